@@ -1,13 +1,215 @@
 from ROOT import *
 from array import array
 import os
-
-RootFiles = {}
-SlimRootFiles = {}
-TreesPassedEvents = {}
-TreesPassedEventsNoHLT = {}
-nEvents = {}
-TreesPassedEventsSlim = {}
+import json
+import fnmatch
+from lib.RootHelpers.EventDeduplication import get_unique_entry_list
+from lib.RootHelpers.ColumnarTreeReader import get_identifiers
+
+
+class LazySampleDict(dict):
+    """
+    Dictionary {sample : object} which calls loader(sample) to fill the
+    entry when a registered sample is asked for the first time.
+    """
+    def __init__(self, loader):
+        super(LazySampleDict, self).__init__()
+        self.loader = loader
+
+    def __contains__(self, sample):
+        return dict.__contains__(self, sample) or (sample in SampleFiles)
+
+    def __missing__(self, sample):
+        if not sample in SampleFiles:
+            raise KeyError(sample)
+        self.loader(sample)
+        return dict.__getitem__(self, sample)
+
+
+SampleFiles = {}  #registered samples {sample : path to root file}, filled by LoadData
+nEventsCacheFile = 'nEvents_cache.json'
+PassedEventsTreeName = "passedEvents_dataMC"
+CheckDuplicates = False  #skip duplicate run/lumi/event entries of the passedEvents trees, set by LoadData
+SlimDir = None  #directory of the slim ntuples, set by LoadData (None: the full trees are read)
+SlimSelection = 'passedFullSelection==1'
+SlimBranches = ['Run', 'LumiSect', 'Event', 'passedFullSelection']  #branch names or patterns always kept in the slim ntuples (selection, duplicates)
+SlimExpressionBranches = []  #identifiers of the cuts, weights and observables (see AddSlimExpressions), kept if they are branches
+
+def OpenSample(sample):
+    """
+    Opens the file of a registered sample and gets the trees.
+    The current ROOT directory is kept, so that copied trees don't end up in the sample file.
+    """
+    file_name = GetSampleTreeFile(sample)
+    print 'Opening sample '+sample+' : '+file_name
+    current_dir = gDirectory.GetPath()
+
+    dict.__setitem__(RootFiles, sample, TFile(file_name,"READ"))
+    dict.__setitem__(TreesPassedEvents, sample, RootFiles[sample].Get(PassedEventsTreeName))
+    dict.__setitem__(TreesPassedEventsNoHLT, sample, RootFiles[sample].Get("Ana/passedEvents"))
+
+    gDirectory.cd(current_dir)
+
+    if (not TreesPassedEvents[sample]): print sample+' has no '+PassedEventsTreeName+' tree'
+
+    if (CheckDuplicates and TreesPassedEvents[sample]):
+        tlist[sample] = get_unique_entry_list(TreesPassedEvents[sample])
+        TreesPassedEvents[sample].SetEntryList(tlist[sample])
+
+
+def GetSampleTreeFile(sample):
+    """
+    Returns the file from which the passedEvents tree of the sample is read:
+    the slim ntuple if the slim cache is used (see GetSlimFile), otherwise the sample file.
+    """
+    if SlimDir:
+        return GetSlimFile(sample)
+    return SampleFiles[sample]
+
+
+def GetSlimKey(sample):
+    """
+    Returns everything the slim ntuple of the sample depends on.
+    """
+    return {
+            'source'    : SampleFiles[sample],
+            'identity'  : GetFileIdentity(SampleFiles[sample]),
+            'tree'      : PassedEventsTreeName,
+            'selection' : SlimSelection,
+            'branches'  : sorted(set(SlimBranches+SlimExpressionBranches)),
+            }
+
+
+def AddSlimExpressions(expressions):
+    """
+    Adds the identifiers of the expressions (cut strings, weights, observables) to SlimExpressionBranches,
+    so that the slim ntuples keep all the branches the expressions need. It has to be called before
+    the samples are opened. The identifiers which are not branches of the tree (e.g. abs) are skipped.
+    """
+    for expression in expressions:
+        if not expression: continue
+        SlimExpressionBranches.extend([identifier for identifier in get_identifiers(expression) if not identifier in SlimExpressionBranches])
+
+
+def GetSlimFile(sample):
+    """
+    Returns the slim ntuple of the sample in SlimDir. It is (re)made with MakeSlimFile
+    if it doesn't exist or if it was made from a different source file (size, mtime),
+    with a different selection or with different branches.
+    """
+    slim_file_name = os.path.join(SlimDir, sample+'_slim.root')
+    slim_key = GetSlimKey(sample)
+
+    slimfileexists = False
+    if os.path.isfile(slim_file_name):
+        current_dir = gDirectory.GetPath()
+        slim_file = TFile(slim_file_name, "READ")
+        stored_key = slim_file.Get('slim_key')
+        if stored_key and slim_key['identity'] and (json.loads(stored_key.GetTitle()) == json.loads(json.dumps(slim_key))):
+            slimfileexists = True
+        slim_file.Close()
+        gDirectory.cd(current_dir)
+
+    if not slimfileexists:
+        MakeSlimFile(sample, slim_file_name, slim_key)
+    return slim_file_name
+
+
+def MakeSlimFile(sample, slim_file_name, slim_key):
+    """
+    Copies the events passing SlimSelection with only the SlimBranches and the
+    SlimExpressionBranches of the passedEvents tree (and the Ana/nEvents histogram) to the slim ntuple. The key
+    it was made from is stored with it as TNamed 'slim_key'.
+    """
+    print 'Making slim ntuple for sample '+sample+' : '+slim_file_name
+    if not os.path.isdir(SlimDir):
+        os.makedirs(SlimDir)
+    current_dir = gDirectory.GetPath()
+
+    source_file = TFile.Open(SampleFiles[sample], "READ")
+    tree = source_file.Get(PassedEventsTreeName)
+    if (not tree):
+        source_file.Close()
+        gDirectory.cd(current_dir)
+        raise IOError, sample+' has no '+PassedEventsTreeName+' tree'
+
+    branch_names = [branch.GetName() for branch in tree.GetListOfBranches()]
+    tree.SetBranchStatus('*', 0)
+    for pattern in SlimBranches:
+        if fnmatch.filter(branch_names, pattern):
+            tree.SetBranchStatus(pattern, 1)
+        else:
+            print 'Branch '+pattern+' not found in '+sample
+    for branch_name in SlimExpressionBranches:
+        if branch_name in branch_names:
+            tree.SetBranchStatus(branch_name, 1)
+
+    #write to temporary file first, so that an interrupted job doesn't leave a valid-looking slim ntuple
+    tmp_file_name = slim_file_name+'.tmp'
+    slim_file = TFile(tmp_file_name, "RECREATE")
+    slim_tree = tree.CopyTree(SlimSelection)
+    slim_tree.Write()
+    h_nevents = source_file.Get("Ana/nEvents")
+    if (h_nevents):
+        slim_file.mkdir("Ana").cd()
+        h_nevents.Write("nEvents")
+        slim_file.cd()
+    TNamed('slim_key', json.dumps(slim_key, sort_keys=True)).Write()
+    print sample+' nEvents in tree: '+str(tree.GetEntries())+' nslimmed: '+str(slim_tree.GetEntries())
+    slim_file.Close()
+    source_file.Close()
+    os.rename(tmp_file_name, slim_file_name)
+    gDirectory.cd(current_dir)
+
+
+def GetFileIdentity(file_name):
+    """
+    Returns [size, mtime] of the file or None if the file cannot be stat-ed (e.g. remote file).
+    """
+    try:
+        file_stat = os.stat(file_name)
+    except OSError:
+        return None
+    return [file_stat.st_size, int(file_stat.st_mtime)]
+
+
+def GetNEvents(sample):
+    """
+    Reads number of events from the 'Ana/nEvents' histogram of the sample. The value is
+    stored in a small sidecar file (nEventsCacheFile), so the sample file is not opened
+    again as long as its size and modification time don't change.
+    """
+    file_name = SampleFiles[sample]
+    identity = GetFileIdentity(file_name)
+
+    cache = {}
+    if os.path.isfile(nEventsCacheFile):
+        with open(nEventsCacheFile) as cache_file:
+            try:
+                cache = json.load(cache_file)
+            except ValueError:
+                print 'Cannot read '+nEventsCacheFile+', it will be recreated.'
+    if identity and (file_name in cache) and (cache[file_name]['identity'] == identity):
+        dict.__setitem__(nEvents, sample, cache[file_name]['nEvents'])
+        return
+
+    h_nevents = RootFiles[sample].Get("Ana/nEvents")
+
+    if (h_nevents):
+        dict.__setitem__(nEvents, sample, h_nevents.Integral())
+    else:
+        dict.__setitem__(nEvents, sample, 0.)
+
+    if identity:
+        cache[file_name] = {'identity' : identity, 'nEvents' : nEvents[sample]}
+        with open(nEventsCacheFile, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=4)
+
+
+RootFiles = LazySampleDict(OpenSample)
+TreesPassedEvents = LazySampleDict(OpenSample)
+TreesPassedEventsNoHLT = LazySampleDict(OpenSample)
+nEvents = LazySampleDict(GetNEvents)
 
 tlist = {}
 
@@ -120,7 +322,12 @@ global eventfile
 global removedfile
 global passedrecofile
 
-def LoadData(dirMC):
+def LoadData(dirMC, checkDuplicates=False, slimDir=None, slimBranches=[]):
+
+    global CheckDuplicates, SlimDir
+    CheckDuplicates = checkDuplicates
+    SlimDir = slimDir
+    SlimBranches.extend([branch for branch in slimBranches if not branch in SlimBranches])
 
     dirData = '/scratch/osghpc/dsperka/Analyzer/SubmitArea_8TeV/'
     SamplesData = ['Data_2012.root']
@@ -174,61 +381,9 @@ def LoadData(dirMC):
 
         sample = SamplesMC[i].rstrip('.root')
 
-        RootFiles[sample] = TFile(dirMC+'/'+sample+'.root',"READ")
-        TreesPassedEvents[sample]  = RootFiles[sample].Get("passedEvents_dataMC")
-        TreesPassedEventsNoHLT[sample]  = RootFiles[sample].Get("Ana/passedEvents")
-
-
-
-
-        h_nevents = RootFiles[sample].Get("Ana/nEvents")
-
-        if (h_nevents):
-            nEvents[sample] = h_nevents.Integral()
-        else:
-            nEvents[sample] = 0.
-        continue
-
-
-        nremoved = 0
-
-
-        if (not TreesPassedEvents[sample]): print sample+' has no passedEvents_dataMC tree'
-
-        checkDuplicates = False
-
-        if (TreesPassedEvents[sample] and (checkDuplicates or (not slimfileexists)) ):
-
-            ### Here we remove duplicate events or Create a slimmed ntuple file
-
-            # keep track of seen events
-            run_lumi_events = set()
-            tlist[sample] = TEntryList(TreesPassedEvents[sample]);
-
-            Nevents = TreesPassedEvents[sample].GetEntriesFast()
-
-            passedrecofile = open('txtfiles/'+sample+'_passedreco.txt','w')
-
-            for entry in xrange(Nevents):
-
-                TreesPassedEvents[sample].GetEntry(entry)
-
-                event = TreesPassedEvents[sample].Event
-                run   = TreesPassedEvents[sample].Run
-                lumi  = TreesPassedEvents[sample].LumiSect
-                run_lumi_event = int(str(run)+str(lumi)+str(event))
-
-                # if we have not seen this event yet, add it to the set
-                if ( (run_lumi_event not in run_lumi_events) and checkDuplicates):
-                    run_lumi_events.add(run_lumi_event)
-                    tlist[sample].Enter(entry,TreesPassedEvents[sample])
-                else:
-                    nremoved +=1
-            passedrecofile.close()
-
-            if (not slimfileexists): SlimRootFiles[sample].Write()
-            if (checkDuplicates): TreesPassedEvents[sample].SetEntryList(tlist[sample]);
-            #print sample+' nEvents: '+str(nEvents[sample]),' nremoved: ',nremoved,' nslimmed: ',TreesPassedEventsSlim[sample].GetEntriesFast()
+        #the file is opened only when the sample is used for the first time (see OpenSample and GetNEvents),
+        #the slim ntuple is made or refreshed at that moment as well (see GetSlimFile)
+        SampleFiles[sample] = dirMC+'/'+sample+'.root'
 
 
     #for i in range(0,len(SamplesData)):
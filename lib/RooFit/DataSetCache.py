@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#-----------------------------------------------
+# Purpose:
+#    - content-addressed cache of RooDataSets in one root file
+#    - entries are keyed by the hash of everything the dataset depends on
+#      (input file identity, cuts, binning ...) and the schema version of the
+#      cache, so stale entries are never used
+#-----------------------------------------------
+import sys, os
+import json
+import hashlib
+from ROOT import *
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.RootHelpers.RootHelperBase import RootHelperBase
+
+
+CACHE_SCHEMA_VERSION = 1  #increase when the content of the entries or the meaning of the keys change
+
+class DataSetCache(RootHelperBase):
+    """
+    Keeps RooDataSets in a root file under the name given by the hash of a
+    key dictionary. The file is opened once and the datasets read from it are
+    kept in memory, so that the same (read-only) dataset object is handed out
+    for the same key. Use get_shared_cache() to have one cache per process.
+    The hashes include CACHE_SCHEMA_VERSION, so the entries of older versions
+    are not used. clear() removes the cache file.
+    A read-only cache is never written. The entries missing in the file are
+    looked up in the fallback cache, if set (e.g. the common cache read by the
+    processes of --jobs, which write into their own files, see merge).
+    """
+
+    hash_prefix = 'ds_'
+    entry_name = 'dataset'  #what the entries are, for the log
+
+    def __init__(self, file_name = 'dataset_cache.root', read_only = False):
+        super(DataSetCache, self).__init__()
+        self.DEBUG = False
+        self.file_name = file_name
+        self.read_only = read_only
+        self.fallback = None
+        self.cache_file = None
+        self.datasets = {}  #{hash : RooDataSet} already handed out
+
+    def get_hash(self, key_dict):
+        """
+        Returns the hash of the key dictionary (any json serializable structure).
+        """
+        return self.hash_prefix+hashlib.sha1(json.dumps(self._get_versioned_key(key_dict), sort_keys=True)).hexdigest()
+
+    def _get_versioned_key(self, key_dict):
+        return {'schema' : CACHE_SCHEMA_VERSION, 'key' : key_dict}
+
+    def _open(self):
+        """
+        Opens the cache file (once). Returns None for a read-only cache without file.
+        """
+        if self.cache_file and self.cache_file.IsOpen():
+            return self.cache_file
+        if self.read_only and not os.path.isfile(self.file_name):
+            return None
+        current_dir = gDirectory.GetPath()
+        self.cache_file = self.TFile_safe_open(self.file_name, {True:'READ', False:'UPDATE'}[self.read_only])
+        gDirectory.cd(current_dir)
+        self.log.info('Opened {0} cache {1} with {2} keys.'.format(self.entry_name, self.file_name, self.cache_file.GetNkeys()))
+        return self.cache_file
+
+    def _read(self, key_hash):
+        """
+        Returns the stored object of the hash from the file or from the fallback cache, None if there is none.
+        """
+        cache_file = self._open()
+        stored = cache_file.Get(key_hash) if cache_file else None
+        if not stored and self.fallback:
+            stored = self.fallback._read(key_hash)
+        return stored
+
+    def get(self, key_dict):
+        """
+        Returns the dataset for the key or None if there is no up-to-date entry.
+        """
+        key_hash = self.get_hash(key_dict)
+        if key_hash in self.datasets:
+            return self.datasets[key_hash]
+
+        dataset = self._read(key_hash)
+        if not dataset:
+            self.log.debug('No {0} in cache for key {1} : {2}'.format(self.entry_name, key_hash, key_dict))
+            return None
+        self.log.debug('Found {0} in cache for key {1}'.format(self.entry_name, key_hash))
+        self.datasets[key_hash] = dataset
+        return dataset
+
+    def put(self, key_dict, dataset):
+        """
+        Stores the dataset under the key. The key itself is stored as well (as TNamed)
+        to be able to see what the entry was made from.
+        """
+        key_hash = self.get_hash(key_dict)
+        if self.read_only:
+            self.datasets[key_hash] = dataset
+            self.log.debug('The cache {0} is read-only, {1} is kept only in memory.'.format(self.file_name, key_hash))
+            return
+        cache_file = self._open()
+        current_dir = gDirectory.GetPath()
+        cache_file.cd()
+        cache_file.WriteTObject(dataset, key_hash, 'Overwrite')
+        cache_file.WriteTObject(TNamed(key_hash+'_key', json.dumps(self._get_versioned_key(key_dict), sort_keys=True)), key_hash+'_key', 'Overwrite')
+        cache_file.Flush()
+        gDirectory.cd(current_dir)
+        self.datasets[key_hash] = dataset
+        self.log.info('Stored {0} {1} in cache {2} under key {3}'.format(self.entry_name, dataset.GetName(), self.file_name, key_hash))
+
+    def get_or_build(self, key_dict, builder):
+        """
+        Returns the cached dataset for the key or builds it with builder() and stores it.
+        """
+        dataset = self.get(key_dict)
+        if dataset:
+            return dataset
+        dataset = builder()
+        if dataset:
+            self.put(key_dict, dataset)
+        return dataset
+
+    def merge(self, file_name):
+        """
+        Copies all the entries of the cache file file_name (e.g. written by a task of --jobs)
+        into this cache and removes that file.
+        """
+        if not os.path.isfile(file_name):
+            return
+        cache_file = self._open()
+        current_dir = gDirectory.GetPath()
+        other_file = self.TFile_safe_open(file_name, 'READ')
+        names = [key.GetName() for key in other_file.GetListOfKeys()]
+        for name in names:
+            cache_file.WriteTObject(other_file.Get(name), name, 'Overwrite')
+        cache_file.Flush()
+        other_file.Close()
+        gDirectory.cd(current_dir)
+        os.remove(file_name)
+        self.log.info('Merged {0} keys of {1} into {2}.'.format(len(names), file_name, self.file_name))
+
+    def close(self):
+        if self.cache_file and self.cache_file.IsOpen():
+            self.cache_file.Close()
+        self.datasets = {}
+
+    def clear(self):
+        """
+        Closes and removes the cache file, all the entries are rebuilt when they are asked for.
+        """
+        self.close()
+        if os.path.isfile(self.file_name):
+            os.remove(self.file_name)
+            self.log.info('Removed cache {0}.'.format(self.file_name))
+
+
+_shared_caches = {}
+
+def get_shared_cache(file_name = 'dataset_cache.root', fallback_file_name = ''):
+    """
+    Returns the DataSetCache for the file. There is only one cache object per file in the process.
+    If fallback_file_name is given, it is read (read-only) for the entries missing in the file.
+    """
+    if not file_name in _shared_caches:
+        _shared_caches[file_name] = DataSetCache(file_name)
+    cache = _shared_caches[file_name]
+    if fallback_file_name and not cache.fallback:
+        cache.fallback = DataSetCache(fallback_file_name, read_only=True)
+    return cache
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#-----------------------------------------------
+# Purpose:
+#    - content-addressed cache of fit results in one root file (see DataSetCache)
+#    - entries are keyed by the hash of everything the fit depends on (dataset
+#      content, initial values and ranges of the parameters, frozen parameters,
+#      fit options), so a repeated fit returns the stored result without minimizing
+#-----------------------------------------------
+import sys, os
+import json
+import hashlib
+import numpy as np
+from ROOT import *
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.RooFit.DataSetCache import DataSetCache
+from lib.fitting.ParametrizationFit import FitResult
+
+
+def get_data_fingerprint(arrays):
+    """
+    Returns the hash of the content of the numpy arrays (e.g. values and weights of the events).
+    """
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        sha1.update(str(array.shape))
+        sha1.update(array.tostring())
+    return sha1.hexdigest()
+
+
+class FitResultCache(DataSetCache):
+    """
+    Keeps fit results in a root file under the name given by the hash of a key
+    dictionary: RooFitResult as it is and FitResult (numpy engine) as json string.
+    Use get_shared_fit_cache() to have one cache per process.
+    """
+
+    hash_prefix = 'fr_'
+    entry_name = 'fit result'
+
+    def __init__(self, file_name = 'fit_result_cache.root', read_only = False):
+        super(FitResultCache, self).__init__(file_name, read_only)
+
+    def get(self, key_dict, parameters=None):
+        """
+        Returns the fit result for the key or None if there is no entry. The FitResult
+        of the numpy engine is restored into the parameters (OrderedDict {name : FitParameter}).
+        """
+        fit_result = super(FitResultCache, self).get(key_dict)
+        if not fit_result:
+            return None
+        if isinstance(fit_result, TNamed):
+            return FitResult.from_dict(json.loads(fit_result.GetTitle()), parameters)
+        return fit_result
+
+    def put(self, key_dict, fit_result):
+        if isinstance(fit_result, FitResult):
+            key_hash = self.get_hash(key_dict)
+            fit_result = TNamed(key_hash, json.dumps(fit_result.to_dict()))
+        super(FitResultCache, self).put(key_dict, fit_result)
+
+
+_shared_fit_caches = {}
+
+def get_shared_fit_cache(file_name = 'fit_result_cache.root', fallback_file_name = ''):
+    """
+    Returns the FitResultCache for the file. There is only one cache object per file in the process.
+    If fallback_file_name is given, it is read (read-only) for the entries missing in the file.
+    """
+    if not file_name in _shared_fit_caches:
+        _shared_fit_caches[file_name] = FitResultCache(file_name)
+    cache = _shared_fit_caches[file_name]
+    if fallback_file_name and not cache.fallback:
+        cache.fallback = FitResultCache(fallback_file_name, read_only=True)
+    return cache
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - read only the branches needed by cuts and observables from a TTree
+#    - keep them as contiguous numpy arrays (columns)
+#    - build RooDataSet from the columns
+#-----------------------------------------------
+import sys, os
+import re
+import collections
+import numpy as np
+from ROOT import *
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.RootHelpers.RootHelperBase import RootHelperBase
+from lib.util.FormulaCompiler import FormulaCompiler
+
+
+def get_identifiers(expression):
+    """
+    Returns list of identifiers (branch names, functions, ...) used in a
+    TTree::Draw-like expression, e.g. 'abs(GENidLS3[GENlepIndex1])==11' gives
+    ['abs', 'GENidLS3', 'GENlepIndex1'].
+    """
+    return re.findall(r'[A-Za-z_][A-Za-z0-9_]*', expression)
+
+
+def _get_draw_values(buf, n_values):
+    """
+    Returns copy of the first n_values of the double buffer filled by TTree::Draw (GetVal, GetV1, ...).
+    """
+    if n_values <= 0:
+        return np.zeros(0)
+    if hasattr(buf, 'SetSize'):
+        buf.SetSize(n_values)
+    else:
+        buf.reshape((n_values,))
+    return np.frombuffer(buf, dtype=np.float64, count=n_values).copy()
+
+
+class ColumnarTreeReader(RootHelperBase):
+    """
+    Reads columns from a TTree into numpy arrays. A column is either a branch
+    name or any TTree::Draw expression (e.g. a cut string which gives 0/1).
+    Only the branches used by the columns and by the selection are read.
+    If root_numpy is available it is used for reading, otherwise the columns
+    are evaluated with TTreeFormula. The entry list of the tree (if set) is
+    respected.
+    Columns which are expressions of branches (cut strings) are by default
+    compiled (FormulaCompiler) and evaluated on the arrays of the branches,
+    sharing common subexpressions between the columns.
+    """
+
+    def __init__(self, compile_formulas=True):
+        super(ColumnarTreeReader, self).__init__()
+        self.DEBUG = False
+        self.compile_formulas = compile_formulas
+        self.compiler = FormulaCompiler()
+
+    def get_branch_names(self, tree):
+        """
+        Returns the set of all branch names of the tree.
+        """
+        return set([branch.GetName() for branch in tree.GetListOfBranches()])
+
+    def get_required_branches(self, tree, expressions):
+        """
+        Returns list of branches of the tree that are needed to evaluate all the
+        expressions (cut strings, observables, weights).
+        """
+        branch_names = self.get_branch_names(tree)
+        required_branches = []
+        for expression in expressions:
+            if not expression: continue
+            for identifier in get_identifiers(expression):
+                if identifier in branch_names and not identifier in required_branches:
+                    required_branches.append(identifier)
+        return required_branches
+
+    def read(self, tree, columns, selection=None):
+        """
+        Read the columns for the entries passing the selection.
+
+        Returns:
+        --------
+        OrderedDict {column : numpy array}
+        """
+        columns = list(collections.OrderedDict.fromkeys(columns))  #remove duplicates, keep order
+        compiled_columns = self._get_compiled_columns(tree, columns)
+        if not compiled_columns:
+            return self._read(tree, columns, selection)
+
+        raw_columns = [column for column in columns if not column in compiled_columns]
+        for column in compiled_columns:
+            raw_columns+=sorted(self.compiler.compile(column).variables)
+        raw_arrays = self._read(tree, list(collections.OrderedDict.fromkeys(raw_columns)), selection)
+        compiled_arrays = self.compiler.evaluate(compiled_columns, raw_arrays)
+
+        arrays = collections.OrderedDict()
+        for column in columns:
+            if column in compiled_arrays:
+                arrays[column] = compiled_arrays[column]
+            else:
+                arrays[column] = raw_arrays[column]
+        return arrays
+
+    def _get_compiled_columns(self, tree, columns):
+        """
+        Returns the columns which are expressions that can be compiled and use only branches of the tree.
+        """
+        if not self.compile_formulas: return []
+        branch_names = self.get_branch_names(tree)
+        compiled_columns = []
+        for column in columns:
+            if column in branch_names or not self.compiler.can_compile(column): continue
+            if self.compiler.compile(column).variables <= branch_names:
+                compiled_columns.append(column)
+        return compiled_columns
+
+    def _is_jagged(self, tree, column):
+        """
+        True if the column is a branch with more values per entry (array or vector).
+        """
+        leaf = tree.GetLeaf(column)
+        if not leaf: return False
+        return bool(leaf.GetLeafCount()) or leaf.GetLenStatic()>1 or leaf.GetTypeName().startswith('vector')
+
+    def _read(self, tree, columns, selection=None):
+        """
+        Read the columns (branches or TTree::Draw expressions) with root_numpy or TTreeFormula.
+        Array and vector branches give object arrays of per-entry numpy arrays.
+        """
+        required_branches = self.get_required_branches(tree, columns+[selection])
+        self.log.debug('Reading {0} columns from tree {1} using {2} of {3} branches: {4}'.format(len(columns), tree.GetName(),
+                                                                                              len(required_branches), tree.GetNbranches(), required_branches))
+        try:
+            from root_numpy import tree2array
+            if tree.GetEntryList():
+                raise ImportError('root_numpy does not use the entry list of the tree')
+        except ImportError, e:
+            self.log.debug('Reading columns with TTreeFormula: {0}'.format(e))
+            arrays = self._read_with_formulas(tree, columns, selection, required_branches)
+        else:
+            records = tree2array(tree, branches=columns, selection=selection)
+            arrays = collections.OrderedDict()
+            for column in columns:
+                arrays[column] = np.ascontiguousarray(records[column])
+
+        if len(arrays):
+            self.log.debug('Read {0} entries.'.format(len(arrays.values()[0])))
+        return arrays
+
+    def _read_with_formulas(self, tree, columns, selection, required_branches):
+        """
+        Evaluate the columns with TTreeFormula having only required branches enabled.
+        If the columns and the selection have one value per entry, they are evaluated
+        by TTree::Draw (see _draw_columns), otherwise entry by entry. The status
+        of the branches is restored at the end.
+        """
+        branch_status = [(branch.GetName(), tree.GetBranchStatus(branch.GetName())) for branch in tree.GetListOfBranches()]
+        tree.SetBranchStatus('*', 0)
+        try:
+            for branch_name in required_branches:
+                tree.SetBranchStatus(branch_name, 1)
+
+            formulas = [TTreeFormula('column_formula_{0}'.format(idx), column, tree) for idx, column in enumerate(columns)]
+            selection_formula = None
+            if selection:
+                selection_formula = TTreeFormula('selection_formula', selection, tree)
+
+            jagged = [self._is_jagged(tree, column) for column in columns]
+            one_value = not any(jagged) and all([formula.GetMultiplicity() == 0 for formula in formulas+[selection_formula] if formula])
+            #':' separates the columns of TTree::Draw (but not in '::')
+            if one_value and not any([':' in column.replace('::', '') for column in columns]):
+                return self._draw_columns(tree, columns, selection)
+            return self._evaluate_entries(tree, columns, formulas, selection_formula, jagged)
+        finally:
+            for branch_name, status in branch_status:
+                tree.SetBranchStatus(branch_name, status)
+
+    def _draw_columns(self, tree, columns, selection):
+        """
+        Evaluate the columns (one value per entry) for the entries passing the selection with
+        TTree::Draw, up to 4 columns at once, and copy the values into numpy arrays.
+        """
+        estimate = tree.GetEstimate()
+        tree.SetEstimate(tree.GetEntries()+1)
+        arrays = collections.OrderedDict()
+        try:
+            for start in range(0, len(columns), 4):
+                chunk = columns[start:start+4]
+                n_selected = tree.Draw(':'.join(chunk), selection or '', 'goff')
+                if n_selected < 0:
+                    raise ValueError, 'Cannot evaluate the columns {0} on tree {1}.'.format(chunk, tree.GetName())
+                for idx, column in enumerate(chunk):
+                    arrays[column] = _get_draw_values(tree.GetVal(idx), n_selected)
+        finally:
+            tree.SetEstimate(estimate)
+        return arrays
+
+    def _evaluate_entries(self, tree, columns, formulas, selection_formula, jagged):
+        """
+        Evaluate the formulas of the columns entry by entry (array and vector columns).
+        """
+        entry_list = tree.GetEntryList()
+        if entry_list:
+            entries = (entry_list.GetEntry(idx) for idx in xrange(entry_list.GetN()))
+            n_entries = entry_list.GetN()
+        else:
+            n_entries = tree.GetEntries()
+            entries = xrange(n_entries)
+
+        buffers = [np.empty(n_entries, dtype={True:object, False:np.float64}[is_jagged]) for is_jagged in jagged]
+        n_selected = 0
+        for entry in entries:
+            tree.LoadTree(entry)
+            if selection_formula:
+                selection_formula.GetNdata()
+                if not selection_formula.EvalInstance(): continue
+            for formula, buf, is_jagged in zip(formulas, buffers, jagged):
+                n_data = formula.GetNdata()
+                if is_jagged:
+                    buf[n_selected] = np.array([formula.EvalInstance(idx) for idx in xrange(n_data)])
+                else:
+                    buf[n_selected] = formula.EvalInstance()
+            n_selected+=1
+
+        arrays = collections.OrderedDict()
+        for column, buf in zip(columns, buffers):
+            arrays[column] = buf[:n_selected].copy()
+        return arrays
+
+    def get_RooDataSet(self, name, variables, arrays, weight_var=None, mask=None):
+        """
+        Creates RooDataSet with RooRealVars from the list 'variables' filled from
+        'arrays' {variable_name : numpy array}. Like for the import from a TTree,
+        entries with values outside of the variable ranges are skipped.
+        The 'mask' (boolean array) can be used to select the entries.
+        With ROOT >= 6.26 the dataset is filled with RooDataSet.from_numpy.
+        """
+        arg_set = RooArgSet()
+        for var in variables:
+            arg_set.add(var)
+        if weight_var:
+            arg_set.add(weight_var)
+            dataset = RooDataSet(name, name, arg_set, RooFit.WeightVar(weight_var))
+        else:
+            dataset = RooDataSet(name, name, arg_set)
+
+        all_variables = list(variables)
+        if weight_var: all_variables.append(weight_var)
+        if not len(all_variables): return dataset
+
+        n_entries = len(arrays[all_variables[0].GetName()])
+        selected = np.ones(n_entries, dtype=bool)
+        if mask is not None:
+            selected &= mask
+        for var in all_variables:
+            values = arrays[var.GetName()]
+            selected &= (values >= var.getMin()) & (values <= var.getMax())
+
+        columns = collections.OrderedDict([(var.GetName(), np.ascontiguousarray(arrays[var.GetName()][selected], dtype=np.float64)) for var in all_variables])
+        if hasattr(RooDataSet, 'from_numpy'):
+            #ROOT >= 6.26 fills the dataset from the arrays in C++
+            dataset = RooDataSet.from_numpy(columns, arg_set, name=name, title=name, weight_name=weight_var.GetName() if weight_var else None)
+        else:
+            #the lookups are done once, the loop only sets the values (python floats) and adds the row
+            setters = [var.setVal for var in variables]
+            add = dataset.add
+            rows = zip(*[column.tolist() for column in columns.values()])
+            if weight_var:
+                for row in rows:
+                    for set_value, value in zip(setters, row):
+                        set_value(value)
+                    add(arg_set, row[-1])
+            else:
+                for row in rows:
+                    for set_value, value in zip(setters, row):
+                        set_value(value)
+                    add(arg_set)
+
+        self.log.debug('Filled RooDataSet {0} with {1} of {2} entries.'.format(name, dataset.numEntries(), n_entries))
+        return dataset
+
+
+def read_columns_from_file(file_name, tree_name, columns, selection=None, unique_events=False):
+    """
+    Opens the file, reads the columns of the tree for the entries passing the
+    selection and closes the file. Returns OrderedDict {column : numpy array}.
+    If unique_events is set, duplicate events are skipped (see EventDeduplication).
+    Meant to be used as a task in worker processes (see lib.util.ProcessPool).
+    """
+    root_file = TFile.Open(file_name, 'READ')
+    if not root_file or root_file.IsZombie():
+        raise IOError, 'The file {0} either doesn\'t exist or cannot be open'.format(file_name)
+    tree = root_file.Get(tree_name)
+    if not tree:
+        root_file.Close()
+        raise IOError, 'There is no tree {0} in file {1}'.format(tree_name, file_name)
+    if unique_events:
+        from lib.RootHelpers.EventDeduplication import get_unique_entry_list
+        tree.SetEntryList(get_unique_entry_list(tree))
+    arrays = ColumnarTreeReader().read(tree, columns, selection)
+    root_file.Close()
+    return arrays
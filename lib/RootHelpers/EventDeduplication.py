@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - find duplicate events (same run, lumi section and event number) in a TTree
+#    - keep only the first occurrence using a TEntryList
+#-----------------------------------------------
+import sys, os
+import numpy as np
+from ROOT import *
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.RootHelpers.ColumnarTreeReader import ColumnarTreeReader
+
+
+def _n_bits(values):
+    """
+    Number of bits needed to store the largest of the (non-negative) values.
+    """
+    if not len(values): return 0
+    return int(values.max()).bit_length()
+
+
+def pack_event_keys(run, lumi, event):
+    """
+    Packs run, lumi and event arrays into collision-free keys. If all the values
+    fit into 64 bits, the keys are uint64 (run in the highest bits, event in the lowest),
+    otherwise a structured array (run, lumi, event) is returned. In both cases
+    the keys sort in the (run, lumi, event) order.
+    """
+    run   = np.asarray(run).astype(np.uint64)
+    lumi  = np.asarray(lumi).astype(np.uint64)
+    event = np.asarray(event).astype(np.uint64)
+
+    lumi_bits  = _n_bits(lumi)
+    event_bits = _n_bits(event)
+    if _n_bits(run)+lumi_bits+event_bits <= 64:
+        return (run << np.uint64(lumi_bits+event_bits)) | (lumi << np.uint64(event_bits)) | event
+
+    keys = np.empty(len(run), dtype=[('run', np.uint64), ('lumi', np.uint64), ('event', np.uint64)])
+    keys['run']   = run
+    keys['lumi']  = lumi
+    keys['event'] = event
+    return keys
+
+
+def get_first_occurrence_mask(run, lumi, event):
+    """
+    Returns boolean array which is True for the first occurrence of each
+    (run, lumi, event) and False for the duplicates.
+    """
+    keys = pack_event_keys(run, lumi, event)
+    mask = np.zeros(len(keys), dtype=bool)
+    if len(keys):
+        unique_keys, first_index = np.unique(keys, return_index=True)
+        mask[first_index] = True
+    return mask
+
+
+def get_unique_entries_mask(tree, run='Run', lumi='LumiSect', event='Event'):
+    """
+    Reads only the run, lumi and event branches of the tree and returns the mask
+    of entries to keep (first occurrence of each event).
+    """
+    tree_entry_list = tree.GetEntryList()
+    if tree_entry_list: tree.SetEntryList(0)
+    try:
+        arrays = ColumnarTreeReader().read(tree, [run, lumi, event])
+    finally:
+        if tree_entry_list: tree.SetEntryList(tree_entry_list)
+    return get_first_occurrence_mask(arrays[run], arrays[lumi], arrays[event])
+
+
+def get_unique_entry_list(tree, run='Run', lumi='LumiSect', event='Event'):
+    """
+    Returns TEntryList of the tree with the first occurrence of each event.
+    It can be set to the tree with tree.SetEntryList(...) to skip the duplicates.
+    The list of all entries is made by TTree::Draw, only the duplicates are removed one by one.
+    """
+    log = Logger().getLogger('get_unique_entry_list', 10)
+    mask = get_unique_entries_mask(tree, run, lumi, event)
+    list_name = 'unique_entries_{0}'.format(tree.GetName())
+    tree_entry_list = tree.GetEntryList()
+    if tree_entry_list: tree.SetEntryList(0)
+    try:
+        tree.Draw('>>'+list_name, '', 'entrylist goff')
+        entry_list = gDirectory.Get(list_name)
+    finally:
+        if tree_entry_list: tree.SetEntryList(tree_entry_list)
+    entry_list.SetDirectory(0)
+    for entry in np.flatnonzero(~mask):
+        entry_list.Remove(int(entry), tree)
+    log.info('Tree {0}: kept {1} of {2} entries, removed {3} duplicate events.'.format(tree.GetName(), int(mask.sum()), len(mask), len(mask)-int(mask.sum())))
+    return entry_list
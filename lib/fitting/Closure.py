@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - closure test of several DCB parametrizations (formulas of MH) on the same
+#      mass points: the events of each mass point are kept once and compared with
+#      the DCB of every parametrization, only the yield is fitted
+#    - table of the yield, NLL and chi-square per parametrization and mass point
+#-----------------------------------------------
+import sys, os
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.fitting.DoubleCB import DoubleCB
+from lib.fitting.Parametrization import CompiledParametrization
+from lib.fitting.ParametrizationFit import MassPoint
+from lib.fitting.GoodnessOfFit import ChiSquareCalculator
+
+
+class ClosureResult(object):
+    """
+    Result of the closure test of one parametrization at one mass point: the fitted yield
+    (and error), the extended NLL at the fitted yield and the ChiSquare.
+    """
+
+    def __init__(self, name, MH, n_yield, yield_error, nll, chi_square):
+        self.name = name
+        self.MH = MH
+        self.n_yield = n_yield
+        self.yield_error = yield_error
+        self.nll = nll
+        self.chi_square = chi_square
+
+    def __repr__(self):
+        return 'ClosureResult(name={0}, MH={1}, yield={2:.4g} +/- {3:.3g}, NLL={4:.6g}, {5})'.format(self.name, self.MH,
+                                                                    self.n_yield, self.yield_error, self.nll, self.chi_square)
+
+
+class ClosureTest(object):
+    """
+    Closure test of the parametrizations OrderedDict {name : {DCB parameter : formula of @0 (=MH)}}
+    on the mass points (MassPoint) in [x_low, x_high], chi-square in n_bins bins.
+    The DCB shapes are fixed by the parametrizations and only the yield is fitted. For the extended
+    likelihood with the normalized shape the fitted yield is the sum of weights of the events in the
+    range (error sqrt of the sum of squared weights, as with SumW2Error), so no minimization is needed.
+    """
+
+    def __init__(self, parametrizations, x_low, x_high, n_bins):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.parametrizations = collections.OrderedDict([(name, CompiledParametrization(formulas))
+                                                         for name, formulas in parametrizations.iteritems()])
+        self.dcb = DoubleCB(x_low, x_high)
+        self.chi_square_calculator = ChiSquareCalculator(x_low, x_high, n_bins)
+        self.mass_points = []
+
+    def add_mass_point(self, mass_point):
+        """
+        Adds the events of the mass point (a copy with the events in the range), shared by all parametrizations.
+        """
+        in_range = (mass_point.x >= self.dcb.x_low) & (mass_point.x <= self.dcb.x_high)
+        mass_point = MassPoint(mass_point.MH, mass_point.x[in_range], mass_point.weights[in_range])
+        self.mass_points.append(mass_point)
+        self.chi_square_calculator.set_data(mass_point.MH, mass_point.x, mass_point.weights)
+
+    def run(self):
+        """
+        Returns OrderedDict {parametrization name : [ClosureResult for each mass point]}.
+        """
+        MH_values = np.array([mass_point.MH for mass_point in self.mass_points])
+        results = collections.OrderedDict()
+        for name, parametrization in self.parametrizations.iteritems():
+            #the DCB parameters of all mass points at once
+            dcb_values = np.array(parametrization.evaluate(MH_values).values()).reshape(-1, len(MH_values))
+            results[name] = []
+            for idx, mass_point in enumerate(self.mass_points):
+                params = tuple(dcb_values[:, idx])
+                n_yield = mass_point.sum_weights()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    nll = n_yield - np.dot(mass_point.weights, self.dcb.log_pdf(mass_point.x, params)+np.log(n_yield))
+                chi_square = self.chi_square_calculator.get(mass_point.MH, params, 1, n_yield)
+                results[name].append(ClosureResult(name, mass_point.MH, n_yield, np.sqrt(np.sum(mass_point.weights**2)), float(nll), chi_square))
+        return results
+
+    def print_table(self, results):
+        """
+        Prints the chi-square/ndof and the NLL (relative to the best parametrization of the mass point)
+        of each parametrization and mass point.
+        """
+        names = results.keys()
+        best_nll = [min([results[name][idx].nll for name in names]) for idx in range(len(self.mass_points))]
+        print 'Closure test of {0} parametrizations: chi2/ndof (ndof), NLL - NLL_best'.format(len(names))
+        print '    {0:>8s} '.format('MH') + ' '.join(['{0:>32s}'.format(name[-32:]) for name in names])
+        for idx, mass_point in enumerate(self.mass_points):
+            cells = ['{0:10.3f} ({1:3d}) {2:14.3f}'.format(results[name][idx].chi_square.per_ndof(), results[name][idx].chi_square.ndof,
+                                                         results[name][idx].nll-best_nll[idx]) for name in names]
+            print '    {0:8.2f} '.format(mass_point.MH) + ' '.join(['{0:>32s}'.format(cell) for cell in cells])
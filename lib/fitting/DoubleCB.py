@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - Double Crystal-Ball (DCB) shape as in RooDoubleCB from HiggsAnalysis/CombinedLimit,
+#      evaluated on whole numpy arrays at once
+#    - normalization over a range with the closed-form integrals of the
+#      gaussian core and of the power-law tails (no numeric integration)
+#-----------------------------------------------
+import sys
+import math
+import numpy as np
+
+try:
+    from scipy.special import erf, erfinv
+except ImportError:
+    erf = np.vectorize(math.erf, otypes=[np.float64])
+
+    def erfinv(y):
+        """
+        Inverse of erf: approximation by S. Winitzki refined by Newton steps.
+        """
+        y = np.asarray(y, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_term = np.log(1.-y*y)
+            first_term = 2./(math.pi*0.147) + 0.5*log_term
+            x = np.sign(y)*np.sqrt(np.sqrt(first_term*first_term - log_term/0.147) - first_term)
+            for step in range(3):
+                x = np.where(np.isfinite(x), x - (erf(x)-y)/(2./math.sqrt(math.pi)*np.exp(-x*x)), x)
+        return x
+
+
+DCB_PARAMETERS = ['mean', 'sigma', 'alpha', 'n', 'alpha2', 'n2']
+
+SQRT_HALF_PI = math.sqrt(0.5*math.pi)
+SQRT_HALF = math.sqrt(0.5)
+N_EQUAL_ONE_SHIFT = 1e-8  #the tail primitive has a log form for n=1, the n is shifted instead in the quantile
+
+
+def _tail_constants(alpha, n):
+    """
+    Returns (log A, B) of the tail A*(B-t)^-n attached at t=-alpha.
+    """
+    alpha, n = np.float64(abs(alpha)), np.float64(n)  #numpy floats give inf for alpha=0 (the limit of its range), no exception
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_A = n*np.log(n/alpha) - 0.5*alpha*alpha  #nan for n<=0 as pow(n/alpha, n) in RooDoubleCB
+        B = n/alpha - alpha
+    return (log_A, B)
+
+
+def _tail_constants_gradient(alpha, n):
+    """
+    Returns the derivatives (d log A/d alpha, d log A/d n, dB/d alpha, dB/d n)
+    of the tail constants with respect to |alpha| and n.
+    """
+    alpha, n = np.float64(abs(alpha)), np.float64(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dlogA_dn = np.log(n/alpha) + 1.
+        return (-n/alpha - alpha, dlogA_dn, -n/(alpha*alpha) - 1., 1./alpha)
+
+
+def _shift_n(n):
+    if np.ndim(n):
+        #arrays of n (e.g. DCB parameters of many MH values)
+        n = np.asarray(n, dtype=np.float64)
+        return np.where(np.abs(n-1.) < N_EQUAL_ONE_SHIFT, 1.+np.where(n < 1., -N_EQUAL_ONE_SHIFT, N_EQUAL_ONE_SHIFT), n)
+    if abs(n-1.) < N_EQUAL_ONE_SHIFT:
+        return 1.+math.copysign(N_EQUAL_ONE_SHIFT, n-1.)
+    return n
+
+
+def _tail_primitive(t, alpha, n):
+    """
+    Primitive function of the left tail A*(B-t)^-n, i.e. A/(n-1)*(B-t)^(1-n).
+    """
+    n = _shift_n(n)
+    log_A, B = _tail_constants(alpha, n)
+    return np.exp(log_A + (1.-n)*np.log(B-t))/(n-1.)
+
+
+def _expm1_ratio(z):
+    """
+    (exp(z)-1)/z, which is 1 at z=0.
+    """
+    z = np.asarray(z, dtype=np.float64)
+    small = np.abs(z) < 1e-8
+    return np.where(small, 1.+0.5*z, np.expm1(z)/np.where(small, 1., z))
+
+
+def _expm1_ratio_log_derivative(z):
+    """
+    Derivative of log((exp(z)-1)/z), i.e. 1/(1-exp(-z)) - 1/z, which is 1/2 at z=0.
+    """
+    z = np.asarray(z, dtype=np.float64)
+    small = np.abs(z) < 1e-4
+    z_safe = np.where(small, 1., z)
+    return np.where(small, 0.5 + z/12., -1./np.expm1(-z_safe) - 1./z_safe)
+
+
+def _tail_integral(t_a, t_b, alpha, n):
+    """
+    Integral of the left tail A*(B-t)^-n from t_a to t_b (t_a <= t_b <= -alpha). It is written as
+    A*(B-t_a)^(1-n)*(-d)*(exp((1-n)*d)-1)/((1-n)*d) with d = log((B-t_b)/(B-t_a)), which goes
+    smoothly into the log form A*(-d) at n=1, so n doesn't have to be shifted.
+    """
+    log_A, B = _tail_constants(alpha, n)
+    log_D_a = np.log(B-t_a)
+    d = np.log(B-t_b) - log_D_a
+    return np.exp(log_A + (1.-n)*log_D_a)*(-d)*_expm1_ratio((1.-n)*d)
+
+
+def _tail_integral_gradient(t_a, t_b, alpha, n):
+    """
+    Derivatives of _tail_integral with respect to |alpha| and n at fixed t_a, t_b (also at n=1).
+    """
+    log_A, B = _tail_constants(alpha, n)
+    dlogA_da, dlogA_dn, dB_da, dB_dn = _tail_constants_gradient(alpha, n)
+    e = 1.-n
+    log_D_a = np.log(B-t_a)
+    d = np.log(B-t_b) - log_D_a
+    #the integral is -d*scale, the derivative of log(-d) is (dd/dB)*dB/d and the (-d) cancels in it
+    scale = np.exp(log_A + e*log_D_a)*_expm1_ratio(e*d)
+    integral = -d*scale
+    dd_dB = 1./(B-t_b) - 1./(B-t_a)
+    g = _expm1_ratio_log_derivative(e*d)
+    d_alpha = integral*(dlogA_da + e*dB_da/(B-t_a) + g*e*dB_da*dd_dB) - scale*dB_da*dd_dB
+    d_n = integral*(dlogA_dn - log_D_a + e*dB_dn/(B-t_a) + g*(e*dB_dn*dd_dB - d)) - scale*dB_dn*dd_dB
+    return (d_alpha, d_n)
+
+
+def _inverse_tail_primitive(primitive, alpha, n):
+    """
+    Returns t where _tail_primitive(t, alpha, n) equals the primitive.
+    """
+    n = _shift_n(n)
+    log_A, B = _tail_constants(alpha, n)
+    return B - np.exp((np.log(primitive*(n-1.)) - log_A)/(1.-n))
+
+
+def _core_primitive(t):
+    """
+    Primitive function of the gaussian core exp(-t^2/2).
+    """
+    return SQRT_HALF_PI*erf(SQRT_HALF*np.asarray(t, dtype=np.float64))
+
+
+def dcb_standard_shape(t, alpha, n, alpha2, n2):
+    """
+    Unnormalized DCB as function of t = (x-mean)/sigma: gaussian core between
+    -alpha and alpha2, power-law tails outside.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    alpha, alpha2 = abs(alpha), abs(alpha2)
+    values = np.exp(-0.5*t*t)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        left = t <= -alpha
+        if np.any(left):
+            log_A, B = _tail_constants(alpha, n)
+            values = np.where(left, np.exp(log_A - n*np.log(np.where(left, B-t, 1.))), values)
+        right = t >= alpha2
+        if np.any(right):
+            log_A, B = _tail_constants(alpha2, n2)
+            values = np.where(right, np.exp(log_A - n2*np.log(np.where(right, B+t, 1.))), values)
+    return values
+
+
+def dcb_standard_integral(t_low, t_high, alpha, n, alpha2, n2):
+    """
+    Closed-form integral of dcb_standard_shape from t_low to t_high
+    (both can be arrays, e.g. bin edges).
+    """
+    t_low  = np.asarray(t_low, dtype=np.float64)
+    t_high = np.asarray(t_high, dtype=np.float64)
+    alpha, alpha2 = abs(alpha), abs(alpha2)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        #left tail
+        low, high = t_low, np.minimum(t_high, -alpha)
+        integral = np.where(low < high, _tail_integral(np.minimum(low, -alpha), np.minimum(high, -alpha), alpha, n), 0.)
+        #gaussian core
+        low, high = np.maximum(t_low, -alpha), np.minimum(t_high, alpha2)
+        integral = integral + np.where(low < high, _core_primitive(high) - _core_primitive(low), 0.)
+        #right tail (mirrored left tail)
+        low, high = np.maximum(t_low, alpha2), t_high
+        integral = integral + np.where(low < high, _tail_integral(np.minimum(-high, -alpha2), np.minimum(-low, -alpha2), alpha2, n2), 0.)
+    return integral
+
+
+def dcb_standard_quantile(p, t_low, t_high, alpha, n, alpha2, n2):
+    """
+    Inverse of the cumulative distribution of dcb_standard_shape normalized on [t_low, t_high]:
+    returns t where the integral from t_low is the fraction p (array) of the total.
+    The tails are inverted in closed form and the gaussian core with erfinv.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    t_low, t_high = float(t_low), float(t_high)
+    alpha, alpha2 = abs(alpha), abs(alpha2)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        #integrals of the left tail, the core and the right tail within [t_low, t_high]
+        left_low_primitive = _tail_primitive(min(t_low, -alpha), alpha, n)
+        left_integral = 0.
+        if t_low < -alpha:
+            left_integral = _tail_primitive(min(t_high, -alpha), alpha, n) - left_low_primitive
+        core_low, core_high = max(t_low, -alpha), min(t_high, alpha2)
+        core_low_primitive = _core_primitive(core_low)
+        core_integral = 0.
+        if core_low < core_high:
+            core_integral = _core_primitive(core_high) - core_low_primitive
+        right_low_primitive = _tail_primitive(-max(t_low, alpha2), alpha2, n2)
+        right_integral = 0.
+        if t_high > alpha2:
+            right_integral = right_low_primitive - _tail_primitive(-t_high, alpha2, n2)
+
+        integral = p*(left_integral+core_integral+right_integral)
+        t = np.empty_like(integral)
+        left = integral < left_integral
+        t[left] = _inverse_tail_primitive(left_low_primitive + integral[left], alpha, n)
+        core = ~left & (integral < left_integral+core_integral)
+        t[core] = erfinv((core_low_primitive + integral[core] - left_integral)/SQRT_HALF_PI)/SQRT_HALF
+        right = ~(left | core)
+        t[right] = -_inverse_tail_primitive(right_low_primitive - (integral[right] - left_integral - core_integral), alpha2, n2)
+    return np.clip(t, t_low, t_high)
+
+
+def dcb_standard_log_shape_gradient(t, alpha, n, alpha2, n2):
+    """
+    Log of dcb_standard_shape and its derivatives with respect to (t, alpha, n, alpha2, n2).
+
+    Returns:
+    --------
+    (log shape, array of shape (5, len(t)) with the derivatives)
+    """
+    t = np.asarray(t, dtype=np.float64)
+    sign_alpha, sign_alpha2 = math.copysign(1., alpha), math.copysign(1., alpha2)
+    alpha, alpha2 = abs(alpha), abs(alpha2)
+    log_shape = -0.5*t*t
+    gradient = np.zeros((5,)+t.shape)
+    gradient[0] = -t
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        left = t <= -alpha
+        if np.any(left):
+            log_A, B = _tail_constants(alpha, n)
+            dlogA_da, dlogA_dn, dB_da, dB_dn = _tail_constants_gradient(alpha, n)
+            D = np.where(left, B-t, 1.)
+            log_D = np.log(D)
+            log_shape = np.where(left, log_A - n*log_D, log_shape)
+            gradient[0] = np.where(left, n/D, gradient[0])
+            gradient[1] = np.where(left, sign_alpha*(dlogA_da - n*dB_da/D), 0.)
+            gradient[2] = np.where(left, dlogA_dn - log_D - n*dB_dn/D, 0.)
+        right = t >= alpha2
+        if np.any(right):
+            log_A, B = _tail_constants(alpha2, n2)
+            dlogA_da, dlogA_dn, dB_da, dB_dn = _tail_constants_gradient(alpha2, n2)
+            D = np.where(right, B+t, 1.)
+            log_D = np.log(D)
+            log_shape = np.where(right, log_A - n2*log_D, log_shape)
+            gradient[0] = np.where(right, -n2/D, gradient[0])
+            gradient[3] = np.where(right, sign_alpha2*(dlogA_da - n2*dB_da/D), 0.)
+            gradient[4] = np.where(right, dlogA_dn - log_D - n2*dB_dn/D, 0.)
+    return (log_shape, gradient)
+
+
+def dcb_standard_integral_gradient(t_low, t_high, alpha, n, alpha2, n2):
+    """
+    Derivatives of dcb_standard_integral with respect to (alpha, n, alpha2, n2)
+    at fixed t_low, t_high. The moving boundaries between the core and the tails
+    don't contribute since the shape is continuous there.
+
+    Returns:
+    --------
+    array of shape (4,)+shape of t_low
+    """
+    t_low  = np.asarray(t_low, dtype=np.float64)
+    t_high = np.asarray(t_high, dtype=np.float64)
+    sign_alpha, sign_alpha2 = math.copysign(1., alpha), math.copysign(1., alpha2)
+    alpha, alpha2 = abs(alpha), abs(alpha2)
+    gradient = np.zeros((4,)+np.broadcast(t_low, t_high).shape)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        #left tail
+        low, high = t_low, np.minimum(t_high, -alpha)
+        in_tail = low < high
+        if np.any(in_tail):
+            d_alpha, d_n = _tail_integral_gradient(np.minimum(low, -alpha), np.minimum(high, -alpha), alpha, n)
+            gradient[0] = np.where(in_tail, sign_alpha*d_alpha, 0.)
+            gradient[1] = np.where(in_tail, d_n, 0.)
+        #right tail (mirrored left tail)
+        low, high = np.maximum(t_low, alpha2), t_high
+        in_tail = low < high
+        if np.any(in_tail):
+            d_alpha, d_n = _tail_integral_gradient(np.minimum(-high, -alpha2), np.minimum(-low, -alpha2), alpha2, n2)
+            gradient[2] = np.where(in_tail, sign_alpha2*d_alpha, 0.)
+            gradient[3] = np.where(in_tail, d_n, 0.)
+    return gradient
+
+
+class DoubleCB(object):
+    """
+    DCB p.d.f. of x normalized on the range [x_low, x_high]. The parameters are
+    given as sequence (mean, sigma, alpha, n, alpha2, n2), see DCB_PARAMETERS.
+    """
+
+    def __init__(self, x_low, x_high):
+        self.x_low = float(x_low)
+        self.x_high = float(x_high)
+
+    def shape(self, x, params):
+        """
+        Unnormalized DCB, the same values as RooDoubleCB::evaluate.
+        """
+        mean, sigma, alpha, n, alpha2, n2 = params
+        return dcb_standard_shape((np.asarray(x, dtype=np.float64)-mean)/sigma, alpha, n, alpha2, n2)
+
+    def integral(self, params, x_low=None, x_high=None):
+        """
+        Integral of the shape from x_low to x_high (default: the normalization range).
+        """
+        mean, sigma, alpha, n, alpha2, n2 = params
+        if x_low is None: x_low = self.x_low
+        if x_high is None: x_high = self.x_high
+        t_low  = (np.asarray(x_low, dtype=np.float64)-mean)/sigma
+        t_high = (np.asarray(x_high, dtype=np.float64)-mean)/sigma
+        return sigma*dcb_standard_integral(t_low, t_high, alpha, n, alpha2, n2)
+
+    def bin_integrals_gradient(self, bin_edges, params):
+        """
+        Integrals of the shape in the bins given by the edges and their analytic
+        derivatives with respect to the parameters.
+
+        Returns:
+        --------
+        (integrals, array of shape (6, number of bins) with the derivatives in the order of DCB_PARAMETERS)
+        """
+        mean, sigma, alpha, n, alpha2, n2 = params
+        t = (np.asarray(bin_edges, dtype=np.float64)-mean)/sigma
+        t_low, t_high = t[:-1], t[1:]
+        integral = dcb_standard_integral(t_low, t_high, alpha, n, alpha2, n2)
+        integral_gradient = dcb_standard_integral_gradient(t_low, t_high, alpha, n, alpha2, n2)
+        shape = dcb_standard_shape(t, alpha, n, alpha2, n2)
+        shape_low, shape_high = shape[:-1], shape[1:]
+
+        gradient = np.empty((6,)+t_low.shape)
+        gradient[0] = shape_low - shape_high
+        gradient[1] = integral - (t_high*shape_high - t_low*shape_low)
+        gradient[2:] = sigma*integral_gradient
+        return (sigma*integral, gradient)
+
+    def pdf(self, x, params):
+        return self.shape(x, params)/self.integral(params)
+
+    def log_pdf(self, x, params):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.log(self.shape(x, params)) - np.log(self.integral(params))
+
+    def cdf(self, x, params):
+        """
+        Fraction of the p.d.f. between x_low and x (x clipped to the range).
+        """
+        x = np.clip(np.asarray(x, dtype=np.float64), self.x_low, self.x_high)
+        return self.integral(params, self.x_low, x)/self.integral(params)
+
+    def quantile(self, p, params):
+        """
+        Returns x where the cdf is p (array), see dcb_standard_quantile.
+        """
+        mean, sigma, alpha, n, alpha2, n2 = params
+        t_low, t_high = (self.x_low-mean)/sigma, (self.x_high-mean)/sigma
+        return mean + sigma*dcb_standard_quantile(p, t_low, t_high, alpha, n, alpha2, n2)
+
+    def sample(self, params, size, random_state=None):
+        """
+        Draws size values of x distributed as the p.d.f. (inverse-CDF sampling).
+        random_state is numpy.random.RandomState (the global numpy generator is used if None).
+        """
+        if random_state is None:
+            random_state = np.random.mtrand._rand
+        return self.quantile(random_state.uniform(size=int(size)), params)
+
+    def nll(self, x, params, weights=None):
+        """
+        Negative log-likelihood of the (weighted) events x.
+        """
+        log_pdf = self.log_pdf(x, params)
+        if weights is None:
+            return -np.sum(log_pdf)
+        return -np.dot(weights, log_pdf)
+
+    def log_pdf_gradient(self, x, params):
+        """
+        Log of the p.d.f. and its analytic derivatives with respect to the parameters.
+
+        Returns:
+        --------
+        (log pdf, array of shape (6, len(x)) with the derivatives in the order of DCB_PARAMETERS)
+        """
+        mean, sigma, alpha, n, alpha2, n2 = params
+        t = (np.asarray(x, dtype=np.float64)-mean)/sigma
+        t_low, t_high = (self.x_low-mean)/sigma, (self.x_high-mean)/sigma
+        log_shape, shape_gradient = dcb_standard_log_shape_gradient(t, alpha, n, alpha2, n2)
+
+        integral = dcb_standard_integral(t_low, t_high, alpha, n, alpha2, n2)
+        integral_gradient = dcb_standard_integral_gradient(t_low, t_high, alpha, n, alpha2, n2)
+        shape_low, shape_high = dcb_standard_shape(np.array([t_low, t_high]), alpha, n, alpha2, n2)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            log_pdf = log_shape - np.log(sigma*integral)
+            gradient = np.empty((6,)+t.shape)
+            gradient[0] = -shape_gradient[0]/sigma + (shape_high-shape_low)/(sigma*integral)
+            gradient[1] = -t*shape_gradient[0]/sigma - 1./sigma + (t_high*shape_high-t_low*shape_low)/(sigma*integral)
+            for idx in range(4):
+                gradient[2+idx] = shape_gradient[1+idx] - integral_gradient[idx]/integral
+        return (log_pdf, gradient)
+
+    def nll_gradient(self, x, params, weights=None):
+        """
+        Negative log-likelihood of the (weighted) events x and its gradient
+        with respect to the parameters (array of 6 values).
+        """
+        log_pdf, gradient = self.log_pdf_gradient(x, params)
+        if weights is None:
+            weights = np.ones_like(log_pdf)
+        return (-np.dot(weights, log_pdf), -gradient.dot(weights))
+
+
+def check_gradient(params, x_low, x_high, x=None, n_bins=35, step=1e-6):
+    """
+    Compares the analytic derivatives of DoubleCB.log_pdf_gradient (at the values x, default 100
+    values in the range) and of DoubleCB.bin_integrals_gradient (n_bins uniform bins of the range)
+    with central finite differences, the step is relative to the parameter values.
+
+    Returns:
+    --------
+    (maximum absolute differences of the log pdf derivatives, of the bin integral derivatives),
+    arrays in the order of DCB_PARAMETERS
+    """
+    dcb = DoubleCB(x_low, x_high)
+    params = np.asarray(params, dtype=np.float64)
+    if x is None:
+        x = np.linspace(x_low, x_high, 100)
+    bin_edges = np.linspace(x_low, x_high, n_bins+1)
+    log_pdf_gradient = dcb.log_pdf_gradient(x, params)[1]
+    bin_gradient = dcb.bin_integrals_gradient(bin_edges, params)[1]
+    log_pdf_differences = np.empty(len(params))
+    bin_differences = np.empty(len(params))
+    for idx in range(len(params)):
+        h = step*max(1., abs(params[idx]))
+        params_up, params_down = params.copy(), params.copy()
+        params_up[idx]+=h
+        params_down[idx]-=h
+        numeric = (dcb.log_pdf(x, params_up) - dcb.log_pdf(x, params_down))/(2.*h)
+        log_pdf_differences[idx] = np.max(np.abs(log_pdf_gradient[idx]-numeric))
+        numeric = (dcb.integral(params_up, bin_edges[:-1], bin_edges[1:]) - dcb.integral(params_down, bin_edges[:-1], bin_edges[1:]))/(2.*h)
+        bin_differences[idx] = np.max(np.abs(bin_gradient[idx]-numeric))
+    return (log_pdf_differences, bin_differences)
+
+
+if __name__ == "__main__":
+    #the tails around n=1 (log form of the tail integral, see N_EQUAL_ONE_SHIFT) and usual values
+    failed = False
+    for n in [1.-1e-9, 1., 1.+1e-9, 1.+1e-6, 1.001, 4.5]:
+        for n2 in [1., 20.]:
+            params = (125., 1.6, 1., n, 1.4, n2)
+            log_pdf_differences, bin_differences = check_gradient(params, 105., 140.)
+            ok = max(log_pdf_differences.max(), bin_differences.max()) < 1e-5
+            failed = failed or not ok
+            print '{0:5s} n={1:.10g} n2={2:g}: max difference log pdf {3:.2e}, bin integrals {4:.2e}'.format({True:'OK', False:'FAIL'}[ok], n, n2,
+                                                                                                      log_pdf_differences.max(), bin_differences.max())
+    sys.exit(int(failed))
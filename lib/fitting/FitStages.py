@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - fit stages of the simultaneous fit declared in a config file (e.g. fit_stages.yaml):
+#      the mass points of each stage, the floating and fixed parameters and the
+#      ranges derived from the results of earlier stages
+#    - the results of the stages are carried forward in memory
+#-----------------------------------------------
+import sys, os
+import fnmatch
+import collections
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.util.UniversalConfigParser import UniversalConfigParser
+
+
+#the former built-in strategy: the 125 GeV point with frozen slopes, then all mass points
+#with the intercepts within +/- 1 sigma of the 125 GeV fit and some parameters frozen
+DEFAULT_FIT_STAGES = [
+    {'name'        : 'fit_125',
+     'mass_points' : [125],
+     'fixed'       : ['*_p1']},
+    {'name'        : 'simultaneous',
+     'mass_points' : 'all',
+     'ranges_from' : {'stage' : 'fit_125', 'parameters' : ['*_p0'], 'n_sigma' : 1},
+     'fixed'       : ['mean_p0', 'sigma_p0', 'alpha_p0', 'n2_p0', 'alpha2_p1', 'alpha_p1', 'n_p1']},
+    ]
+
+STAGE_KEYS = ['name', 'mass_points', 'float', 'fixed', 'ranges_from']
+
+
+def _match(par_name, patterns):
+    return any([fnmatch.fnmatchcase(par_name, pattern) for pattern in patterns])
+
+
+class FitStage(object):
+    """
+    One fit of the pipeline: the mass points ('all' or list of MH values), the floating
+    parameters (name patterns, default all) and the fixed parameters (name patterns, they win
+    over floating). With ranges_from {'stage' : name, 'parameters' : patterns, 'n_sigma' : n}
+    the matching parameters, floating in that earlier stage, are set to its result with
+    the range result +/- n_sigma*error.
+    """
+
+    def __init__(self, name, mass_points='all', floating=None, fixed=None, ranges_from=None):
+        self.name = name
+        if mass_points != 'all':
+            mass_points = [float(MH) for MH in mass_points]
+            if not mass_points:
+                raise ValueError, 'The fit stage {0} has no mass points.'.format(name)
+        self.mass_points = mass_points
+        self.floating = floating or ['*']
+        self.fixed = fixed or []
+        self.ranges_from = ranges_from
+        if ranges_from:
+            if not 'stage' in ranges_from:
+                raise ValueError, 'The ranges_from of the fit stage {0} has no stage.'.format(name)
+            self.ranges_from = {'stage'      : ranges_from['stage'],
+                                'parameters' : ranges_from.get('parameters', ['*']),
+                                'n_sigma'    : float(ranges_from.get('n_sigma', 1.))}
+
+    @staticmethod
+    def from_dict(stage_dict):
+        """
+        Returns FitStage from the dictionary (one entry of the stages in the config, see STAGE_KEYS).
+        """
+        unknown = [key for key in stage_dict.keys() if not key in STAGE_KEYS]
+        if unknown or not 'name' in stage_dict:
+            raise ValueError, 'Fit stage {0} needs a name and can have only the keys {1}.'.format(stage_dict, STAGE_KEYS)
+        return FitStage(stage_dict['name'], stage_dict.get('mass_points', 'all'), stage_dict.get('float'),
+                        stage_dict.get('fixed'), stage_dict.get('ranges_from'))
+
+    def get_mass_points(self, MH_values):
+        """
+        Returns the MH values of the stage out of the MH_values of the loaded mass points.
+        """
+        if self.mass_points == 'all':
+            return list(MH_values)
+        missing = [MH for MH in self.mass_points if not MH in MH_values]
+        if missing:
+            raise NameError, 'The mass points {0} of the fit stage {1} are not loaded.'.format(missing, self.name)
+        return [MH for MH in MH_values if MH in self.mass_points]
+
+    def is_floating(self, par_name):
+        return _match(par_name, self.floating) and not _match(par_name, self.fixed)
+
+    def get_setup(self, par_names, stage_results):
+        """
+        Returns OrderedDict {parameter name : (constant, value, error, (min, max))} of the stage, the value,
+        error and range are None where the parameter keeps its current ones. The stage_results are
+        {stage name : {parameter name : (value, error, floating)}} of the earlier stages.
+        Raises RuntimeError if a parameter of ranges_from has no error in that stage (fixed there or failed fit).
+        """
+        setup = collections.OrderedDict([(par_name, (not self.is_floating(par_name), None, None, None)) for par_name in par_names])
+        if not self.ranges_from:
+            return setup
+        source = self.ranges_from['stage']
+        if not source in stage_results:
+            raise ValueError, 'The fit stage {0} takes the ranges from {1}, which is not an earlier stage.'.format(self.name, source)
+        n_sigma = self.ranges_from['n_sigma']
+        for par_name in par_names:
+            if not _match(par_name, self.ranges_from['parameters']):
+                continue
+            value, error, floating = stage_results[source][par_name]
+            if not floating or not error > 0:
+                raise RuntimeError, 'Parameter {0} has no error in the fit stage {1}, the fit stage {2} cannot take its range from it.'.format(par_name, source, self.name)
+            setup[par_name] = (setup[par_name][0], value, error, (value-n_sigma*error, value+n_sigma*error))
+        return setup
+
+    def __repr__(self):
+        return 'FitStage({0}, mass_points={1}, float={2}, fixed={3}, ranges_from={4})'.format(self.name, self.mass_points,
+                                                                                              self.floating, self.fixed, self.ranges_from)
+
+
+class FitStagePipeline(object):
+    """
+    The fit stages run in order. The results {parameter name : (value, error, floating)}
+    of each stage are kept in memory for the setup of the following stages.
+    """
+
+    def __init__(self, stages):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.stages = [stage if isinstance(stage, FitStage) else FitStage.from_dict(stage) for stage in stages]
+        if not self.stages:
+            raise ValueError, 'There are no fit stages.'
+        names = [stage.name for stage in self.stages]
+        if len(set(names)) != len(names):
+            raise ValueError, 'The names of the fit stages {0} are not unique.'.format(names)
+        for idx, stage in enumerate(self.stages):
+            if stage.ranges_from and not stage.ranges_from['stage'] in names[:idx]:
+                raise ValueError, 'The fit stage {0} takes the ranges from {1}, which is not an earlier stage.'.format(stage.name, stage.ranges_from['stage'])
+        self.results = collections.OrderedDict()
+
+    @staticmethod
+    def from_file(file_name):
+        """
+        Returns FitStagePipeline of the list 'stages' in the config file (e.g. YAML, see fit_stages.yaml).
+        """
+        cfg_dict = UniversalConfigParser(file_list=file_name).get_dict()
+        if not 'stages' in cfg_dict:
+            raise ValueError, 'There are no fit stages in {0}.'.format(file_name)
+        return FitStagePipeline(cfg_dict['stages'])
+
+    def is_final(self, stage):
+        return stage is self.stages[-1]
+
+    def run(self, fit_function, par_names, MH_values, n_stages=None):
+        """
+        Runs the first n_stages stages (default all): for each stage calls fit_function(stage, setup, stage MH values)
+        with the setup of FitStage.get_setup, which has to apply the setup, fit and return the result
+        {parameter name : (value, error, floating)}. Returns OrderedDict {stage name : result}.
+        """
+        self.results = collections.OrderedDict()
+        for stage in self.stages[:n_stages]:
+            setup = self.get_setup(stage, par_names)
+            self.log.info('Fit stage {0}: mass points {1}, floating parameters {2}.'.format(stage.name, stage.get_mass_points(MH_values),
+                                                                                      [par_name for par_name, par_setup in setup.iteritems() if not par_setup[0]]))
+            self.results[stage.name] = fit_function(stage, setup, stage.get_mass_points(MH_values))
+        return self.results
+
+    def get_setup(self, stage, par_names):
+        return stage.get_setup(par_names, self.results)
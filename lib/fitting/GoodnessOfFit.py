@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - chi-square/ndof of the DCB and the (weighted) events of a category, from
+#      the histogram of the events and the integrals of the p.d.f. in the bins
+#    - no RooPlot needed; the histograms are filled once per category and the
+#      chi-square is computed once per category and set of DCB parameters
+#-----------------------------------------------
+import sys, os
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.fitting.DoubleCB import DoubleCB
+from lib.fitting.ParametrizationFit import MassPoint
+
+
+def binned_chi_square(counts, sumw2, expected, n_fit_params=0):
+    """
+    Chi-square of the expected and the observed (weighted) bin contents with the errors
+    sqrt(sum of squared weights). The bins without events are skipped, as in RooPlot::chiSquare.
+    Returns (chi-square, ndof = number of used bins - n_fit_params).
+    """
+    used = sumw2 > 0
+    chi2 = np.sum((counts[used]-expected[used])**2/sumw2[used])
+    return (float(chi2), int(used.sum())-n_fit_params)
+
+
+class ChiSquare(object):
+    """
+    Chi-square and the number of degrees of freedom.
+    """
+
+    def __init__(self, chi2, ndof):
+        self.chi2 = chi2
+        self.ndof = ndof
+
+    def per_ndof(self):
+        if self.ndof <= 0:
+            return float('nan')
+        return self.chi2/self.ndof
+
+    def __repr__(self):
+        return 'ChiSquare(chi2={0:.4g}, ndof={1}, chi2/ndof={2:.4g})'.format(self.chi2, self.ndof, self.per_ndof())
+
+
+class ChiSquareCalculator(object):
+    """
+    Chi-square of the DCB (parameters mean, sigma, alpha, n, alpha2, n2) and the events
+    of the categories (e.g. the mass points), in n_bins bins between x_low and x_high.
+    The events of a category are given once (set_data) and only their histogram is kept.
+    The results are memoized by the category and the DCB parameters.
+    """
+
+    def __init__(self, x_low, x_high, n_bins):
+        self.bin_edges = np.linspace(x_low, x_high, n_bins+1)
+        self.dcb = DoubleCB(x_low, x_high)
+        self._histograms = {}  #{category : (counts, sumw2)}
+        self._results = {}  #{(category, DCB parameters, n_fit_params, normalization) : ChiSquare}
+
+    def has_data(self, category):
+        return category in self._histograms
+
+    def set_data(self, category, x, weights=None):
+        """
+        Fills the histogram of the events x (and weights) of the category.
+        """
+        self._histograms[category] = MassPoint(0, x, weights).histogram(self.bin_edges)
+        for key in [key for key in self._results if key[0] == category]:
+            del self._results[key]
+
+    def get_expected(self, params, normalization):
+        """
+        Expected bin contents of the DCB normalized to the normalization in [x_low, x_high].
+        """
+        integrals = self.dcb.integral(params, self.bin_edges[:-1], self.bin_edges[1:])
+        return normalization*integrals/self.dcb.integral(params)
+
+    def get(self, category, params, n_fit_params=0, normalization=None):
+        """
+        Returns ChiSquare of the category for the DCB parameters. The DCB is normalized to the
+        sum of weights of the events in the range unless normalization (e.g. a fitted yield) is given.
+        """
+        params = tuple([float(par) for par in params])
+        key = (category, params, n_fit_params, normalization)
+        if not key in self._results:
+            counts, sumw2 = self._histograms[category]
+            if normalization is None:
+                normalization = counts.sum()
+            self._results[key] = ChiSquare(*binned_chi_square(counts, sumw2, self.get_expected(params, normalization), n_fit_params))
+        return self._results[key]
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - multi-start minimization: the fit is repeated from several starting points
+#      (latin hypercube or jittered around the nominal start) in worker processes
+#      and the converged result with the lowest NLL is kept
+#    - summary of the spread of the minima found
+#-----------------------------------------------
+import sys, os
+import copy
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.util.ProcessPool import parallel_map
+from lib.fitting.ParametrizationFit import ParametrizationFitter
+
+
+MULTI_START_METHODS = ['lhs', 'jitter']
+JITTER = 0.1  #standard deviation of the jitter as fraction of the parameter range
+SPREAD = 0.25  #half width of the latin hypercube around the nominal start as fraction of the parameter range
+MAX_START_SHIFTS = 5  #times a start point is moved halfway to the nominal one if the NLL cannot be evaluated there
+
+
+def get_start_points(ranges, n_starts, method='lhs', random_state=None, nominal=None, jitter=JITTER, spread=SPREAD):
+    """
+    Returns list of n_starts starting points OrderedDict {name : value} of the floating parameters
+    with ranges OrderedDict {name : (min, max)}. The first point is the nominal one (if given).
+    The others are a latin hypercube sample ('lhs') of the box nominal +/- spread*(max-min) within
+    the ranges (of the whole ranges without nominal), or the nominal values with gaussian jitter
+    of jitter*(max-min), clipped to the ranges ('jitter').
+    """
+    if not method in MULTI_START_METHODS:
+        raise ValueError, 'Unknown multi-start method {0}. Use one of {1}.'.format(method, MULTI_START_METHODS)
+    if random_state is None:
+        random_state = np.random.RandomState()
+    names = ranges.keys()
+    low = np.array([ranges[name][0] for name in names], dtype=np.float64)
+    high = np.array([ranges[name][1] for name in names], dtype=np.float64)
+    n_random = n_starts - int(nominal is not None)
+
+    if method == 'lhs':
+        if nominal is not None:
+            center = np.array([nominal[name] for name in names], dtype=np.float64)
+            low, high = np.maximum(low, center-spread*(high-low)), np.minimum(high, center+spread*(high-low))
+        #one point in each of the n_random strata of each parameter, strata paired at random
+        strata = np.array([random_state.permutation(n_random) for name in names]).T
+        fractions = (strata + random_state.uniform(size=strata.shape))/max(n_random, 1)
+        points = low + fractions*(high-low)
+    else:
+        if nominal is None:
+            raise ValueError, 'The jitter multi-start method needs the nominal starting point.'
+        center = np.array([nominal[name] for name in names], dtype=np.float64)
+        points = np.clip(center + jitter*(high-low)*random_state.normal(size=(n_random, len(names))), low, high)
+
+    start_points = []
+    if nominal is not None:
+        start_points.append(collections.OrderedDict([(name, nominal[name]) for name in names]))
+    for point in points:
+        start_points.append(collections.OrderedDict(zip(names, point)))
+    return start_points
+
+
+class MultiStartSummary(object):
+    """
+    The minima found from the starting points: NLL, convergence flag and the
+    parameter values {name : value} of each start (NLL None if the fit failed).
+    The minima closer than tolerance in NLL are counted as one.
+    """
+
+    def __init__(self, nlls, converged, values, tolerance=1e-2):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.nlls = nlls
+        self.converged = converged
+        self.values = values
+        self.tolerance = tolerance
+
+    def get_converged(self):
+        return [idx for idx, nll in enumerate(self.nlls) if nll is not None and self.converged[idx]]
+
+    def best_index(self):
+        """
+        Index of the converged start with the lowest NLL (of any start if none converged, None if all failed).
+        """
+        candidates = self.get_converged() or [idx for idx, nll in enumerate(self.nlls) if nll is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda idx: self.nlls[idx])
+
+    def get_distinct_minima(self):
+        """
+        Returns the sorted NLL values of the distinct converged minima.
+        """
+        minima = []
+        for nll in sorted([self.nlls[idx] for idx in self.get_converged()]):
+            if not minima or nll-minima[-1] > self.tolerance:
+                minima.append(nll)
+        return minima
+
+    def print_summary(self):
+        best = self.best_index()
+        converged = self.get_converged()
+        if best is None:
+            self.log.error('All {0} fits of the multi-start failed.'.format(len(self.nlls)))
+            return
+        best_nll = self.nlls[best]
+        minima = self.get_distinct_minima()
+        self.log.info('Multi-start: {0} starts, {1} converged, {2} distinct minima, best NLL = {3} (start {4}).'.format(len(self.nlls),
+                                                                                    len(converged), len(minima), best_nll, best))
+        for idx, nll in enumerate(self.nlls):
+            if nll is None:
+                print '    start {0:3d}: failed'.format(idx)
+            else:
+                print '    start {0:3d}: NLL - NLL_best = {1:12.4f} {2}'.format(idx, nll-best_nll, {True:'', False:'(not converged)'}[self.converged[idx]])
+        if len(converged) > 1:
+            print '    spread of the converged minima: max NLL - NLL_best = {0:.4f}'.format(max([self.nlls[idx] for idx in converged])-best_nll)
+            for name in self.values[best].keys():
+                par_values = [self.values[idx][name] for idx in converged]
+                print '    {0:12s} best = {1: .6g}, min = {2: .6g}, max = {3: .6g}'.format(name, self.values[best][name], min(par_values), max(par_values))
+
+
+def fit_from_start(parameters, nll, start_values, sumw2_error=True):
+    """
+    Fits the parameters (a copy, OrderedDict {name : FitParameter}) to the NLL from the start values
+    {name : value}. If the NLL cannot be evaluated at the start, it is moved halfway to the current
+    values of the parameters (at most MAX_START_SHIFTS times). Returns the FitResult or None if the fit failed.
+    """
+    parameters = copy.deepcopy(parameters)
+    nominal = dict([(name, parameters[name].value) for name in start_values.keys()])
+    start_values = dict(start_values)
+    for n_shifts in range(MAX_START_SHIFTS+1):
+        for name, value in start_values.iteritems():
+            parameters[name].value = value
+        try:
+            return ParametrizationFitter(parameters).fit(nll, sumw2_error)
+        except ValueError, error:
+            start_values = dict([(name, 0.5*(value+nominal[name])) for name, value in start_values.iteritems()])
+        except (FloatingPointError, np.linalg.LinAlgError), error:
+            #e.g. singular covariance at the minimum, another start does not help
+            break
+    Logger().getLogger('fit_from_start', 10).warning('Fit failed: {0}'.format(error))
+    return None
+
+
+#set by multi_start_fit before the worker processes are started, so that the NLL
+#(with the events) is inherited by the workers and not sent with each task
+_multi_start_setup = {}
+
+
+def fit_setup_start(start_values):
+    """
+    Multi-start worker: fit_from_start with the parameters and the NLL of the _multi_start_setup.
+    """
+    setup = _multi_start_setup
+    return fit_from_start(setup['parameters'], setup['nll'], start_values, setup['sumw2_error'])
+
+
+def multi_start_fit(parameters, nll, n_starts, method='lhs', random_state=None, n_workers=1, sumw2_error=True):
+    """
+    Fits the parameters (OrderedDict {name : FitParameter}, numpy engine) from n_starts starting
+    points (see get_start_points, the first is the current values) with n_workers processes.
+    The values and errors of the best converged fit are set to the parameters.
+    Returns (FitResult, MultiStartSummary).
+    """
+    ranges = collections.OrderedDict([(name, (par.min, par.max)) for name, par in parameters.iteritems() if not par.constant])
+    nominal = dict([(name, par.value) for name, par in parameters.iteritems()])
+    start_points = get_start_points(ranges, n_starts, method, random_state, nominal)
+    _multi_start_setup.clear()
+    _multi_start_setup.update({'parameters' : parameters, 'nll' : nll, 'sumw2_error' : sumw2_error})
+    try:
+        results = parallel_map(fit_setup_start, [(start_values,) for start_values in start_points], n_workers)
+    finally:
+        _multi_start_setup.clear()
+
+    summary = MultiStartSummary([result.nll if result else None for result in results],
+                                [bool(result and result.status == 0) for result in results],
+                                [collections.OrderedDict([(name, result.parameters[name].value) for name in result.floating]) if result else None
+                                 for result in results])
+    summary.print_summary()
+    best = summary.best_index()
+    if best is None:
+        raise RuntimeError, 'All {0} fits of the multi-start failed.'.format(n_starts)
+    best_result = results[best]
+    for name, par in best_result.parameters.iteritems():
+        parameters[name].value = par.value
+        parameters[name].error = par.error
+    best_result.parameters = parameters
+    return (best_result, summary)
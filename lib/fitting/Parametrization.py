@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - DCB parameters as functions of MH given by RooFormulaVar-like formula
+#      strings of @0 (=MH), as in DCB_parametrization.yaml and legacy_DCB_parametrization.yaml
+#    - the formulas are compiled once (FormulaCompiler) and evaluated with numpy
+#      on whole arrays of MH values and parameter sets
+#-----------------------------------------------
+import sys, os
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.FormulaCompiler import FormulaCompiler, FormulaEvaluator
+from lib.fitting.DoubleCB import DCB_PARAMETERS
+
+
+_compiler = FormulaCompiler()  #one compiler per process, each formula is parsed only once
+
+
+def compile_formula(formula):
+    """
+    Returns the CompiledFormula of the formula string (cached).
+    """
+    return _compiler.compile(str(formula))
+
+
+def evaluate_formulas(formulas, refs):
+    """
+    Evaluates the formulas with the references @0, @1, ... taken from the list refs
+    (numbers or numpy arrays of broadcastable shapes, e.g. MH[:,np.newaxis] and parameter
+    sets along the second axis). Subexpressions shared by the formulas are computed once.
+    Returns list of numpy arrays with the broadcast shape of the refs.
+    """
+    refs = [np.asarray(ref, dtype=np.float64) for ref in refs]
+    shape = np.broadcast(*refs).shape if len(refs)>1 else refs[0].shape
+    evaluator = FormulaEvaluator({}, refs)
+    return [np.broadcast_to(compile_formula(formula)(evaluator=evaluator), shape).astype(np.float64) for formula in formulas]
+
+
+class CompiledParametrization(object):
+    """
+    The DCB parameters (mean, sigma, alpha, n, alpha2, n2) as compiled formulas of MH (@0).
+    The formulas are taken from the dictionary {DCB parameter : formula string}, e.g. the
+    dictionary of a channel from the parametrization YAML file (other keys are ignored).
+    """
+
+    def __init__(self, formulas):
+        self.formulas = collections.OrderedDict([(dcb_par, str(formulas[dcb_par])) for dcb_par in DCB_PARAMETERS])
+        for formula in self.formulas.values():
+            compile_formula(formula)
+
+    def evaluate(self, MH, *parameters):
+        """
+        Returns OrderedDict {DCB parameter : numpy array} for the MH value(s). The formulas
+        can use more references (@1, @2, ...) given as parameters (values or arrays).
+        """
+        values = evaluate_formulas(self.formulas.values(), [MH]+list(parameters))
+        return collections.OrderedDict(zip(self.formulas.keys(), values))
+
+    def get_dcb_params(self, MH, *parameters):
+        """
+        Returns tuple of the DCB parameters (floats) for one MH value.
+        """
+        return tuple([float(values) for values in self.evaluate(float(MH), *parameters).values()])
+
+    def __repr__(self):
+        return 'CompiledParametrization({0})'.format(dict(self.formulas))
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - simultaneous fit of the DCB shapes of several mass points with the DCB
+#      parameters linear in MH: par = par_p0 + par_p1*(MH-125)
+#    - numpy/scipy engine, no RooFit or CMSSW libraries needed
+#-----------------------------------------------
+import sys, os
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.fitting.DoubleCB import DoubleCB, DCB_PARAMETERS
+
+
+EXPANSION_POINT = 125.  #the parametrization is an expansion around mH=125
+BAD_NLL = 1e30  #returned instead of nan/inf, e.g. for negative n
+BINNED_LIKELIHOODS = ['poisson', 'chi2']
+
+
+def get_parametrization_names():
+    """
+    Returns the names of the parameters of the linear parametrization
+    in the order used for the parameter vectors: mean_p0, mean_p1, sigma_p0, ...
+    """
+    names = []
+    for dcb_par in DCB_PARAMETERS:
+        names+=[dcb_par+'_p0', dcb_par+'_p1']
+    return names
+
+
+def get_dcb_params(values, MH):
+    """
+    Returns the DCB parameters (mean, sigma, alpha, n, alpha2, n2) at MH for
+    the vector of parametrization values (see get_parametrization_names).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return tuple(values[0::2] + values[1::2]*(MH-EXPANSION_POINT))
+
+
+class MassPoint(object):
+    """
+    Events (and weights) of the sample with Higgs mass MH.
+    """
+
+    def __init__(self, MH, x, weights=None):
+        self.MH = float(MH)
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        if weights is None:
+            weights = np.ones_like(self.x)
+        self.weights = np.ascontiguousarray(weights, dtype=np.float64)
+
+    def sum_weights(self):
+        return self.weights.sum()
+
+    def histogram(self, bin_edges):
+        """
+        Returns (sum of weights, sum of squared weights) of the events in the bins.
+        """
+        counts = np.histogram(self.x, bins=bin_edges, weights=self.weights)[0]
+        sumw2 = np.histogram(self.x, bins=bin_edges, weights=self.weights**2)[0]
+        return (counts, sumw2)
+
+
+class SimultaneousDCBNLL(object):
+    """
+    Weighted negative log-likelihood of all the mass points for the vector of
+    parametrization values. Each mass point has the DCB normalized on [x_low, x_high].
+    """
+
+    def __init__(self, mass_points, x_low, x_high, squared_weights=False):
+        self.mass_points = mass_points
+        self.x_low = x_low
+        self.x_high = x_high
+        self.squared_weights = squared_weights
+        self.dcb = DoubleCB(x_low, x_high)
+        self.n_calls = 0
+
+    def get_squared_weights_nll(self):
+        """
+        The same NLL with squared weights (used for the SumW2 error correction).
+        """
+        return self.__class__(self.mass_points, self.x_low, self.x_high, squared_weights=True)
+
+    def sum_weights(self):
+        return sum([mass_point.sum_weights() for mass_point in self.mass_points])
+
+    def _weights(self, mass_point):
+        if self.squared_weights:
+            return mass_point.weights**2
+        return mass_point.weights
+
+    def __call__(self, values):
+        self.n_calls+=1
+        nll = 0.
+        for mass_point in self.mass_points:
+            nll+=self.dcb.nll(mass_point.x, get_dcb_params(values, mass_point.MH), self._weights(mass_point))
+        if not np.isfinite(nll):
+            return BAD_NLL
+        return nll
+
+    def value_and_gradient(self, values):
+        """
+        Returns the NLL and its analytic gradient with respect to the parametrization
+        values: the DCB derivatives of each mass point are chained through
+        par = par_p0 + par_p1*(MH-125).
+        """
+        self.n_calls+=1
+        nll = 0.
+        gradient = np.zeros(2*len(DCB_PARAMETERS))
+        for mass_point in self.mass_points:
+            nll_mass_point, dcb_gradient = self.dcb.nll_gradient(mass_point.x, get_dcb_params(values, mass_point.MH), self._weights(mass_point))
+            nll+=nll_mass_point
+            gradient[0::2]+=dcb_gradient
+            gradient[1::2]+=dcb_gradient*(mass_point.MH-EXPANSION_POINT)
+        if not (np.isfinite(nll) and np.all(np.isfinite(gradient))):
+            return (BAD_NLL, np.zeros_like(gradient))
+        return (nll, gradient)
+
+
+class BinnedSimultaneousDCBNLL(object):
+    """
+    Binned version of SimultaneousDCBNLL: each mass point is histogrammed once in
+    n_bins equal bins on [x_low, x_high] and the cost of the NLL depends only on the
+    number of bins. The likelihood is either
+        - 'poisson': multinomial NLL -sum(n_i*log(p_i)) of the (weighted) bin contents,
+          the binned limit of the unbinned weighted NLL
+        - 'chi2': weighted chi2/2 = sum((n_i-N*p_i)^2/sumw2_i)/2 over the non-empty bins,
+          the errors are then already those of the weighted events
+    where p_i is the DCB probability of the bin i (closed-form bin integrals).
+    """
+
+    def __init__(self, mass_points, x_low, x_high, n_bins, likelihood='poisson', squared_weights=False):
+        if not likelihood in BINNED_LIKELIHOODS:
+            raise ValueError, 'Unknown binned likelihood {0}. Use one of {1}.'.format(likelihood, BINNED_LIKELIHOODS)
+        self.mass_points = mass_points
+        self.x_low = x_low
+        self.x_high = x_high
+        self.n_bins = int(n_bins)
+        self.likelihood = likelihood
+        self.squared_weights = squared_weights
+        self.dcb = DoubleCB(x_low, x_high)
+        self.bin_edges = np.linspace(x_low, x_high, self.n_bins+1)
+        self.histograms = [mass_point.histogram(self.bin_edges) for mass_point in mass_points]
+        self.n_calls = 0
+
+    def get_squared_weights_nll(self):
+        """
+        The same NLL with squared weights (used for the SumW2 error correction).
+        """
+        return self.__class__(self.mass_points, self.x_low, self.x_high, self.n_bins, self.likelihood, squared_weights=True)
+
+    def sum_weights(self):
+        return sum([counts.sum() for counts, sumw2 in self.histograms])
+
+    def _mass_point_nll_gradient(self, counts, sumw2, params):
+        """
+        NLL of one histogram and its gradient with respect to the DCB parameters.
+        """
+        integrals, integrals_gradient = self.dcb.bin_integrals_gradient(self.bin_edges, params)
+        total = integrals.sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            probabilities = integrals/total
+            #d log(p_i) = d I_i/I_i - d I/I
+            log_p_gradient = integrals_gradient/integrals - (integrals_gradient.sum(axis=1)/total)[:,np.newaxis]
+            if self.likelihood == 'poisson':
+                if self.squared_weights: counts = sumw2
+                filled = counts != 0
+                nll = -np.dot(counts[filled], np.log(probabilities[filled]))
+                gradient = -log_p_gradient[:,filled].dot(counts[filled])
+            else:
+                filled = sumw2 > 0
+                n_total = counts.sum()
+                residuals = (counts[filled] - n_total*probabilities[filled])/sumw2[filled]
+                nll = 0.5*np.dot(residuals, counts[filled] - n_total*probabilities[filled])
+                gradient = -n_total*(log_p_gradient[:,filled]*probabilities[filled]).dot(residuals)
+        return (nll, gradient)
+
+    def value_and_gradient(self, values):
+        """
+        Returns the NLL and its analytic gradient with respect to the parametrization values.
+        """
+        self.n_calls+=1
+        nll = 0.
+        gradient = np.zeros(2*len(DCB_PARAMETERS))
+        for mass_point, (counts, sumw2) in zip(self.mass_points, self.histograms):
+            nll_mass_point, dcb_gradient = self._mass_point_nll_gradient(counts, sumw2, get_dcb_params(values, mass_point.MH))
+            nll+=nll_mass_point
+            gradient[0::2]+=dcb_gradient
+            gradient[1::2]+=dcb_gradient*(mass_point.MH-EXPANSION_POINT)
+        if not (np.isfinite(nll) and np.all(np.isfinite(gradient))):
+            return (BAD_NLL, np.zeros_like(gradient))
+        return (nll, gradient)
+
+    def __call__(self, values):
+        return self.value_and_gradient(values)[0]
+
+
+class FitParameter(object):
+    """
+    Parameter of the fit with the value, range, error and the constant flag (like RooRealVar).
+    """
+
+    def __init__(self, name, value, min_value, max_value, constant=False):
+        self.name = name
+        self.value = float(value)
+        self.min = float(min_value)
+        self.max = float(max_value)
+        self.error = 0.
+        self.constant = constant
+
+    def setRange(self, min_value, max_value):
+        self.min, self.max = float(min_value), float(max_value)
+        self.value = min(max(self.value, self.min), self.max)
+
+    def __repr__(self):
+        return 'FitParameter({0}={1} +/- {2}, [{3}, {4}]{5})'.format(self.name, self.value, self.error, self.min, self.max, {True:', constant', False:''}[self.constant])
+
+
+class FitResult(object):
+    """
+    Result of ParametrizationFitter.fit.
+    """
+
+    def __init__(self, parameters, floating, nll, status, message, n_calls, covariance=None):
+        self.parameters = parameters
+        self.floating = floating
+        self.nll = nll
+        self.status = status
+        self.message = message
+        self.n_calls = n_calls
+        self.covariance = covariance
+
+    def values(self):
+        return collections.OrderedDict([(name, par.value) for name, par in self.parameters.iteritems()])
+
+    def errors(self):
+        return collections.OrderedDict([(name, par.error) for name, par in self.parameters.iteritems()])
+
+    def to_dict(self):
+        """
+        Returns json serializable dictionary of the result (see from_dict).
+        """
+        covariance = None
+        if self.covariance is not None:
+            covariance = np.asarray(self.covariance).tolist()
+        return {'parameters' : [(par.name, par.value, par.error, par.min, par.max, par.constant) for par in self.parameters.values()],
+                'floating' : list(self.floating), 'nll' : self.nll, 'status' : self.status,
+                'message' : self.message, 'n_calls' : self.n_calls, 'covariance' : covariance}
+
+    @staticmethod
+    def from_dict(result_dict, parameters=None):
+        """
+        Returns FitResult from the dictionary of to_dict. If parameters (OrderedDict {name : FitParameter})
+        are given, the stored values and errors are set to them and they are used in the result.
+        """
+        if parameters is None:
+            parameters = collections.OrderedDict()
+        for name, value, error, min_value, max_value, constant in result_dict['parameters']:
+            if not name in parameters:
+                parameters[name] = FitParameter(name, value, min_value, max_value, constant)
+            parameters[name].value = value
+            parameters[name].error = error
+        covariance = result_dict['covariance']
+        if covariance is not None:
+            covariance = np.array(covariance, dtype=np.float64)
+        return FitResult(parameters, list(result_dict['floating']), result_dict['nll'], result_dict['status'],
+                         result_dict['message'], result_dict['n_calls'], covariance)
+
+    def Print(self):
+        print 'FitResult: status={0} ({1}), NLL={2}, NLL calls={3}'.format(self.status, self.message, self.nll, self.n_calls)
+        for name, par in self.parameters.iteritems():
+            print '    {0:12s} = {1: .6g} +/- {2:.3g} {3}'.format(name, par.value, par.error, {True:'(floating)', False:'(constant)'}[name in self.floating])
+
+
+class ParametrizationFitter(object):
+    """
+    Minimizes the NLL (function of the vector of all parameter values) with respect
+    to the floating parameters within their ranges, using scipy.optimize (L-BFGS-B).
+    If the NLL provides value_and_gradient, the analytic gradient is passed to the
+    minimizer and the Hessian is computed from differences of the gradient.
+    The errors are taken from the inverse of the Hessian; with sumw2_error
+    they are corrected for the event weights as with RooFit.SumW2Error.
+    """
+
+    def __init__(self, parameters):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.parameters = parameters  #OrderedDict {name : FitParameter}, the order of the NLL parameter vector
+
+    def get_values(self):
+        return np.array([par.value for par in self.parameters.values()])
+
+    def get_floating(self):
+        return [name for name, par in self.parameters.iteritems() if not par.constant]
+
+    def _full_values(self, floating_values, floating_idx):
+        values = self.get_values()
+        values[floating_idx] = floating_values
+        return values
+
+    def fit(self, nll, sumw2_error=True):
+        try:
+            from scipy.optimize import minimize
+        except ImportError:
+            raise ImportError, 'The numpy fit engine needs scipy (scipy.optimize).'
+
+        names = self.parameters.keys()
+        floating = self.get_floating()
+        floating_idx = np.array([names.index(name) for name in floating], dtype=int)
+        x0 = self.get_values()[floating_idx]
+        bounds = [(self.parameters[name].min, self.parameters[name].max) for name in floating]
+        self.log.info('Minimizing NLL with {0} floating parameters: {1}'.format(len(floating), floating))
+
+        #the minimizer works with the NLL per (weighted) event relative to the starting point,
+        #so that the first step of the line search has a sensible size
+        nll_start = nll(self.get_values())
+        if nll_start >= BAD_NLL:
+            raise ValueError, 'The NLL cannot be evaluated at the starting point {0}'.format(self.parameters.values())
+        scale = 1./max(getattr(nll, 'sum_weights', lambda : 1.)(), 1.)
+        objective = lambda x: nll(self._full_values(x, floating_idx))
+        if hasattr(nll, 'value_and_gradient'):
+            gradient = self._get_gradient_function(nll, floating_idx)
+            def scaled_objective(x):
+                value, grad = nll.value_and_gradient(self._full_values(x, floating_idx))
+                return ((value-nll_start)*scale, grad[floating_idx]*scale)
+            result = minimize(scaled_objective, x0, jac=True, method='L-BFGS-B', bounds=bounds, options={'maxiter':10000, 'ftol':1e-13, 'gtol':1e-8})
+        else:
+            gradient = None
+            scaled_objective = lambda x: (objective(x)-nll_start)*scale
+            result = minimize(scaled_objective, x0, method='L-BFGS-B', bounds=bounds, options={'maxiter':10000, 'ftol':1e-13, 'gtol':1e-8})
+
+        for name, value in zip(floating, result.x):
+            self.parameters[name].value = value
+
+        covariance = self.get_covariance(objective, result.x, nll, floating_idx, sumw2_error, gradient, bounds)
+        for idx, name in enumerate(floating):
+            self.parameters[name].error = np.sqrt(covariance[idx, idx]) if covariance[idx, idx]>0 else 0.
+
+        fit_result = FitResult(self.parameters, floating, float(result.fun)/scale+nll_start, int(result.status), str(result.message), nll.n_calls, covariance)
+        self.log.info('Minimization done: status={0} ({1}), NLL={2}, NLL calls={3}'.format(fit_result.status, fit_result.message, fit_result.nll, fit_result.n_calls))
+        return fit_result
+
+    def _get_gradient_function(self, nll, floating_idx):
+        """
+        Returns function of the floating values giving the gradient of the NLL with respect to them.
+        """
+        return lambda x: nll.value_and_gradient(self._full_values(x, floating_idx))[1][floating_idx]
+
+    def get_covariance(self, objective, x, nll, floating_idx, sumw2_error, gradient=None, bounds=None):
+        """
+        Covariance matrix V = H^-1 or, with sumw2_error, V = H^-1 H2 H^-1 where H2
+        is the Hessian of the NLL with squared weights. If the gradient function
+        is given, the Hessian is computed from the gradient. The finite differences
+        stay within the bounds [(min, max)] of the floating parameters.
+        """
+        if gradient is None:
+            hessian = get_numeric_hessian(objective, x, bounds=bounds)
+        else:
+            hessian = get_hessian_from_gradient(gradient, x, bounds=bounds)
+        try:
+            covariance = np.linalg.inv(hessian)
+        except np.linalg.LinAlgError:
+            self.log.warning('The Hessian is singular, the errors are not available.')
+            return np.zeros_like(hessian)
+        if sumw2_error and hasattr(nll, 'get_squared_weights_nll'):
+            nll_w2 = nll.get_squared_weights_nll()
+            if gradient is None:
+                hessian_w2 = get_numeric_hessian(lambda x: nll_w2(self._full_values(x, floating_idx)), x, bounds=bounds)
+            else:
+                hessian_w2 = get_hessian_from_gradient(self._get_gradient_function(nll_w2, floating_idx), x, bounds=bounds)
+            covariance = covariance.dot(hessian_w2).dot(covariance)
+        return covariance
+
+
+def _get_steps(x, relative_step, bounds):
+    """
+    Returns the finite difference steps for x, at most half of the width of the bounds [(min, max)] (if given).
+    """
+    steps = relative_step*np.maximum(np.abs(x), 1.)
+    if bounds is not None:
+        steps = np.minimum(steps, 0.5*np.array([high-low for low, high in bounds], dtype=np.float64))
+    return steps
+
+
+def get_numeric_hessian(function, x, relative_step=1e-4, bounds=None):
+    """
+    Hessian of the function at x from central finite differences. With the bounds [(min, max)]
+    the differences are centered at x moved inside the bounds by one step, where x is closer
+    to a limit (the function is not defined outside of the ranges).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    steps = _get_steps(x, relative_step, bounds)
+    if bounds is not None:
+        x = np.clip(x, np.array([low for low, high in bounds])+steps, np.array([high for low, high in bounds])-steps)
+    hessian = np.zeros((n, n))
+    f0 = function(x)
+    for i in range(n):
+        ei = np.zeros(n)
+        ei[i] = steps[i]
+        hessian[i, i] = (function(x+ei) - 2*f0 + function(x-ei))/steps[i]**2
+        for j in range(i+1, n):
+            ej = np.zeros(n)
+            ej[j] = steps[j]
+            hessian[i, j] = (function(x+ei+ej) - function(x+ei-ej) - function(x-ei+ej) + function(x-ei-ej))/(4*steps[i]*steps[j])
+            hessian[j, i] = hessian[i, j]
+    return hessian
+
+
+def get_hessian_from_gradient(gradient, x, relative_step=1e-5, bounds=None):
+    """
+    Hessian from central differences of the (analytic) gradient, symmetrized. With the bounds
+    [(min, max)] the difference is one-sided where x +/- step would leave them.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    steps = _get_steps(x, relative_step, bounds)
+    hessian = np.zeros((n, n))
+    gradient_x = None
+    for i in range(n):
+        upper, lower = x[i]+steps[i], x[i]-steps[i]
+        if bounds is not None:
+            if upper > bounds[i][1]: upper = x[i]
+            if lower < bounds[i][0]: lower = x[i]
+        values = []
+        for value in [upper, lower]:
+            if value == x[i]:
+                if gradient_x is None:
+                    gradient_x = gradient(x)
+                values.append(gradient_x)
+            else:
+                shifted = x.copy()
+                shifted[i] = value
+                values.append(gradient(shifted))
+        hessian[i] = (values[0] - values[1])/(upper-lower)
+    return 0.5*(hessian+hessian.T)
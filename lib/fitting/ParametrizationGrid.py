@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - evaluate the DCB parametrizations of all channels of a parametrization file
+#      (e.g. DCB_parametrization.yaml) on a grid of MH values at once
+#    - tables of the DCB parameters (channel x MH) and grids of the normalized
+#      DCB shape (channel x MH x m4l), e.g. as input for combine
+#-----------------------------------------------
+import sys, os
+import optparse
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.util.UniversalConfigParser import UniversalConfigParser
+from lib.fitting.DoubleCB import DoubleCB, DCB_PARAMETERS
+from lib.fitting.Parametrization import CompiledParametrization
+
+
+def read_parametrizations(file_name, channels=None):
+    """
+    Returns OrderedDict {channel : CompiledParametrization} of the parametrization file (read with
+    UniversalConfigParser). The entries without all the DCB parameters (e.g. the common setup) are skipped.
+    """
+    cfg_dict = UniversalConfigParser(file_list=file_name).get_dict()
+    parametrizations = collections.OrderedDict()
+    for channel in sorted(cfg_dict.keys()):
+        if channels and not channel in channels:
+            continue
+        if not isinstance(cfg_dict[channel], dict) or not all([dcb_par in cfg_dict[channel] for dcb_par in DCB_PARAMETERS]):
+            continue
+        parametrizations[channel] = CompiledParametrization(cfg_dict[channel])
+    return parametrizations
+
+
+def parse_grid(grid):
+    """
+    Returns numpy array of the values given as 'start:stop:step' (stop included) or comma separated list.
+    """
+    if ':' in grid:
+        start, stop, step = [float(value) for value in grid.split(':')]
+        return start + step*np.arange(int(round((stop-start)/step))+1)
+    return np.array([float(value) for value in grid.split(',')])
+
+
+class ParametrizationGrid(object):
+    """
+    The parametrizations of the channels in a parametrization file (see read_parametrizations)
+    evaluated on arrays of MH values: each formula is compiled once and evaluated for all
+    MH values in one call.
+    """
+
+    def __init__(self, file_name, channels=None):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.file_name = file_name
+        self.parametrizations = read_parametrizations(file_name, channels)
+        if not self.parametrizations:
+            raise ValueError, 'There are no DCB parametrizations in {0}.'.format(file_name)
+        self.log.info('Read parametrizations of channels {0} from {1}.'.format(self.parametrizations.keys(), file_name))
+
+    def get_parameter_table(self, MH_values):
+        """
+        Returns OrderedDict {channel : OrderedDict {DCB parameter : array of the values at MH_values}}.
+        """
+        MH_values = np.asarray(MH_values, dtype=np.float64)
+        return collections.OrderedDict([(channel, parametrization.evaluate(MH_values))
+                                        for channel, parametrization in self.parametrizations.iteritems()])
+
+    def get_shape_grid(self, MH_values, x_values, x_low, x_high):
+        """
+        Returns array (channel, MH, x) of the DCB p.d.f. normalized on [x_low, x_high]
+        at the x_values (e.g. m4l) for each channel and MH value.
+        """
+        MH_values = np.asarray(MH_values, dtype=np.float64)
+        x_values = np.asarray(x_values, dtype=np.float64)
+        dcb = DoubleCB(x_low, x_high)
+        table = self.get_parameter_table(MH_values)
+        grid = np.empty((len(table), len(MH_values), len(x_values)))
+        for channel_idx, dcb_values in enumerate(table.values()):
+            params = np.array(dcb_values.values()).reshape(len(DCB_PARAMETERS), len(MH_values))
+            for MH_idx in range(len(MH_values)):
+                grid[channel_idx, MH_idx] = dcb.pdf(x_values, tuple(params[:, MH_idx]))
+        return grid
+
+    def print_parameter_table(self, MH_values):
+        table = self.get_parameter_table(MH_values)
+        for channel, dcb_values in table.iteritems():
+            print 'DCB parameters of {0} ({1}):'.format(channel, self.file_name)
+            print '    {0:>8s} '.format('MH') + ' '.join(['{0:>12s}'.format(dcb_par) for dcb_par in dcb_values.keys()])
+            for MH_idx, MH in enumerate(np.asarray(MH_values, dtype=np.float64)):
+                print '    {0:8.3f} '.format(MH) + ' '.join(['{0:12.6g}'.format(values[MH_idx]) for values in dcb_values.values()])
+
+    def save(self, file_name, MH_values, x_values=None, x_low=None, x_high=None):
+        """
+        Saves the parameter table (arrays <channel>_<DCB parameter>) and, if x_values are given,
+        the shape grid (array 'shape' of (channel, MH, x)) to the numpy .npz file.
+        """
+        arrays = {'channels' : np.array(self.parametrizations.keys()), 'MH' : np.asarray(MH_values, dtype=np.float64)}
+        for channel, dcb_values in self.get_parameter_table(MH_values).iteritems():
+            for dcb_par, values in dcb_values.iteritems():
+                arrays['{0}_{1}'.format(channel, dcb_par)] = values
+        if x_values is not None:
+            arrays['x'] = np.asarray(x_values, dtype=np.float64)
+            arrays['shape'] = self.get_shape_grid(MH_values, x_values, x_low, x_high)
+        np.savez(file_name, **arrays)
+        self.log.info('Saved the parametrization grid of {0} MH values to {1}.'.format(len(arrays['MH']), file_name))
+
+
+def parseOptions():
+
+    usage = ('usage: %prog [options] \n' + '%prog -h for help')
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-p', '--params', dest='params', type='string', default='DCB_parametrization.yaml', help='Parametrization file, default DCB_parametrization.yaml')
+    parser.add_option('-s', '--finalState', dest='channels', type='string', default='', help='Comma separated list of channels, default all')
+    parser.add_option('',   '--mH', dest='mH', type='string', default='120:130:1', help='MH values as start:stop:step or comma separated list, default 120:130:1')
+    parser.add_option('',   '--m4l', dest='m4l', type='string', default='', help='m4l values of the shape grid as start:stop:step or comma separated list, default none (no shape grid)')
+    parser.add_option('',   '--m4lRange', dest='m4l_range', type='string', default='105,140', help='Normalization range of the DCB as low,high, default 105,140')
+    parser.add_option('-o', '--output', dest='output', type='string', default='', help='Output .npz file, default none (print the parameter table)')
+
+    global opt, args
+    (opt, args) = parser.parse_args()
+
+
+if __name__ == "__main__":
+    parseOptions()
+    grid = ParametrizationGrid(opt.params, [channel for channel in opt.channels.split(',') if channel])
+    MH_values = parse_grid(opt.mH)
+    x_low, x_high = [float(value) for value in opt.m4l_range.split(',')]
+    x_values = None
+    if opt.m4l:
+        x_values = parse_grid(opt.m4l)
+    if opt.output:
+        grid.save(opt.output, MH_values, x_values, x_low, x_high)
+    else:
+        grid.print_parameter_table(MH_values)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - uncertainties of the simultaneous fit parameters from resampling: bootstrap
+#      replicas (Poisson weights of the events) or toy datasets of the fitted DCB
+#      for each mass point, refitted in worker processes
+#    - summary of the spread and correlations of the refitted parameters
+#-----------------------------------------------
+import sys, os
+import copy
+import json
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.util.ProcessPool import parallel_map
+from lib.fitting.Toys import get_random_state, generate_dcb_values
+from lib.fitting.ParametrizationFit import MassPoint, SimultaneousDCBNLL, BinnedSimultaneousDCBNLL, ParametrizationFitter, get_dcb_params
+
+
+RESAMPLING_METHODS = ['bootstrap', 'toys']
+REPLICAS_PER_TASK = 10  #replicas fitted in one task of the worker pool
+
+
+def get_effective_entries(mass_point):
+    """
+    Returns the effective number of events (sum w)^2/sum w^2 of the mass point.
+    """
+    sum_w2 = np.sum(mass_point.weights**2)
+    if sum_w2 <= 0:
+        return 0.
+    return mass_point.sum_weights()**2/sum_w2
+
+
+def get_bootstrap_replica(mass_points, random_state):
+    """
+    Returns the mass points with the weights of the events multiplied by Poisson(1) numbers.
+    The event arrays are shared with the given mass points, only the weights are new.
+    """
+    return [MassPoint(mass_point.MH, mass_point.x, mass_point.weights*random_state.poisson(1., len(mass_point.x)))
+            for mass_point in mass_points]
+
+
+def get_toy_replica(mass_points, values, x_low, x_high, random_state):
+    """
+    Returns toy mass points with unit weights drawn from the DCB of the parametrization values
+    (see get_dcb_params). The number of events of each toy is Poisson with the mean
+    of the effective number of events of the mass point, so that the statistical power of
+    the weighted events is kept.
+    """
+    return [MassPoint(mass_point.MH, generate_dcb_values(get_dcb_params(values, mass_point.MH),
+                                                         random_state.poisson(get_effective_entries(mass_point)), x_low, x_high, random_state))
+            for mass_point in mass_points]
+
+
+#set by resampling_fit before the worker processes are started, so that the events
+#are inherited by the workers and not sent with each task
+_resampling_setup = {}
+
+
+def fit_replicas(replica_indices):
+    """
+    Fits the replicas (indices) of the _resampling_setup and returns list of
+    (replica index, array of the floating parameter values or None if the fit failed, converged).
+    """
+    setup = _resampling_setup
+    log = Logger().getLogger('fit_replicas', 10)
+    results = []
+    for replica_idx in replica_indices:
+        random_state = get_random_state(setup['seed'], setup['method'], setup['stream'], replica_idx)
+        if setup['method'] == 'bootstrap':
+            mass_points = get_bootstrap_replica(setup['mass_points'], random_state)
+        else:
+            mass_points = get_toy_replica(setup['mass_points'], setup['values'], setup['x_low'], setup['x_high'], random_state)
+        if setup['fit_bins']:
+            nll = BinnedSimultaneousDCBNLL(mass_points, setup['x_low'], setup['x_high'], setup['fit_bins'], setup['likelihood'])
+        else:
+            nll = SimultaneousDCBNLL(mass_points, setup['x_low'], setup['x_high'])
+        #each replica starts from the nominal fit result
+        parameters = copy.deepcopy(setup['parameters'])
+        try:
+            result = ParametrizationFitter(parameters).fit(nll, sumw2_error=False)
+        except (ValueError, FloatingPointError, np.linalg.LinAlgError), error:
+            log.warning('Fit of replica {0} failed: {1}'.format(replica_idx, error))
+            results.append((replica_idx, None, False))
+            continue
+        results.append((replica_idx, np.array([parameters[name].value for name in result.floating]), result.status == 0))
+    return results
+
+
+class ResamplingSummary(object):
+    """
+    The floating parameter values of the refitted replicas (array replicas x parameters)
+    compared with the nominal fit: mean, standard deviation, 68% interval and correlations.
+    Only the converged replicas are used.
+    """
+
+    def __init__(self, method, names, nominal_values, nominal_errors, replica_values, converged):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.method = method
+        self.names = names
+        self.nominal_values = np.asarray(nominal_values, dtype=np.float64)
+        self.nominal_errors = np.asarray(nominal_errors, dtype=np.float64)
+        self.n_replicas = len(converged)
+        self.values = np.array([values for values, ok in zip(replica_values, converged) if ok]).reshape(-1, len(names))
+
+    def mean(self):
+        return self.values.mean(axis=0)
+
+    def std(self):
+        return self.values.std(axis=0, ddof=1)
+
+    def interval(self, coverage=0.6827):
+        """
+        Returns (lower, upper) arrays of the central interval of the replica values with the coverage.
+        """
+        return (np.percentile(self.values, 50.*(1.-coverage), axis=0), np.percentile(self.values, 50.*(1.+coverage), axis=0))
+
+    def covariance(self):
+        return np.atleast_2d(np.cov(self.values, rowvar=False))
+
+    def correlation(self):
+        std = np.sqrt(np.diag(self.covariance()))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.covariance()/np.outer(std, std)
+
+    def to_dict(self):
+        """
+        Returns json serializable dictionary of the summary (without the spread if less than two replicas converged).
+        """
+        summary = collections.OrderedDict([('method', self.method), ('n_replicas', self.n_replicas), ('n_converged', len(self.values)),
+                                           ('parameters', self.names), ('nominal', self.nominal_values.tolist()),
+                                           ('fit_errors', self.nominal_errors.tolist())])
+        if len(self.values) >= 2:
+            lower, upper = self.interval()
+            summary.update([('mean', self.mean().tolist()), ('std', self.std().tolist()), ('lower', lower.tolist()),
+                            ('upper', upper.tolist()), ('correlation', self.correlation().tolist())])
+        return summary
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        self.log.info('Saved the {0} summary to {1}.'.format(self.method, file_name))
+
+    def print_summary(self):
+        self.log.info('{0}: {1} replicas, {2} converged.'.format(self.method, self.n_replicas, len(self.values)))
+        if len(self.values) < 2:
+            self.log.error('Not enough converged replicas for the {0} uncertainties.'.format(self.method))
+            return
+        lower, upper = self.interval()
+        print '    {0:12s} {1:>12s} {2:>10s} {3:>12s} {4:>10s} {5:>8s} {6:>24s}'.format('parameter', 'nominal', 'fit error', 'mean', 'std',
+                                                                                     'std/err', '68% interval')
+        for idx, name in enumerate(self.names):
+            ratio = self.std()[idx]/self.nominal_errors[idx] if self.nominal_errors[idx] > 0 else float('nan')
+            print '    {0:12s} {1: 12.6g} {2:10.3g} {3: 12.6g} {4:10.3g} {5:8.3f} [{6: .6g}, {7: .6g}]'.format(name, self.nominal_values[idx],
+                                        self.nominal_errors[idx], self.mean()[idx], self.std()[idx], ratio, lower[idx], upper[idx])
+        print '    correlations:'
+        width = max([8]+[len(name) for name in self.names])
+        print '    {0:12s} '.format('') + ' '.join(['{0:>{1}s}'.format(name, width) for name in self.names])
+        for idx, name in enumerate(self.names):
+            print '    {0:12s} '.format(name) + ' '.join(['{0: {1}.3f}'.format(value, width) for value in self.correlation()[idx]])
+
+
+def resampling_fit(parameters, mass_points, x_low, x_high, method='bootstrap', n_replicas=100, seed=1, stream=None,
+                   n_workers=1, fit_bins=0, likelihood='poisson'):
+    """
+    Refits the parameters (OrderedDict {name : FitParameter} of the nominal fit, numpy engine) to
+    n_replicas bootstrap or toy replicas (see get_bootstrap_replica and get_toy_replica) of the
+    mass points with n_workers processes, unbinned or binned with fit_bins bins.
+    The replicas are given by the seed and the stream (e.g. channel and bins), not by the order
+    of the fits. Returns ResamplingSummary.
+    """
+    if not method in RESAMPLING_METHODS:
+        raise ValueError, 'Unknown resampling method {0}. Use one of {1}.'.format(method, RESAMPLING_METHODS)
+    floating = [name for name, par in parameters.iteritems() if not par.constant]
+    _resampling_setup.clear()
+    _resampling_setup.update({'parameters' : parameters, 'mass_points' : mass_points, 'x_low' : x_low, 'x_high' : x_high,
+                              'method' : method, 'seed' : seed, 'stream' : stream, 'fit_bins' : fit_bins, 'likelihood' : likelihood,
+                              'values' : np.array([par.value for par in parameters.values()])})
+    #at least one task per worker, at most REPLICAS_PER_TASK replicas in a task
+    per_task = max(1, min(REPLICAS_PER_TASK, n_replicas//max(n_workers, 1)))
+    tasks = [(range(start, min(start+per_task, n_replicas)),) for start in range(0, n_replicas, per_task)]
+    try:
+        results = sum(parallel_map(fit_replicas, tasks, n_workers), [])
+    finally:
+        _resampling_setup.clear()
+
+    summary = ResamplingSummary(method, floating, [parameters[name].value for name in floating], [parameters[name].error for name in floating],
+                                [values for replica_idx, values, converged in results],
+                                [values is not None and converged for replica_idx, values, converged in results])
+    summary.print_summary()
+    return summary
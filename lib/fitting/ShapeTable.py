@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - tables of the normalized DCB shape of the parametrizations in a parametrization
+#      file (e.g. DCB_parametrization.yaml) on dense uniform (MH, m4l) grids per channel
+#    - stored as .npy (float32, opened memory-mapped) with a .json description of the grids
+#    - fast bilinear or bicubic (Catmull-Rom) interpolation of the tables at arbitrary
+#      (channel, MH, m4l) and the maximum interpolation error against the exact DCB
+#-----------------------------------------------
+import sys, os
+import json
+import optparse
+import collections
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.fitting.DoubleCB import DoubleCB
+from lib.fitting.ParametrizationGrid import ParametrizationGrid, parse_grid
+
+
+INTERPOLATION_METHODS = ['linear', 'cubic']
+MH_CHUNK = 256  #MH values of the table computed at once
+
+
+def get_table_file_names(file_name):
+    """
+    Returns (.npy file name, .json file name) of the shape table file_name (with or without extension).
+    """
+    base_name = os.path.splitext(file_name)[0] if file_name.endswith('.npy') or file_name.endswith('.json') else file_name
+    return (base_name+'.npy', base_name+'.json')
+
+
+def build_shape_table(file_name, params_file, MH_values, n_x, x_low, x_high, channels=None):
+    """
+    Tabulates the DCB p.d.f. normalized on [x_low, x_high] of each channel of the params_file at
+    the uniform MH_values (numpy array) and at n_x uniform x values from x_low to x_high (both
+    included). The table (channel, MH, x) is written in float32 to <file_name>.npy and the grids
+    to <file_name>.json. Returns ShapeTable of the file.
+    """
+    log = Logger().getLogger('build_shape_table', 10)
+    MH_values = np.asarray(MH_values, dtype=np.float64)
+    if len(MH_values) < 2 or n_x < 2:
+        raise ValueError, 'The shape table needs at least two MH and two m4l values.'
+    MH_step = (MH_values[-1]-MH_values[0])/(len(MH_values)-1)
+    if not np.allclose(np.diff(MH_values), MH_step):
+        raise ValueError, 'The MH values of the shape table have to be uniform.'
+    npy_file, json_file = get_table_file_names(file_name)
+
+    grid = ParametrizationGrid(params_file, channels)
+    x_values = np.linspace(x_low, x_high, n_x)
+    dcb = DoubleCB(x_low, x_high)
+    table = np.lib.format.open_memmap(npy_file, mode='w+', dtype=np.float32, shape=(len(grid.parametrizations), len(MH_values), n_x))
+    for channel_idx, parametrization in enumerate(grid.parametrizations.values()):
+        for start in range(0, len(MH_values), MH_CHUNK):
+            #the DCB parameters as columns (MH, 1) broadcast with the x values (1, x)
+            dcb_values = parametrization.evaluate(MH_values[start:start+MH_CHUNK, np.newaxis]).values()
+            table[channel_idx, start:start+MH_CHUNK] = dcb.pdf(x_values[np.newaxis, :], dcb_values)
+    table.flush()
+    del table
+
+    description = collections.OrderedDict([('params_file', params_file),
+                                           ('channels', grid.parametrizations.keys()),
+                                           ('MH_min', float(MH_values[0])), ('MH_step', float(MH_step)), ('n_MH', len(MH_values)),
+                                           ('x_low', float(x_low)), ('x_high', float(x_high)), ('n_x', int(n_x))])
+    with open(json_file, 'w') as f:
+        json.dump(description, f, indent=4)
+    log.info('Saved the shape table of {0} channels x {1} MH x {2} m4l values to {3}.'.format(len(description['channels']),
+                                                                                              len(MH_values), n_x, npy_file))
+    return ShapeTable(file_name)
+
+
+def _linear_weights(u, cell, n):
+    return [1.-u, u]
+
+
+def _cubic_weights(u, cell, n):
+    """
+    Catmull-Rom weights of the grid points i-1, i, i+1, i+2 at the fraction u between i=cell and i+1.
+    In the first and last cell of the n grid points the interpolation is linear.
+    """
+    u2 = u*u
+    u3 = u2*u
+    edge = (cell == 0) | (cell == n-2)
+    return [np.where(edge, 0., 0.5*(-u3 + 2*u2 - u)), np.where(edge, 1.-u, 0.5*(3*u3 - 5*u2 + 2)),
+            np.where(edge, u, 0.5*(-3*u3 + 4*u2 + u)), np.where(edge, 0., 0.5*(u3 - u2))]
+
+
+class ShapeTable(object):
+    """
+    Table of the normalized DCB shapes (see build_shape_table) opened memory-mapped, only the grid
+    points needed by the interpolation are read. The shape is 0 outside of [x_low, x_high] and NaN
+    for MH outside of the table.
+    """
+
+    def __init__(self, file_name):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        npy_file, json_file = get_table_file_names(file_name)
+        with open(json_file) as f:
+            self.description = json.load(f, object_pairs_hook=collections.OrderedDict)
+        self.table = np.load(npy_file, mmap_mode='r')
+        self.channels = [str(channel) for channel in self.description['channels']]
+        self.MH_min, self.MH_step, self.n_MH = self.description['MH_min'], self.description['MH_step'], self.description['n_MH']
+        self.x_low, self.x_high, self.n_x = self.description['x_low'], self.description['x_high'], self.description['n_x']
+        self.x_step = (self.x_high-self.x_low)/(self.n_x-1)
+        if self.table.shape != (len(self.channels), self.n_MH, self.n_x):
+            raise ValueError, 'The shape table {0} {1} does not match its description {2}.'.format(npy_file, self.table.shape, json_file)
+
+    def get_MH_range(self):
+        return (self.MH_min, self.MH_min+self.MH_step*(self.n_MH-1))
+
+    def _get_cells(self, values, start, step, n, n_points):
+        """
+        Returns (index of the first grid point used for each value, index of its cell, fraction within
+        the cell) for interpolation with n_points (2 or 4) grid points along an axis of n uniform points.
+        """
+        position = (values-start)/step
+        cell = np.clip(np.floor(position), 0, n-2).astype(np.intp)
+        first = cell - (n_points//2-1)
+        return (first, cell, position-cell)
+
+    def evaluate(self, channel, MH, x, method='linear'):
+        """
+        Returns the interpolated normalized DCB of the channel at (MH, x) (numbers or numpy arrays of
+        broadcastable shapes). The method is 'linear' (bilinear) or 'cubic' (bicubic Catmull-Rom).
+        """
+        if not method in INTERPOLATION_METHODS:
+            raise ValueError, 'Unknown interpolation method {0}. Use one of {1}.'.format(method, INTERPOLATION_METHODS)
+        if not channel in self.channels:
+            raise ValueError, 'There is no channel {0} in the shape table, there are {1}.'.format(channel, self.channels)
+        MH, x = np.broadcast_arrays(np.asarray(MH, dtype=np.float64), np.asarray(x, dtype=np.float64))
+        table = self.table[self.channels.index(channel)]
+        n_points, get_weights = {'linear' : (2, _linear_weights), 'cubic' : (4, _cubic_weights)}[method]
+
+        MH_first, MH_cell, MH_fraction = self._get_cells(MH, self.MH_min, self.MH_step, self.n_MH, n_points)
+        x_first, x_cell, x_fraction = self._get_cells(x, self.x_low, self.x_step, self.n_x, n_points)
+        MH_weights, x_weights = get_weights(MH_fraction, MH_cell, self.n_MH), get_weights(x_fraction, x_cell, self.n_x)
+        values = np.zeros(MH.shape)
+        for MH_shift in range(n_points):
+            #grid points beyond the edges (with weight 0) are replaced by the edge points
+            MH_idx = np.clip(MH_first+MH_shift, 0, self.n_MH-1)
+            row = np.zeros(MH.shape)
+            for x_shift in range(n_points):
+                row += x_weights[x_shift]*table[MH_idx, np.clip(x_first+x_shift, 0, self.n_x-1)]
+            values += MH_weights[MH_shift]*row
+
+        MH_low, MH_high = self.get_MH_range()
+        values = np.where((x < self.x_low) | (x > self.x_high), 0., values)
+        return np.where((MH < MH_low) | (MH > MH_high), np.nan, values)
+
+    def get_interpolation_error(self, n_points=100000, method='linear', random_state=None, params_file=None):
+        """
+        Compares the interpolation with the exact DCB of the parametrizations (of params_file, default
+        the file the table was built from) at n_points random (MH, x) points per channel.
+        Returns OrderedDict {channel : (max absolute error, max absolute error / max of the shape, MH, x of the max error)}.
+        """
+        if random_state is None:
+            random_state = np.random.RandomState()
+        grid = ParametrizationGrid(params_file or self.description['params_file'], self.channels)
+        dcb = DoubleCB(self.x_low, self.x_high)
+        MH_low, MH_high = self.get_MH_range()
+        errors = collections.OrderedDict()
+        for channel in self.channels:
+            MH = random_state.uniform(MH_low, MH_high, n_points)
+            x = random_state.uniform(self.x_low, self.x_high, n_points)
+            exact = dcb.pdf(x, grid.parametrizations[channel].evaluate(MH).values())
+            difference = np.abs(self.evaluate(channel, MH, x, method)-exact)
+            idx = np.argmax(difference)
+            errors[channel] = (float(difference[idx]), float(difference[idx]/np.max(self.table[self.channels.index(channel)])), float(MH[idx]), float(x[idx]))
+        return errors
+
+    def print_interpolation_error(self, n_points=100000, method='linear', random_state=None, params_file=None):
+        errors = self.get_interpolation_error(n_points, method, random_state, params_file)
+        print 'Maximum {0} interpolation error of the shape table at {1} random points per channel:'.format(method, n_points)
+        for channel, (max_error, relative_error, MH, x) in errors.iteritems():
+            print '    {0:>8s}: {1:.3e} ({2:.3e} of the maximum of the shape) at MH = {3:.3f}, m4l = {4:.3f}'.format(channel, max_error, relative_error, MH, x)
+
+
+def parseOptions():
+
+    usage = ('usage: %prog [options] \n' + '%prog -h for help')
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-p', '--params', dest='params', type='string', default='DCB_parametrization.yaml', help='Parametrization file, default DCB_parametrization.yaml')
+    parser.add_option('-s', '--finalState', dest='channels', type='string', default='', help='Comma separated list of channels, default all')
+    parser.add_option('',   '--mH', dest='mH', type='string', default='110:140:0.01', help='Uniform MH values of the table as start:stop:step, default 110:140:0.01')
+    parser.add_option('',   '--nM4l', dest='n_m4l', type='int', default=3501, help='Number of m4l values of the table in the m4l range, default 3501')
+    parser.add_option('',   '--m4lRange', dest='m4l_range', type='string', default='105,140', help='Normalization range of the DCB as low,high, default 105,140')
+    parser.add_option('-o', '--output', dest='output', type='string', default='DCB_shape_table', help='Output file name (.npy and .json), default DCB_shape_table')
+    parser.add_option('',   '--check', dest='check', type='int', default=100000, help='Random points per channel to check the interpolation error, default 100000 (0 for no check)')
+    parser.add_option('',   '--method', dest='method', type='string', default='linear', help='Interpolation method to check: linear or cubic, default linear')
+
+    global opt, args
+    (opt, args) = parser.parse_args()
+
+
+if __name__ == "__main__":
+    parseOptions()
+    x_low, x_high = [float(value) for value in opt.m4l_range.split(',')]
+    shape_table = build_shape_table(opt.output, opt.params, parse_grid(opt.mH), opt.n_m4l, x_low, x_high,
+                                    [channel for channel in opt.channels.split(',') if channel])
+    if opt.check:
+        shape_table.print_interpolation_error(opt.check, opt.method)
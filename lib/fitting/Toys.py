@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - generate toy m4l values distributed as the DCB of each mass point
+#    - reproducible random streams: the seed of each stream (e.g. channel and MH)
+#      depends only on the base seed and the stream name, not on the order of generation
+#-----------------------------------------------
+import sys, os
+import json
+import hashlib
+import numpy as np
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.fitting.DoubleCB import DoubleCB
+
+
+BATCH_SIZE = 1000000  #number of values drawn at once
+
+
+def get_stream_seed(seed, *stream):
+    """
+    Returns the 32-bit seed of the random stream given by the base seed and the
+    stream identifiers (json serializable, e.g. 'toy', channel, MH).
+    """
+    return int(hashlib.sha1(json.dumps([seed]+list(stream))).hexdigest()[:8], 16)
+
+
+def get_random_state(seed, *stream):
+    """
+    Returns numpy.random.RandomState of the random stream (see get_stream_seed).
+    """
+    return np.random.RandomState(get_stream_seed(seed, *stream))
+
+
+def generate_dcb_values(params, n_events, x_low, x_high, random_state, batch_size=BATCH_SIZE):
+    """
+    Draws n_events values from the DCB with the parameters (mean, sigma, alpha, n, alpha2, n2)
+    normalized on [x_low, x_high], in batches of batch_size values.
+    """
+    dcb = DoubleCB(x_low, x_high)
+    n_events = int(n_events)
+    values = np.empty(n_events)
+    for start in xrange(0, n_events, batch_size):
+        stop = min(start+batch_size, n_events)
+        values[start:stop] = dcb.sample(params, stop-start, random_state)
+    return values
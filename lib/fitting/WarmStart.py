@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - initial values (and step sizes) of the p0, p1 parameters of the simultaneous
+#      fit from the last stored fit result or from a parametrization (YAML formulas)
+#    - store of the last fit result of each fit (json file per fit name)
+#-----------------------------------------------
+import sys, os
+import json
+import tempfile
+import collections
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+from lib.util.Logger import *
+from lib.fitting.Parametrization import CompiledParametrization
+from lib.fitting.ParametrizationFit import EXPANSION_POINT
+
+
+def get_values_from_parametrization(formulas, delta_MH=1.):
+    """
+    Returns OrderedDict {p0/p1 parameter name : value} of the linear expansion around
+    mH=125 of the parametrization formulas {DCB parameter : formula of @0 (=MH)}:
+    p0 is the value at 125 and p1 the slope (central difference with step delta_MH).
+    """
+    parametrization = CompiledParametrization(formulas)
+    values = collections.OrderedDict()
+    at_low, at_expansion, at_high = [parametrization.evaluate(EXPANSION_POINT+shift) for shift in [-delta_MH, 0, delta_MH]]
+    for dcb_par in parametrization.formulas.keys():
+        values[dcb_par+'_p0'] = float(at_expansion[dcb_par])
+        values[dcb_par+'_p1'] = float(at_high[dcb_par]-at_low[dcb_par])/(2*delta_MH)
+    return values
+
+
+class WarmStartStore(object):
+    """
+    Keeps the last fit result {parameter name : (value, error)} of each fit name
+    (e.g. channel and bins) as json file in the directory. The files are replaced
+    atomically, so that fits running at the same time can store their results.
+    """
+
+    def __init__(self, directory='warm_start'):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.directory = directory
+
+    def get_file_name(self, name):
+        return os.path.join(self.directory, '{0}.json'.format(name))
+
+    def get(self, name):
+        """
+        Returns OrderedDict {parameter name : (value, error)} stored for the name or None.
+        """
+        file_name = self.get_file_name(name)
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name) as f:
+            stored = json.load(f, object_pairs_hook=collections.OrderedDict)
+        return collections.OrderedDict([(par_name, tuple(value_error)) for par_name, value_error in stored.iteritems()])
+
+    def put(self, name, values, errors=None):
+        """
+        Stores the values {parameter name : value} (and errors) under the name.
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass  #made by other process in the meantime
+        errors = errors or {}
+        stored = collections.OrderedDict([(par_name, (value, errors.get(par_name, 0.))) for par_name, value in values.iteritems()])
+        fd, tmp_file_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stored, f, indent=4)
+        #mkstemp makes the file readable only by the owner, give it the permissions of a new file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file_name, 0666 & ~umask)
+        os.rename(tmp_file_name, self.get_file_name(name))
+        self.log.debug('Stored fit result {0} to {1}'.format(name, self.get_file_name(name)))
+
+
+def apply_warm_start(param_init, values, errors=None):
+    """
+    Returns (OrderedDict {name : (initial value, min, max)}, {name : step size}) with the initial
+    values of param_init {name : (initial value, min, max)} replaced by the given values (clipped
+    to the ranges). The step sizes are the errors (if given and positive).
+    """
+    log = Logger().getLogger('apply_warm_start', 10)
+    errors = errors or {}
+    warm_init = collections.OrderedDict()
+    steps = {}
+    for par_name, (init_value, min_value, max_value) in param_init.iteritems():
+        value = values.get(par_name, init_value)
+        if not min_value <= value <= max_value:
+            log.warning('Warm start value {0} = {1} is outside of the range [{2}, {3}], clipped.'.format(par_name, value, min_value, max_value))
+            value = min(max(value, min_value), max_value)
+        warm_init[par_name] = (value, min_value, max_value)
+        if errors.get(par_name, 0) > 0:
+            steps[par_name] = errors[par_name]
+    return (warm_init, steps)
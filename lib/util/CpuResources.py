@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - number of CPUs available to the process: the CPU affinity and the
+#      cgroup (v1 or v2) quota of the process and its parent cgroups
+#    - split of the CPUs between the fits running at the same time and
+#      the CPUs of each fit (NumCPU)
+#-----------------------------------------------
+import os
+import multiprocessing
+from Logger import *
+
+
+def _parse_cpu_list(cpu_list):
+    """
+    Number of CPUs in a list like '0-3,8,10-11' (as in Cpus_allowed_list of /proc/<pid>/status).
+    """
+    n_cpus = 0
+    for cpu_range in cpu_list.strip().split(','):
+        if not cpu_range: continue
+        if '-' in cpu_range:
+            first, last = cpu_range.split('-')
+            n_cpus+=int(last)-int(first)+1
+        else:
+            n_cpus+=1
+    return n_cpus
+
+
+def get_affinity_cpus(status_file='/proc/self/status'):
+    """
+    Number of CPUs the process is allowed to run on (CPU affinity mask) or None if unknown.
+    """
+    try:
+        with open(status_file) as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return _parse_cpu_list(line.split(':', 1)[1]) or None
+    except IOError:
+        pass
+    return None
+
+
+def get_cgroup_paths(cgroup_file='/proc/self/cgroup'):
+    """
+    Returns {controller : path} of the cgroups of the process from lines 'id:controllers:path'
+    of /proc/self/cgroup, the controller of the cgroup v2 (unified) hierarchy is ''.
+    """
+    paths = {}
+    try:
+        with open(cgroup_file) as f:
+            for line in f:
+                fields = line.strip().split(':', 2)
+                if len(fields) != 3: continue
+                for controller in fields[1].split(','):
+                    paths[controller] = fields[2]
+    except IOError:
+        pass
+    return paths
+
+
+def _get_cgroup_dirs(mount_dir, path):
+    """
+    Returns the directories of the cgroup path and of all its parents under mount_dir (the quota
+    of each of them limits the process). The path may be missing there (cgroup namespaces),
+    then only the mount_dir is used.
+    """
+    dirs = []
+    path = path.strip('/')
+    while path:
+        if os.path.isdir(os.path.join(mount_dir, path)):
+            dirs.append(os.path.join(mount_dir, path))
+        path = os.path.dirname(path)
+    dirs.append(mount_dir)
+    return dirs
+
+
+def _read_cpu_max(cgroup_dir):
+    """
+    CPUs of the cgroup v2 quota (cpu.max 'quota period') or None if there is no quota.
+    """
+    try:
+        with open(os.path.join(cgroup_dir, 'cpu.max')) as f:
+            fields = f.read().split()
+        if fields[0] != 'max' and float(fields[1]) > 0:
+            return float(fields[0])/float(fields[1])
+    except (IOError, IndexError, ValueError):
+        pass
+    return None
+
+
+def _read_cfs_quota(cgroup_dir):
+    """
+    CPUs of the cgroup v1 quota (cpu.cfs_quota_us/cpu.cfs_period_us) or None if there is no quota.
+    """
+    try:
+        with open(os.path.join(cgroup_dir, 'cpu.cfs_quota_us')) as f:
+            quota = float(f.read())
+        with open(os.path.join(cgroup_dir, 'cpu.cfs_period_us')) as f:
+            period = float(f.read())
+    except (IOError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota/period
+
+
+def get_cgroup_quota_cpus(cgroup_dir='/sys/fs/cgroup', cgroup_file='/proc/self/cgroup'):
+    """
+    Number of CPUs given by the CFS quota of the cgroups of the process (see get_cgroup_paths) and of
+    their parents (v2 cpu.max or v1 cpu.cfs_quota_us/cpu.cfs_period_us), the smallest one rounded
+    down but at least 1, or None if there is no quota.
+    """
+    paths = get_cgroup_paths(cgroup_file)
+    quotas = []
+    if '' in paths:
+        quotas+=[_read_cpu_max(quota_dir) for quota_dir in _get_cgroup_dirs(cgroup_dir, paths[''])]
+    if 'cpu' in paths:
+        for mount in ['cpu', 'cpu,cpuacct', 'cpuacct,cpu']:
+            if os.path.isdir(os.path.join(cgroup_dir, mount)):
+                quotas+=[_read_cfs_quota(quota_dir) for quota_dir in _get_cgroup_dirs(os.path.join(cgroup_dir, mount), paths['cpu'])]
+                break
+    if not paths:
+        quotas+=[_read_cpu_max(cgroup_dir), _read_cfs_quota(os.path.join(cgroup_dir, 'cpu'))]
+    quotas = [quota for quota in quotas if quota]
+    if not quotas:
+        return None
+    return max(1, int(min(quotas)))
+
+
+def get_available_cpus():
+    """
+    Number of CPUs available to the process: the smallest of the number of CPUs of the
+    machine, of the CPU affinity mask and of the cgroup CPU quota (e.g. in containers and batch slots).
+    """
+    n_cpus = [multiprocessing.cpu_count(), get_affinity_cpus(), get_cgroup_quota_cpus()]
+    return min([n for n in n_cpus if n])
+
+
+class ParallelismPolicy(object):
+    """
+    Splits the available CPUs between the fits running at the same time (e.g. the
+    JobScheduler tasks) and the parallel NLL evaluation inside each fit (RooFit.NumCPU).
+    The total number of CPUs is auto-detected (see get_available_cpus) unless given,
+    and the CPUs per fit can be fixed with fit_cpus. With n_tasks fits in total, no
+    more than n_tasks of them run at the same time.
+    """
+
+    def __init__(self, total_cpus=0, concurrent_fits=1, fit_cpus=0, n_tasks=None):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.detected_cpus = get_available_cpus()
+        self.total_cpus = total_cpus or self.detected_cpus
+        self.concurrent_fits = max(1, concurrent_fits)
+        if n_tasks:
+            self.concurrent_fits = min(self.concurrent_fits, n_tasks)
+        self.fit_cpus = fit_cpus or max(1, self.total_cpus//self.concurrent_fits)
+        self.log.info('CPUs: {0} detected, {1} used, {2} concurrent fits with {3} CPUs each.'.format(self.detected_cpus,
+                                                                                             self.total_cpus, self.concurrent_fits, self.fit_cpus))
+        if self.concurrent_fits*self.fit_cpus > self.detected_cpus:
+            self.log.warning('{0} concurrent fits with {1} CPUs each oversubscribe the {2} available CPUs.'.format(self.concurrent_fits,
+                                                                                                          self.fit_cpus, self.detected_cpus))
+
+    def get_fit_cpus(self):
+        """
+        Number of CPUs for the NLL evaluation of one fit (RooFit.NumCPU).
+        """
+        return self.fit_cpus
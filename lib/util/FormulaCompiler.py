@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - parse TTree::Draw / TFormula like expressions (cut strings, RooFormulaVar formulas) once
+#    - evaluate them on numpy arrays (columns) instead of event by event
+#    - share common subexpressions between many expressions (e.g. cuts of different channels)
+#-----------------------------------------------
+import re
+import collections
+import numpy as np
+from Logger import *
+
+
+class FormulaSyntaxError(Exception):
+    pass
+
+
+_token_re = re.compile(r'''
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+       |(?P<ref>@\d+)
+       |(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:::[A-Za-z_][A-Za-z0-9_]*)*)
+       |(?P<op>&&|\|\||==|!=|>=|<=|[-+*/<>!()\[\],])
+    )''', re.VERBOSE)
+
+
+def tokenize(expression):
+    """
+    Splits the expression into list of (kind, value) tokens.
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _token_re.match(expression, position)
+        if not match:
+            raise FormulaSyntaxError('Cannot parse "{0}" at position {1}: {2}'.format(expression, position, expression[position:]))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+#functions known to the compiler {name : (numpy function, number of arguments)}
+FUNCTIONS = {
+    'abs'         : (np.abs, 1),
+    'fabs'        : (np.abs, 1),
+    'TMath::Abs'  : (np.abs, 1),
+    'sqrt'        : (np.sqrt, 1),
+    'TMath::Sqrt' : (np.sqrt, 1),
+    'exp'         : (np.exp, 1),
+    'TMath::Exp'  : (np.exp, 1),
+    'log'         : (np.log, 1),
+    'TMath::Log'  : (np.log, 1),
+    'cos'         : (np.cos, 1),
+    'sin'         : (np.sin, 1),
+    'pow'         : (np.power, 2),
+    'TMath::Power': (np.power, 2),
+    'min'         : (np.minimum, 2),
+    'TMath::Min'  : (np.minimum, 2),
+    'max'         : (np.maximum, 2),
+    'TMath::Max'  : (np.maximum, 2),
+    }
+
+#binary operators: precedence (higher binds tighter) and whether the operands can be swapped
+BINARY_OPERATORS = {
+    '||' : (1, True),
+    '&&' : (2, True),
+    '==' : (3, True),
+    '!=' : (3, True),
+    '<'  : (4, False),
+    '>'  : (4, False),
+    '<=' : (4, False),
+    '>=' : (4, False),
+    '+'  : (5, True),
+    '-'  : (5, False),
+    '*'  : (6, True),
+    '/'  : (6, False),
+    }
+
+
+class _Parser(object):
+    """
+    Recursive descent parser producing the expression tree as nested tuples:
+    ('num', value), ('var', name), ('ref', index), ('index', name, node),
+    ('call', name, (nodes)), ('not', node), ('neg', node), ('bin', op, node, node).
+    Operands of commutative operators are sorted, so that the same subexpression
+    written in a different order gives the same node.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.position+=1
+        return token
+
+    def _expect(self, value):
+        kind, token = self._next()
+        if token != value:
+            raise FormulaSyntaxError('Expected "{0}" but got "{1}" in "{2}"'.format(value, token, self.expression))
+
+    def parse(self):
+        if not self.tokens:
+            raise FormulaSyntaxError('Empty expression')
+        node = self._parse_binary(1)
+        if self.position != len(self.tokens):
+            raise FormulaSyntaxError('Unexpected "{0}" in "{1}"'.format(self._peek()[1], self.expression))
+        return node
+
+    def _parse_binary(self, min_precedence):
+        node = self._parse_unary()
+        while True:
+            kind, op = self._peek()
+            if kind != 'op' or not op in BINARY_OPERATORS: break
+            precedence, commutative = BINARY_OPERATORS[op]
+            if precedence < min_precedence: break
+            self._next()
+            right = self._parse_binary(precedence+1)
+            node = make_binary(op, node, right)
+        return node
+
+    def _parse_unary(self):
+        kind, token = self._peek()
+        if (kind, token) == ('op', '!'):
+            self._next()
+            return ('not', self._parse_unary())
+        if (kind, token) == ('op', '-'):
+            self._next()
+            operand = self._parse_unary()
+            if operand[0] == 'num':
+                return ('num', -operand[1])
+            return ('neg', operand)
+        if (kind, token) == ('op', '+'):
+            self._next()
+            return self._parse_unary()
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        kind, token = self._next()
+        if kind == 'number':
+            return ('num', float(token))
+        if kind == 'ref':
+            return ('ref', int(token[1:]))
+        if kind == 'name':
+            next_kind, next_token = self._peek()
+            if next_token == '(':
+                self._next()
+                args = [self._parse_binary(1)]
+                while self._peek()[1] == ',':
+                    self._next()
+                    args.append(self._parse_binary(1))
+                self._expect(')')
+                if not token in FUNCTIONS:
+                    raise FormulaSyntaxError('Unknown function "{0}" in "{1}"'.format(token, self.expression))
+                if len(args) != FUNCTIONS[token][1]:
+                    raise FormulaSyntaxError('Function "{0}" takes {1} arguments in "{2}"'.format(token, FUNCTIONS[token][1], self.expression))
+                return ('call', FUNCTIONS[token][0].__name__, tuple(args))
+            if next_token == '[':
+                self._next()
+                index = self._parse_binary(1)
+                self._expect(']')
+                return ('index', token, index)
+            return ('var', token)
+        if token == '(':
+            node = self._parse_binary(1)
+            self._expect(')')
+            return node
+        raise FormulaSyntaxError('Unexpected "{0}" in "{1}"'.format(token, self.expression))
+
+
+def make_binary(op, left, right):
+    """
+    Returns the node of the binary operation, folding constants and sorting
+    the operands of commutative operators.
+    """
+    if left[0] == 'num' and right[0] == 'num':
+        return ('num', float(_apply_binary(op, np.float64(left[1]), np.float64(right[1]))))
+    if BINARY_OPERATORS[op][1] and right < left:
+        left, right = right, left
+    return ('bin', op, left, right)
+
+
+def _truth(values):
+    if isinstance(values, np.ndarray) and values.dtype == bool:
+        return values
+    return np.asarray(values) != 0
+
+
+def _apply_binary(op, left, right):
+    if op == '&&': return np.logical_and(_truth(left), _truth(right))
+    if op == '||': return np.logical_or(_truth(left), _truth(right))
+    if op == '==': return left == right
+    if op == '!=': return left != right
+    if op == '<' : return left < right
+    if op == '>' : return left > right
+    if op == '<=': return left <= right
+    if op == '>=': return left >= right
+    if op == '+' : return np.add(left, right, dtype=np.float64)
+    if op == '-' : return np.subtract(left, right, dtype=np.float64)
+    if op == '*' : return np.multiply(left, right, dtype=np.float64)
+    if op == '/' : return np.true_divide(left, right, dtype=np.float64)
+    raise FormulaSyntaxError('Unknown operator {0}'.format(op))
+
+
+_numpy_functions = dict([(function.__name__, function) for function, n_args in FUNCTIONS.values()])
+
+
+def get_variables(node):
+    """
+    Returns the set of variable (branch) names used by the expression tree.
+    """
+    kind = node[0]
+    if kind == 'var':
+        return set([node[1]])
+    if kind == 'index':
+        return set([node[1]]) | get_variables(node[2])
+    if kind == 'call':
+        return set().union(*[get_variables(arg) for arg in node[2]])
+    if kind in ['not', 'neg']:
+        return get_variables(node[1])
+    if kind == 'bin':
+        return get_variables(node[2]) | get_variables(node[3])
+    return set()
+
+
+def pad_jagged(column):
+    """
+    Converts jagged (per-event vector) column given as object array of arrays
+    to 2D array padded with nan. 2D arrays are returned as they are.
+    """
+    if column.dtype != object:
+        return column
+    max_length = max([len(values) for values in column]) if len(column) else 0
+    padded = np.full((len(column), max(max_length, 1)), np.nan)
+    for row, values in enumerate(column):
+        padded[row, :len(values)] = values
+    return padded
+
+
+def get_jagged_value(column, index):
+    """
+    Returns column[event][index[event]] for jagged column given as 2D array
+    (see pad_jagged). Out of range indices give nan.
+    """
+    index = np.broadcast_to(np.asarray(index), (column.shape[0],)).astype(np.int64)
+    in_range = (index >= 0) & (index < column.shape[1])
+    values = np.full(column.shape[0], np.nan)
+    rows = np.flatnonzero(in_range)
+    values[rows] = column[rows, index[rows]]
+    return values
+
+
+class FormulaEvaluator(object):
+    """
+    Evaluates expression trees on one set of columns {name : numpy array}.
+    The values of all the (sub)expressions are kept, so a subexpression shared
+    by several expressions is computed only once.
+    References @N are taken from the list 'refs'.
+    """
+
+    def __init__(self, columns, refs=None):
+        self.columns = columns
+        self.refs = refs or []
+        self.values = {}
+        self.padded_columns = {}
+
+    def evaluate(self, node):
+        if node in self.values:
+            return self.values[node]
+        kind = node[0]
+        if kind == 'num':
+            value = node[1]
+        elif kind == 'var':
+            if not node[1] in self.columns:
+                raise KeyError('Column {0} needed by the formula is not available'.format(node[1]))
+            value = self.columns[node[1]]
+        elif kind == 'ref':
+            value = self.refs[node[1]]
+        elif kind == 'index':
+            if not node[1] in self.padded_columns:
+                self.padded_columns[node[1]] = pad_jagged(self.columns[node[1]])
+            value = get_jagged_value(self.padded_columns[node[1]], self.evaluate(node[2]))
+        elif kind == 'call':
+            value = _numpy_functions[node[1]](*[self.evaluate(arg) for arg in node[2]])
+        elif kind == 'not':
+            value = np.logical_not(_truth(self.evaluate(node[1])))
+        elif kind == 'neg':
+            value = np.negative(self.evaluate(node[1]))
+        else:
+            value = _apply_binary(node[1], self.evaluate(node[2]), self.evaluate(node[3]))
+        self.values[node] = value
+        return value
+
+
+class CompiledFormula(object):
+    """
+    Expression parsed once. Call it with the columns {name : numpy array}
+    (and optionally the list of @N references) to get the values.
+    """
+
+    def __init__(self, expression, node):
+        self.expression = expression
+        self.node = node
+        self.variables = get_variables(node)
+
+    def __call__(self, columns=None, refs=None, evaluator=None):
+        if evaluator is None:
+            evaluator = FormulaEvaluator(columns or {}, refs)
+        return evaluator.evaluate(self.node)
+
+    def mask(self, columns=None, evaluator=None):
+        """
+        Returns boolean numpy array which is True where the cut passes.
+        """
+        values = self(columns, evaluator=evaluator)
+        n_entries = len(columns.values()[0]) if columns else len(evaluator.columns.values()[0])
+        return np.broadcast_to(_truth(values), (n_entries,)).copy()
+
+    def __repr__(self):
+        return 'CompiledFormula({0!r})'.format(self.expression)
+
+
+class FormulaCompiler(object):
+    """
+    Compiles TTree::Draw / TFormula like expressions into CompiledFormula objects.
+    Supported are numbers, branch names, indexed branches (e.g. GENidLS3[GENlepIndex1]),
+    @N references, the functions in FUNCTIONS and the operators
+    ! - || && == != < > <= >= + - * /.
+    Expressions are parsed only once per compiler.
+    """
+
+    def __init__(self):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.compiled = {}
+
+    def compile(self, expression):
+        if not expression in self.compiled:
+            self.compiled[expression] = CompiledFormula(expression, _Parser(expression).parse())
+            self.log.debug('Compiled formula: {0} -> {1}'.format(expression, self.compiled[expression].node))
+        return self.compiled[expression]
+
+    def can_compile(self, expression):
+        try:
+            self.compile(expression)
+        except FormulaSyntaxError, e:
+            self.log.debug('Cannot compile formula: {0}'.format(e))
+            return False
+        return True
+
+    def evaluate(self, expressions, columns, refs=None):
+        """
+        Evaluates all the expressions on the same columns sharing the common
+        subexpressions. Returns OrderedDict {expression : numpy array}.
+        """
+        evaluator = FormulaEvaluator(columns, refs)
+        n_entries = len(columns.values()[0]) if len(columns) else 0
+        results = collections.OrderedDict()
+        for expression in expressions:
+            values = self.compile(expression)(evaluator=evaluator)
+            results[expression] = np.broadcast_to(values, (n_entries,)).astype(np.float64)
+        return results
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - run independent tasks (e.g. the fits of the channels and bins) in worker
+#      processes, the output of each task goes to its own log file
+#    - progress report and summary of the done and failed tasks
+#-----------------------------------------------
+import sys, os
+import time
+import traceback
+import collections
+import multiprocessing
+from Logger import *
+
+
+class TaskResult(object):
+    """
+    Outcome of one task: status ('done' or 'failed'), the returned result or
+    the traceback of the exception, the log file and the duration in seconds.
+    """
+
+    def __init__(self, name, status, result=None, error=None, log_file=None, duration=0.):
+        self.name = name
+        self.status = status
+        self.result = result
+        self.error = error
+        self.log_file = log_file
+        self.duration = duration
+
+    def ok(self):
+        return self.status == 'done'
+
+    def __repr__(self):
+        return 'TaskResult(name={0}, status={1}, duration={2:.1f} s, log_file={3})'.format(self.name, self.status, self.duration, self.log_file)
+
+
+def _redirect_output(log_file):
+    """
+    Redirects stdout and stderr (also of the C++ code, e.g. ROOT) to the log file.
+    Returns the saved file descriptors for _restore_output.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(log_fd)
+    return saved_fds
+
+
+def _restore_output(saved_fds):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(saved_fds[0], 1)
+    os.dup2(saved_fds[1], 2)
+    os.close(saved_fds[0])
+    os.close(saved_fds[1])
+
+
+def _run_task(task):
+    """
+    Runs one task (name, function, args, log_file) catching any exception, so
+    that a failing task doesn't stop the others.
+    """
+    name, function, args, log_file = task
+    start = time.time()
+    saved_fds = None
+    if log_file:
+        saved_fds = _redirect_output(log_file)
+    try:
+        result = function(*args)
+        status, error = 'done', None
+    except Exception:
+        result, status, error = None, 'failed', traceback.format_exc()
+        print error
+    finally:
+        if saved_fds:
+            _restore_output(saved_fds)
+    return TaskResult(name, status, result, error, log_file, time.time()-start)
+
+
+class JobScheduler(object):
+    """
+    Runs independent tasks function(*args) with at most n_workers processes at the
+    same time. Each task runs in a fresh process (the ROOT state is not shared
+    between the tasks) and its output goes to <log_dir>/<task name>.log.
+    The results of all tasks are collected; a failed task is reported and the
+    remaining tasks still run. With one worker the tasks run in the current
+    process and their output is not redirected.
+    The functions have to be defined at module level (to be picklable), and so
+    do the arguments and the results.
+    """
+
+    def __init__(self, n_workers=1, log_dir='logs'):
+        self.log = Logger().getLogger(self.__class__.__name__, 10)
+        self.n_workers = n_workers
+        self.log_dir = log_dir
+        self.tasks = collections.OrderedDict()  #{name : (function, args)}
+
+    def add_task(self, name, function, *args):
+        if name in self.tasks:
+            raise ValueError, 'Task {0} already exists.'.format(name)
+        self.tasks[name] = (function, args)
+
+    def get_log_file(self, name):
+        if self.n_workers<=1 or not self.log_dir:
+            return None
+        return os.path.join(self.log_dir, '{0}.log'.format(name))
+
+    def run(self):
+        """
+        Runs all the tasks and returns OrderedDict {task name : TaskResult} in the order the tasks were added.
+        """
+        tasks = [(name, function, args, self.get_log_file(name)) for name, (function, args) in self.tasks.iteritems()]
+        n_tasks = len(tasks)
+        results = {}
+        if self.n_workers<=1 or n_tasks<=1:
+            self.log.info('Running {0} tasks serially.'.format(n_tasks))
+            for task in tasks:
+                results[task[0]] = self._report_progress(_run_task(task), len(results)+1, n_tasks)
+        else:
+            if self.log_dir and not os.path.exists(self.log_dir):
+                os.makedirs(self.log_dir)
+            n_processes = min(self.n_workers, n_tasks)
+            self.log.info('Running {0} tasks in {1} worker processes, logs in {2}.'.format(n_tasks, n_processes, self.log_dir))
+            pool = multiprocessing.Pool(processes=n_processes, maxtasksperchild=1)
+            try:
+                for task_result in pool.imap_unordered(_run_task, tasks, chunksize=1):
+                    results[task_result.name] = self._report_progress(task_result, len(results)+1, n_tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return collections.OrderedDict([(task[0], results[task[0]]) for task in tasks])
+
+    def _report_progress(self, task_result, n_finished, n_tasks):
+        if task_result.ok():
+            self.log.info('[{0}/{1}] Task {2} done in {3:.1f} s.'.format(n_finished, n_tasks, task_result.name, task_result.duration))
+        else:
+            self.log.error('[{0}/{1}] Task {2} failed after {3:.1f} s (log: {4}):\n{5}'.format(n_finished, n_tasks, task_result.name,
+                                                                                          task_result.duration, task_result.log_file, task_result.error))
+        return task_result
+
+    def print_summary(self, results):
+        """
+        Prints the status of all tasks. Returns the list of names of the failed tasks.
+        """
+        failed = [name for name, task_result in results.iteritems() if not task_result.ok()]
+        print 'Tasks summary: {0} done, {1} failed'.format(len(results)-len(failed), len(failed))
+        for name, task_result in results.iteritems():
+            print '    {0:50s} {1:6s} {2:8.1f} s  {3}'.format(name, task_result.status, task_result.duration, task_result.log_file or '')
+        return failed
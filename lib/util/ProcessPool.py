@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------
+# Purpose:
+#    - map a function over argument tuples with a pool of forked worker processes,
+#      the results in the order of the arguments
+#    - serial run with one worker or inside a worker process of another pool
+#-----------------------------------------------
+import multiprocessing
+from Logger import *
+
+
+def _apply(function_and_args):
+    """
+    Helper for the pool: calls function(*args).
+    """
+    function, args = function_and_args
+    return function(*args)
+
+
+def get_n_processes(n_workers, n_tasks):
+    """
+    Returns the number of processes parallel_map runs the n_tasks tasks in with n_workers, 1 if they run serially.
+    """
+    if n_workers is None or n_workers<=1 or n_tasks<=1 or multiprocessing.current_process().daemon:
+        return 1
+    return min(n_workers, n_tasks)
+
+
+def parallel_map(function, args_list, n_workers=1):
+    """
+    Calls function(*args) for each tuple args in args_list using n_workers
+    processes and returns the list of results in the order of args_list.
+    The function has to be defined at module level (to be picklable), and so
+    do the arguments and the results.
+    With one worker (or one task) everything runs serially in the current process,
+    and so it does inside a worker process of another pool (e.g. a JobScheduler
+    task), which cannot have child processes.
+    """
+    args_list = list(args_list)
+    log = Logger().getLogger('parallel_map', 10)
+    if n_workers is not None and n_workers>1 and multiprocessing.current_process().daemon:
+        log.warning('Running in a worker process, the {0} tasks run serially.'.format(len(args_list)))
+        n_workers = 1
+    n_processes = get_n_processes(n_workers, len(args_list))
+    if n_processes<=1:
+        log.debug('Running {0} tasks serially.'.format(len(args_list)))
+        return [function(*args) for args in args_list]
+
+    log.info('Running {0} tasks in {1} worker processes.'.format(len(args_list), n_processes))
+    pool = multiprocessing.Pool(processes=n_processes)
+    try:
+        results = pool.map(_apply, [(function, args) for args in args_list], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -1,6 +1,7 @@
 
 ###python efficiencyFactors_plestina_width.py --dir=/scratch/osghpc/dsperka/Analyzer/SubmitArea_8TeV/Trees_HZZFiducialSamples_Nov22/ --obsName=mass4l --obsBins="|105.0|140.0|" -l -q -b --modelName=SM
 import sys, os, string, re, pwd, commands, ast, optparse, shlex, time
+import glob, shutil, json
 from array import array
 from math import *
 from decimal import *
@@ -9,9 +10,27 @@ global sample_shortnames
 #from sample_shortnames_width import *
 from sample_shortnames import *
 
+import collections, copy
 from lib.util.Logger import *
+import numpy as np
 from lib.util.UniversalConfigParser import UniversalConfigParser
 from lib.plotting.RootPlotters import SimplePlotter
+from lib.RootHelpers.ColumnarTreeReader import ColumnarTreeReader, read_columns_from_file
+from lib.util.ProcessPool import parallel_map, get_n_processes
+from lib.util.JobScheduler import JobScheduler
+from lib.util.CpuResources import ParallelismPolicy
+from lib.fitting.ParametrizationGrid import ParametrizationGrid
+from lib.fitting.Toys import get_random_state, generate_dcb_values
+from lib.fitting.ParametrizationFit import MassPoint, SimultaneousDCBNLL, BinnedSimultaneousDCBNLL, BINNED_LIKELIHOODS, FitParameter, FitResult, ParametrizationFitter, get_dcb_params
+from lib.fitting.GoodnessOfFit import ChiSquareCalculator
+from lib.fitting.DoubleCB import DCB_PARAMETERS
+from lib.fitting.WarmStart import WarmStartStore, get_values_from_parametrization, apply_warm_start
+from lib.fitting.Closure import ClosureTest
+from lib.fitting.MultiStart import MULTI_START_METHODS, get_start_points, multi_start_fit, MultiStartSummary
+from lib.fitting.Resampling import RESAMPLING_METHODS, resampling_fit
+from lib.fitting.FitStages import FitStagePipeline, DEFAULT_FIT_STAGES
+from lib.RooFit.DataSetCache import get_shared_cache
+from lib.RooFit.FitResultCache import get_shared_fit_cache, get_data_fingerprint
 
 grootargs = []
 def callback_rootargs(option, opt, value, parser):
@@ -33,8 +52,35 @@ def parseOptions():
     parser.add_option('-f', '--doFit', action="store_true", dest='DOFIT', default=False, help='doFit, default false')
     parser.add_option('-p', '--doPlots', action="store_true", dest='DOPLOTS', default=False, help='doPlots, default false')
     parser.add_option('-g', '--generate',    dest='GENERATE_N',  type='float',default=0, help='Generate <N> events and use as fitting dataset.')
+    parser.add_option('',   '--generateParams',dest='GENERATE_PARAMS',    type='string',default='DCB_parametrization.yaml',   help='Parametrization (YAML) of the DCB parameters used to generate the -g toys, default DCB_parametrization.yaml')
+    parser.add_option('',   '--seed',dest='SEED',    type='int',default=1,   help='Seed of the random streams of the generated toys, default 1')
     parser.add_option('-s', '--finalState',dest='FINAL_STATE',    type='string', default='',   help='Comma separated list of final states, e.g. 2e2mu,2mu2e,4e,4mu Default: none')
-    parser.add_option('', '--doDatasets', action="store_true", dest='DO_DATASETS', default=False, help='Creates datasets and stores them to a workspace, default false')
+    parser.add_option('', '--doDatasets', action="store_true", dest='DO_DATASETS', default=False, help='Creates datasets and stores them to the dataset cache (and to a workspace), default false')
+    parser.add_option('',   '--datasetCache',dest='DATASET_CACHE',    type='string',default='dataset_cache.root',   help='File of the dataset cache, default dataset_cache.root')
+    parser.add_option('', '--clearDatasetCache', action="store_true", dest='CLEAR_DATASET_CACHE', default=False, help='Remove the dataset cache file (and the per-task files of --jobs) before the run, default false')
+    parser.add_option('',   '--fitCache',dest='FIT_CACHE',    type='string',default='fit_result_cache.root',   help='File of the fit result cache (fits with the same data, initial parameters and options are not repeated), empty string to always fit, default fit_result_cache.root')
+    parser.add_option('',   '--warmStart',dest='WARM_START',    type='string',default='',   help='Initial values of the simultaneous fit parameters: "last" (the last stored fit result of the channel and bins) or a parametrization YAML file (e.g. DCB_parametrization.yaml), default none (the built-in values). With "last" the fit result cache misses when the stored result changed')
+    parser.add_option('',   '--warmStartDir',dest='WARM_START_DIR',    type='string',default='warm_start',   help='Directory where the results of the simultaneous fits are stored for --warmStart last, default warm_start')
+    parser.add_option('', '--checkDuplicates', action="store_true", dest='CHECK_DUPLICATES', default=False, help='Skip duplicate run/lumi/event entries of the input trees, default false')
+    parser.add_option('',   '--slimDir',dest='SLIM_DIR',    type='string',default='',   help='Directory of the slim ntuples (selected events, needed branches only) made once and read instead of the sample files, default none (read the sample files)')
+    parser.add_option('',   '--slimBranches',dest='SLIM_BRANCHES',    type='string',default='',   help='Comma separated list of additional branches (or patterns) kept in the slim ntuples')
+    parser.add_option('', '--columnar', action="store_true", dest='COLUMNAR', default=False, help='Read only the branches needed by cuts and observables into arrays to build the datasets, default false')
+    parser.add_option('',   '--extractWorkers',dest='EXTRACT_WORKERS',    type='int',default=1,   help='Number of worker processes extracting the datasets of all mass points and final states before the fits, default 1 (no parallel extraction)')
+    parser.add_option('',   '--engine',dest='FIT_ENGINE',    type='choice', choices=['roofit', 'numpy'], default='roofit',   help='Fit engine for the simultaneous fit: roofit (RooDoubleCB from CMSSW) or numpy (no CMSSW needed), default roofit')
+    parser.add_option('', '--binned', action="store_true", dest='BINNED', default=False, help='Fit histograms of the mass points (see --fitBins and --binnedLikelihood) instead of the unbinned datasets, default false')
+    parser.add_option('',   '--fitBins',dest='FIT_BINS',    type='int',default=700,   help='Number of bins between m4l_low and m4l_high for the --binned fit, default 700')
+    parser.add_option('',   '--binnedLikelihood',dest='BINNED_LIKELIHOOD',    type='choice', choices=['poisson', 'chi2'], default='poisson',   help='Likelihood of the --binned fit: poisson or chi2 (weighted chi2), default poisson')
+    parser.add_option('', '--compareUnbinned', action="store_true", dest='COMPARE_UNBINNED', default=False, help='With --binned, repeat each fit unbinned and report the shifts of the parameters, default false')
+    parser.add_option('-j', '--jobs',dest='JOBS',    type='int',default=1,   help='Number of channel/recobin/genbin tasks running at the same time in separate processes, default 1 (serial)')
+    parser.add_option('',   '--cpus',dest='CPUS',    type='int',default=0,   help='Number of CPUs to use in total, default 0 (detect from the CPU affinity and the cgroup quota)')
+    parser.add_option('',   '--fitCpus',dest='FIT_CPUS',    type='int',default=0,   help='Number of CPUs for the NLL evaluation of each fit (RooFit.NumCPU), default 0 (the CPUs divided between the --jobs tasks)')
+    parser.add_option('',   '--jobLogDir',dest='JOB_LOG_DIR',    type='string',default='logs',   help='Directory for the logs of the tasks run with --jobs, default logs')
+    parser.add_option('',   '--multiStart',dest='MULTI_START',    type='int',default=1,   help='Number of starting points of each fit (run in parallel with the --fitCpus CPUs), the converged fit with the lowest NLL is kept, default 1 (single fit)')
+    parser.add_option('',   '--multiStartMethod',dest='MULTI_START_METHOD',    type='choice', choices=['lhs', 'jitter'], default='lhs',   help='Starting points of --multiStart: lhs (latin hypercube of the parameter ranges) or jitter (around the initial values), default lhs')
+    parser.add_option('',   '--fitStages',dest='FIT_STAGES',    type='string',default='',   help='Config file (e.g. fit_stages.yaml) of the fit stages of the simultaneous fit (mass points, floating and fixed parameters, ranges from earlier stages), default none (the built-in stages: 125 GeV with frozen slopes, then all mass points)')
+    parser.add_option('',   '--resample',dest='RESAMPLE',    type='choice', choices=RESAMPLING_METHODS, default=None,   help='Uncertainties of the simultaneous fit parameters from refits of resampled mass points: bootstrap (Poisson weights of the events) or toys (generated from the fitted DCB), default none')
+    parser.add_option('',   '--replicas',dest='REPLICAS',    type='int',default=100,   help='Number of bootstrap or toy replicas of --resample (drawn with --seed, fitted in parallel on the --fitCpus CPUs), default 100')
+    parser.add_option('', '--singlePass', action="store_true", dest='SINGLE_PASS', default=False, help='Extract datasets for all final states given with -s in a single pass over each tree, default false')
     parser.add_option('',   '--closureParams',dest='CLOSURE_TEST',    type='string',default='',   help='Provide parametrization dictionary (cfg file, e.g. YAML).')
     parser.add_option('', '--doClosure', action="store_true", dest='DOCLOSURE', default=False, help='doPlots, default false')
     parser.add_option("-l",action="callback",callback=callback_rootargs)
@@ -58,7 +104,8 @@ if (not os.path.exists("plots") and doPlots):
 
 from ROOT import *
 from LoadData_dsperka_DCB_parameters import *
-LoadData(opt.SOURCEDIR)
+import LoadData_dsperka_DCB_parameters  #the settings of LoadData (e.g. CheckDuplicates) are read from the module, the star import has copies made before LoadData
+LoadData(opt.SOURCEDIR, opt.CHECK_DUPLICATES, opt.SLIM_DIR, [branch for branch in opt.SLIM_BRANCHES.split(',') if branch])
 save = ""
 
 RooMsgService.instance().setGlobalKillBelow(RooFit.WARNING)
@@ -74,6 +121,27 @@ class SignalSpectrumFitter(object):
     Fitting of the m4l distribution.
     Plotting components for the cross section study.
     """
+    _single_pass_datasets = {}  #{dataset cache key (json) : RooDataSet} shared between fitters of different channels
+
+    #p0, p1 parameters of the DCB parameters {name : (initial value, min, max)}
+    #idea is to make a linear expansion around mH=125
+    #*_p0 is an intersection with y-axis of parametere(mH-125) dependance
+    #*_p1 is a slope of parametere(mH-125) dependance
+    _dcb_param_init = collections.OrderedDict([
+                        ('mean_p0',   (125, 120, 130)),
+                        ('mean_p1',   (1, 0.9, 1.1)),
+                        ('sigma_p0',  (1.63, 1, 3)),
+                        ('sigma_p1',  (0, -0.5, 0.5)),
+                        ('alpha_p0',  (0.96, 0, 10)),
+                        ('alpha_p1',  (0, -0.5, 0.5)),
+                        ('n_p0',      (4.51, 0, 10)),
+                        ('n_p1',      (0, -10, 10)),
+                        ('alpha2_p0', (1.4, 0, 10)),
+                        ('alpha2_p1', (0, -0.5, 0.5)),
+                        ('n2_p0',     (20, -50, 50)),
+                        ('n2_p1',     (0, -0.5, 0.5)),
+                        ])
+
     def __init__(self,channel=None, List=None, m4l_bins=None, m4l_low=None, m4l_high=None, obs_reco=None, obs_gen=None, obs_bins=None, recobin=None, genbin=None):
         """Basic definitin, initializtion"""
         self.log = Logger().getLogger(self.__class__.__name__, 10)
@@ -107,7 +175,7 @@ class SignalSpectrumFitter(object):
 
     def datasets_exists(self, exists):
         """
-        If set, the RooDataSet from a workspace is expected.
+        If set, the RooDataSet from the dataset cache is expected (missing or stale ones are rebuilt).
         """
         self.use_dataset_from_ws = exists
 
@@ -150,6 +218,18 @@ class SignalSpectrumFitter(object):
 
         self.cut_2e2mu_ord= '(abs(idL1)==abs(idL2) && abs(idL3)==abs(idL4) && (abs(idL1)==11 && abs(idL3)==13))'
         self.cut_2mu2e_ord= '(abs(idL1)==abs(idL2) && abs(idL3)==abs(idL4) && (abs(idL1)==13 && abs(idL3)==11))'
+        self.cut_4e_flav  = '(abs(idL1)==11 && abs(idL2)==11 && abs(idL3)==11 && abs(idL4)==11)'
+        self.cut_4mu_flav = '(abs(idL1)==13 && abs(idL2)==13 && abs(idL3)==13 && abs(idL4)==13)'
+        self.cut_2e2mu_flav = '((abs(idL1)+abs(idL2)+abs(idL3)+abs(idL4))==48)'  #two electrons (11) and two muons (13)
+
+        #reco lepton flavour definition of each final state (used to give a channel code to events)
+        self.cutchan_reco = {
+                            '4e'              : self.cut_4e_flav,
+                            '4mu'             : self.cut_4mu_flav,
+                            '2e2mu'           : self.cut_2e2mu_ord,
+                            '2mu2e'           : self.cut_2mu2e_ord,
+                            '2e2mu_inclusive' : self.cut_2e2mu_flav,
+                            }
 
         self.cutobs_reco = "("+self.obs_reco+">="+str(self.obs_reco_low)+" && "+self.obs_reco+"<"+str(self.obs_reco_high)+")"
         self.cutobs_gen = "("+self.obs_gen+">="+str(self.obs_gen_low)+" && "+self.obs_gen+"<"+str(self.obs_gen_high)+")"
@@ -243,6 +323,192 @@ class SignalSpectrumFitter(object):
 
 
 
+    def _get_mass_var(self, channel):
+        """
+        Returns the m4l RooRealVar for the final state (mass4e, mass4mu or mass2e2mu).
+        """
+        mass_suffix = channel
+        if channel in ["2e2mu_inclusive", "2e2mu","2mu2e"]:
+                mass_suffix = "2e2mu"
+        return RooRealVar("mass"+mass_suffix, "mass"+mass_suffix, self.m4l_low, self.m4l_high)
+
+
+    def _get_observable(self):
+        """
+        Returns the RooRealVar of the reco observable. Needs _set_cuts to be called before.
+        """
+        if (self.obs_reco.startswith('abs')):
+            self.obs_reco_noabs = self.obs_reco.replace('abs(','').replace(')','')
+            observable = RooRealVar(self.obs_reco_noabs, self.obs_reco_noabs, -1.0*max(float(self.obs_reco_high), float(self.obs_gen_high)), max(float(self.obs_reco_high), float(self.obs_gen_high)))
+        else:
+            observable = RooRealVar(self.obs_reco, self.obs_reco, max(float(self.obs_reco_low), float(self.obs_gen_low)), max(float(self.obs_reco_high), float(self.obs_gen_high)))
+        return observable
+
+
+    def _get_reco_selection(self, channel):
+        """
+        Returns tuple (tree_selection, cutobs_reco) used to extract the dataset
+        for the channel. Needs _set_cuts to be called before.
+        The reco flavour of the channel (cutchan_reco) is part of the selection for all
+        channels, so that the per-channel and the single-pass extraction (which gives
+        each event the channels of its flavours) select the same events.
+        """
+        tree_selection = "passedFullSelection==1"
+        if channel in self.cutchan_reco:
+            tree_selection += " && ({0})".format(self.cutchan_reco[channel])
+
+        cutobs_reco = self.cutobs_reco
+        if (channel == "4e"):
+            cutobs_reco = cutobs_reco.replace('mass4l','mass4e')
+        if (channel == "4mu"):
+            cutobs_reco = cutobs_reco.replace('mass4l','mass4mu')
+        return (tree_selection, cutobs_reco)
+
+
+    def get_tree_expressions(self, channel):
+        """
+        Returns the expressions read from the passedEvents trees of all the samples for the
+        channel: the selections, the flavour and observable cuts, the mass, the observable and
+        the weight (e.g. to know which branches the slim ntuples have to keep).
+        """
+        expressions = []
+        for Sample in self.List:
+            self._set_cuts(channel, Sample)
+            expressions+=list(self._get_reco_selection(channel))
+            expressions+=[self.cutchan_reco.get(channel), self._get_mass_var(channel).GetName(), self._get_observable().GetName(), self.recoweight]
+        return [expression for expression in collections.OrderedDict.fromkeys(expressions) if expression]
+
+
+    def set_single_pass_channels(self, channels):
+        """
+        If set, the datasets for all the 'channels' are extracted in one pass
+        over each tree and shared between the fitters of different channels.
+        """
+        self.single_pass_channels = channels
+
+
+    def set_columnar_reader(self, use_columnar_reader):
+        """
+        If set, the datasets are built from numpy arrays with only the needed
+        branches read from the tree instead of copying the full tree.
+        """
+        self.use_columnar_reader = use_columnar_reader
+
+
+    def set_dataset_cache(self, file_name, fallback_file_name=''):
+        """
+        Set the file of the content-addressed dataset cache (see DataSetCache). The datasets
+        missing in it are looked up in fallback_file_name (read-only), if given.
+        """
+        self.dataset_cache_file = file_name
+        self.dataset_cache_fallback = fallback_file_name
+
+
+    def _get_dataset_cache(self):
+        return get_shared_cache(getattr(self, 'dataset_cache_file', 'dataset_cache.root'), getattr(self, 'dataset_cache_fallback', ''))
+
+
+    def _get_dataset_cache_key(self, Sample, channel, massHiggs):
+        """
+        Returns the dictionary with everything the dataset depends on: identity of
+        the input file, the cut strings from _set_cuts and the observable binning
+        and range (entries outside of the observable range are not in the dataset).
+        """
+        self._set_cuts(channel, Sample)
+        tree_selection, cutobs_reco = self._get_reco_selection(channel)
+        observable = self._get_observable()
+        input_file = SampleFiles.get(Sample, Sample)
+        return {
+                'input_file'     : [input_file, GetFileIdentity(input_file)],
+                'channel'        : channel,
+                'MH'             : massHiggs,
+                'tree_selection' : tree_selection,
+                'cutobs_reco'    : cutobs_reco,
+                'cutchan_reco'   : self.cutchan_reco.get(channel),
+                'recoweight'     : self.recoweight,
+                'unique_events'  : LoadData_dsperka_DCB_parameters.CheckDuplicates,
+                'm4l_binning'    : [self.m4l_low, self.m4l_high, self.m4l_bins],
+                'obs_binning'    : [self.obs_reco, self.obs_gen, list(self.obs_bins)],
+                'obs_range'      : [observable.GetName(), observable.getMin(), observable.getMax()],
+                }
+
+
+    def get_stage_key(self, channel):
+        """
+        Returns the dictionary with everything the fits of the channel depend on: the
+        cache keys of the datasets of all samples. The genbin enters only through them
+        (the range of the observable), so the fitters of the gen bins with the same key
+        give the same results and only one of them has to run (see run_fitter_task).
+        """
+        return {
+                'channel'  : channel,
+                'datasets' : [self._get_dataset_cache_key(Sample, channel, self._get_sample_mass(Sample)) for Sample in self.List],
+                }
+
+
+    def _get_dataset(self, Sample, channel, massHiggs):
+        """
+        Returns the RooDataSet for the sample and channel. If datasets are expected
+        to exist (datasets_exists), the dataset is taken from the dataset cache,
+        and only missing or stale entries are rebuilt. Otherwise the dataset is
+        rebuilt and the cache entry refreshed.
+        Generated toys (see generate_dataset) replace the datasets.
+        """
+        if (channel, massHiggs) in getattr(self, 'generated_values', {}):
+            return self._get_generated_dataset(Sample, channel, massHiggs)
+        cache = self._get_dataset_cache()
+        cache_key = self._get_dataset_cache_key(Sample, channel, massHiggs)
+        if self.use_dataset_from_ws:
+            dataset = cache.get(cache_key)
+            if dataset:
+                self.log.info('Using RooDataSet {0} from cache {1}'.format(dataset.GetName(), cache.file_name))
+                self._set_cuts(channel, Sample)
+                return dataset
+            self.log.info('No up-to-date RooDataSet in cache for sample={0}, channel={1}. It will be rebuilt.'.format(Sample, channel))
+
+        dataset = self._build_dataset(Sample, channel, massHiggs)
+        if dataset:
+            cache.put(cache_key, dataset)
+        return dataset
+
+
+    def _build_dataset(self, Sample, channel, massHiggs):
+        """
+        Returns the RooDataSet for the sample and channel either from the (parallel)
+        multi-channel extraction or with a dedicated extraction.
+        """
+        key = self._get_single_pass_key(Sample, channel, massHiggs)
+        if key in SignalSpectrumFitter._single_pass_datasets:
+            self.log.info('Using already extracted RooDataSet: sample={0}, channel={1}, MH={2}'.format(Sample, channel, int(massHiggs)) )
+            self._set_cuts(channel, Sample)
+            return SignalSpectrumFitter._single_pass_datasets[key]
+
+        if (not getattr(self, 'single_pass_channels', None)) or (not channel in self.single_pass_channels):
+            if getattr(self, 'use_columnar_reader', False):
+                return self._prepare_datasets_all_channels(Sample, [channel], massHiggs).get(channel)
+            return self._prepare_datasets(Sample, channel, massHiggs)
+
+        self._keep_single_pass_datasets(Sample, self._prepare_datasets_all_channels(Sample, self.single_pass_channels, massHiggs), massHiggs)
+        self._set_cuts(channel, Sample)
+        return SignalSpectrumFitter._single_pass_datasets.get(key)
+
+
+    def _get_single_pass_key(self, Sample, channel, massHiggs):
+        """
+        Returns the key of the dataset in _single_pass_datasets: the dataset cache key, so that the datasets
+        of other bins or observable ranges (e.g. of another genbin) are never mixed up.
+        """
+        return json.dumps(self._get_dataset_cache_key(Sample, channel, massHiggs), sort_keys=True)
+
+
+    def _keep_single_pass_datasets(self, Sample, datasets, massHiggs):
+        """
+        Keeps the datasets {channel : RooDataSet} of the sample in _single_pass_datasets.
+        """
+        for channel, dataset in datasets.iteritems():
+            SignalSpectrumFitter._single_pass_datasets[self._get_single_pass_key(Sample, channel, massHiggs)] = dataset
+
+
     def _prepare_datasets(self, Sample, channel, massHiggs):
         """
         Extract RooDataSet from a tree with given cuts for given final state.
@@ -259,27 +525,12 @@ class SignalSpectrumFitter(object):
         if (self.recoweight=="totalWeight"): genweight = "19712.0*scaleWeight/"+str(nEvents[Sample])
         else: genweight = "1.0"
 
-
-        if (self.obs_reco.startswith('abs')):
-            self.obs_reco_noabs = self.obs_reco.replace('abs(','').replace(')','')
-            observable = RooRealVar(self.obs_reco_noabs, self.obs_reco_noabs, -1.0*max(float(self.obs_reco_high), float(self.obs_gen_high)), max(float(self.obs_reco_high), float(self.obs_gen_high)))
-        else:
-            observable = RooRealVar(self.obs_reco, self.obs_reco, max(float(self.obs_reco_low), float(self.obs_gen_low)), max(float(self.obs_reco_high), float(self.obs_gen_high)))
+        observable = self._get_observable()
 
         dataset_name = 'dataset_sig_{0}_{1}'.format(channel, int(massHiggs))
 
-        if (channel == "4e"):
-            dataset_sig  = RooDataSet(dataset_name,dataset_name, TreesPassedEvents[Sample].CopyTree("passedFullSelection==1"), RooArgSet(self.mass4l,self.rrv_recoweight,observable), self.cutobs_reco.replace("abs","fabs").replace('mass4l','mass4e'), self.rrv_recoweight.GetName())
-
-        if (channel == "4mu"):
-            dataset_sig  = RooDataSet(dataset_name,dataset_name, TreesPassedEvents[Sample].CopyTree("passedFullSelection==1"), RooArgSet(self.mass4l,self.rrv_recoweight,observable), self.cutobs_reco.replace("abs","fabs").replace('mass4l','mass4mu'), self.rrv_recoweight.GetName())
-
-        if (channel == "2e2mu_inclusive"):
-            dataset_sig  = RooDataSet(dataset_name,dataset_name, TreesPassedEvents[Sample].CopyTree("passedFullSelection==1"), RooArgSet(self.mass4l,self.rrv_recoweight,observable), self.cutobs_reco.replace("abs","fabs"), self.rrv_recoweight.GetName())
-        if (channel == "2e2mu"):
-            dataset_sig  = RooDataSet(dataset_name,dataset_name, TreesPassedEvents[Sample].CopyTree("passedFullSelection==1 && ({0})".format(self.cut_2e2mu_ord)), RooArgSet(self.mass4l,self.rrv_recoweight,observable), self.cutobs_reco.replace("abs","fabs"), self.rrv_recoweight.GetName())
-        if (channel == "2mu2e"):
-            dataset_sig  = RooDataSet(dataset_name,dataset_name, TreesPassedEvents[Sample].CopyTree("passedFullSelection==1 && ({0})".format(self.cut_2mu2e_ord)), RooArgSet(self.mass4l,self.rrv_recoweight,observable), self.cutobs_reco.replace("abs","fabs"), self.rrv_recoweight.GetName())
+        tree_selection, cutobs_reco = self._get_reco_selection(channel)
+        dataset_sig  = RooDataSet(dataset_name,dataset_name, TreesPassedEvents[Sample].CopyTree(tree_selection), RooArgSet(self.mass4l,self.rrv_recoweight,observable), cutobs_reco.replace("abs","fabs"), self.rrv_recoweight.GetName())
 
         self.log.info('Created the dataset: Sample={0}, channel={1}, is_weighted={2}, sum_entries={3}'.format(Sample, channel,dataset_sig.isWeighted(), dataset_sig.sumEntries()))
         if self.DEBUG:
@@ -287,6 +538,172 @@ class SignalSpectrumFitter(object):
         return dataset_sig
 
 
+    def _prepare_datasets_all_channels(self, Sample, channels, massHiggs):
+        """
+        Extract RooDataSets for several final states with a single pass over the tree.
+        Only the branches needed by the cuts and by the dataset variables are read
+        into numpy arrays (ColumnarTreeReader). Each event passing the full selection
+        gets a channel code from the lepton flavours (one bit per channel, since
+        2e2mu_inclusive overlaps with 2e2mu and 2mu2e) and is filled into the
+        datasets of all channels it belongs to.
+
+        Returns:
+        --------
+        dictionary {channel : RooDataSet}
+        """
+        self.log.info('Extracting RooDataSets in a single pass: sample={0}, channels={1}, MH={2}'.format(Sample, channels, int(massHiggs)) )
+
+        if (not Sample in TreesPassedEvents): return {}
+        if (not TreesPassedEvents[Sample]): return {}
+        tree = TreesPassedEvents[Sample]
+
+        columns, channels_setup = self._get_channels_columns(Sample, channels)
+        arrays = ColumnarTreeReader().read(tree, columns, selection='passedFullSelection==1')
+        return self._get_datasets_from_columns(Sample, channels_setup, arrays, massHiggs)
+
+
+    def _get_channels_columns(self, Sample, channels):
+        """
+        Returns the list of columns to read from the tree for the channels and
+        the per-channel setup (channel bit code, flavour and observable cut columns,
+        dataset variables) used by _get_datasets_from_columns.
+        """
+        columns = []
+        channels_setup = collections.OrderedDict()
+        for bit, channel in enumerate(channels):
+            self._set_cuts(channel, Sample)
+            if not channel in self.cutchan_reco:
+                self.log.warning('No reco flavour definition for channel={0}. It will not be extracted in the single pass.'.format(channel))
+                continue
+            tree_selection, cutobs_reco = self._get_reco_selection(channel)
+            channels_setup[channel] = {
+                'code'      : 1<<bit,
+                'flavour'   : self.cutchan_reco[channel],
+                'cutobs'    : cutobs_reco,
+                'vars'      : [self._get_mass_var(channel), self._get_observable()],
+                'weight'    : RooRealVar(self.recoweight, self.recoweight, 0.0, 10.0),
+                }
+            columns+=[self.cutchan_reco[channel], cutobs_reco]
+            columns+=[var.GetName() for var in channels_setup[channel]['vars']+[channels_setup[channel]['weight']]]
+        return (list(collections.OrderedDict.fromkeys(columns)), channels_setup)
+
+
+    def _get_datasets_from_columns(self, Sample, channels_setup, arrays, massHiggs):
+        """
+        Builds the RooDataSets of all the channels from the columns read from the tree.
+
+        Returns:
+        --------
+        dictionary {channel : RooDataSet}
+        """
+        n_selected = len(arrays.values()[0]) if len(arrays) else 0
+        self.log.info('Building datasets from columns: sample={0}, passedFullSelection={1}'.format(Sample, n_selected))
+
+        channel_code = np.zeros(n_selected, dtype=np.int32)
+        for channel, setup in channels_setup.iteritems():
+            channel_code[arrays[setup['flavour']]!=0] |= setup['code']
+
+        reader = ColumnarTreeReader()
+        datasets = {}
+        for channel, setup in channels_setup.iteritems():
+            dataset_name = 'dataset_sig_{0}_{1}'.format(channel, int(massHiggs))
+            mask = ((channel_code & setup['code'])!=0) & (arrays[setup['cutobs']]!=0)
+            datasets[channel] = reader.get_RooDataSet(dataset_name, setup['vars'], arrays, weight_var = setup['weight'], mask = mask)
+            self.log.info('Created the dataset: Sample={0}, channel={1}, is_weighted={2}, sum_entries={3}'.format(Sample, channel, datasets[channel].isWeighted(), datasets[channel].sumEntries()))
+            if self.DEBUG:
+                datasets[channel].Print('v')
+        return datasets
+
+
+    def _get_sample_mass(self, Sample):
+        """
+        Returns the Higgs mass of the sample from its short name (e.g. ..._125p6_... gives 125.6)
+        """
+        mh = sample_shortnames[Sample].split("_")
+        mass = ""
+        for i in range(len(mh)):
+            if mh[i].startswith("1"): mass = mh[i]
+        if (mass=="125p6"): mass="125.6"
+        return ast.literal_eval(mass)
+
+
+    def generate_dataset(self, n_events, params_cfg='DCB_parametrization.yaml', seed=1):
+        """
+        Generates n_events toy m4l values for each mass point from the DCB parametrization
+        of the channel in params_cfg (YAML), by inverse-CDF sampling (lib/fitting/Toys.py).
+        Each mass point has its own random stream given by the seed, the channel, the reco bin
+        and MH, so the toys are reproducible. The toys replace the MC datasets in the fits.
+        """
+        channel = self.channel
+        MH_values = [self._get_sample_mass(Sample) for Sample in self.List]
+        #the DCB parameters of all mass points at once
+        dcb_table = ParametrizationGrid(params_cfg, [channel]).get_parameter_table(MH_values)[channel]
+        self.generated_values = {}
+        self.generated_datasets = {}
+        for MH_idx, massHiggs in enumerate(MH_values):
+            random_state = get_random_state(seed, 'toy', channel, self.recobin, massHiggs)
+            dcb_params = tuple([float(dcb_table[dcb_par][MH_idx]) for dcb_par in DCB_PARAMETERS])
+            self.generated_values[(channel, massHiggs)] = generate_dcb_values(dcb_params, n_events, self.m4l_low, self.m4l_high, random_state)
+            self.log.info('Generated {0} toy events for channel={1}, MH={2} with DCB parameters {3} from {4}'.format(int(n_events), channel, massHiggs, dcb_params, params_cfg))
+
+
+    def _get_generated_dataset(self, Sample, channel, massHiggs):
+        """
+        Returns RooDataSet (unit weights) of the toys made by generate_dataset.
+        """
+        self._set_cuts(channel, Sample)
+        if not (channel, massHiggs) in self.generated_datasets:
+            mass_var = self._get_mass_var(channel)
+            weight_var = RooRealVar(self.recoweight, self.recoweight, 0.0, 10.0)
+            values = self.generated_values[(channel, massHiggs)]
+            arrays = {mass_var.GetName() : values, weight_var.GetName() : np.ones_like(values)}
+            dataset_name = 'dataset_toy_{0}_{1}'.format(channel, int(massHiggs))
+            self.generated_datasets[(channel, massHiggs)] = ColumnarTreeReader().get_RooDataSet(dataset_name, [mass_var], arrays, weight_var)
+        return self.generated_datasets[(channel, massHiggs)]
+
+
+    def set_extraction_workers(self, n_workers):
+        """
+        Number of worker processes for extract_datasets_parallel.
+        """
+        self.extraction_workers = n_workers
+
+
+    def extract_datasets_parallel(self, channels):
+        """
+        Fan the extraction of the datasets of all the mass points and channels out
+        to worker processes. The workers only read the needed columns into numpy
+        arrays (read_columns_from_file), the RooDataSets are built from the arrays
+        here, stored to the dataset cache and kept for _build_dataset.
+        If datasets are expected to exist, only missing cache entries are extracted.
+        With one worker the extraction runs serially.
+        """
+        n_workers = getattr(self, 'extraction_workers', 1)
+        cache = self._get_dataset_cache()
+
+        tasks = []
+        tasks_setup = []
+        for Sample in self.List:
+            if not Sample in SampleFiles: continue
+            massHiggs = self._get_sample_mass(Sample)
+            missing_channels = [channel for channel in channels if not self._get_single_pass_key(Sample, channel, massHiggs) in SignalSpectrumFitter._single_pass_datasets]
+            if self.use_dataset_from_ws:
+                missing_channels = [channel for channel in missing_channels if not cache.get(self._get_dataset_cache_key(Sample, channel, massHiggs))]
+            if not missing_channels: continue
+            columns, channels_setup = self._get_channels_columns(Sample, missing_channels)
+            tasks.append((GetSampleTreeFile(Sample), PassedEventsTreeName, columns, 'passedFullSelection==1', LoadData_dsperka_DCB_parameters.CheckDuplicates))
+            tasks_setup.append((Sample, massHiggs, channels_setup))
+
+        self.log.info('Extracting datasets for {0} samples with {1} workers: channels={2}, recobin={3}'.format(len(tasks), n_workers, channels, self.recobin))
+        results = parallel_map(read_columns_from_file, tasks, n_workers)
+
+        for (Sample, massHiggs, channels_setup), arrays in zip(tasks_setup, results):
+            datasets = self._get_datasets_from_columns(Sample, channels_setup, arrays, massHiggs)
+            self._keep_single_pass_datasets(Sample, datasets, massHiggs)
+            for channel, dataset in datasets.iteritems():
+                cache.put(self._get_dataset_cache_key(Sample, channel, massHiggs), dataset)
+
+
     def make_chisqaure_plot(self, name, values, x_title='x', y_title='y'):
         """
         Plot 2D graph from 'values' provided as list of 2D tuples.
@@ -317,11 +734,627 @@ class SignalSpectrumFitter(object):
 
 
 
+    def set_fit_engine(self, fit_engine):
+        """
+        Set the engine for fit_simultaneously: 'roofit' (RooDoubleCB from CMSSW) or
+        'numpy' (lib/fitting, no CMSSW needed).
+        """
+        if not fit_engine in ['roofit', 'numpy']:
+            raise ValueError, 'Unknown fit engine {0}. Use roofit or numpy.'.format(fit_engine)
+        self.fit_engine = fit_engine
+
+
+    def get_fit_summary(self):
+        """
+        Returns picklable summary of the fitter: the channel and bins, the fitted parameters
+        {name : (value, error)} of the last fit (empty if there was no fit) and the chi-square values.
+        """
+        parameters = collections.OrderedDict()
+        fit_result = getattr(self, 'r', None)
+        if isinstance(fit_result, FitResult):
+            for par_name, par in fit_result.parameters.iteritems():
+                parameters[par_name] = (par.value, par.error)
+        elif fit_result:
+            float_params = fit_result.floatParsFinal()
+            for idx in range(float_params.getSize()):
+                parameters[float_params[idx].GetName()] = (float_params[idx].getVal(), float_params[idx].getError())
+        summary = {'channel' : self.channel, 'recobin' : self.recobin, 'genbin' : self.genbin,
+                   'parameters' : parameters, 'chi_square_values' : copy.deepcopy(getattr(self, 'chi_square_values', []))}
+        if getattr(self, 'resampling_summary', None):
+            summary['resampling'] = self.resampling_summary.to_dict()
+        return summary
+
+
+    def set_fit_cpus(self, fit_cpus):
+        """
+        Set the number of CPUs for the NLL evaluation of each fit (RooFit.NumCPU), see ParallelismPolicy.
+        """
+        self.fit_cpus = fit_cpus
+
+
+    def get_fit_cpus(self):
+        return getattr(self, 'fit_cpus', 1)
+
+
+    def set_binned_fit(self, n_bins, likelihood='poisson', compare_unbinned=False):
+        """
+        Fit histograms with n_bins bins between m4l_low and m4l_high instead of the
+        unbinned datasets (n_bins=0 for the unbinned fits). The likelihood is 'poisson'
+        or 'chi2' (weighted chi2). With compare_unbinned, each fit is repeated unbinned
+        from the same starting point and the shifts of the parameters are reported.
+        """
+        if not likelihood in BINNED_LIKELIHOODS:
+            raise ValueError, 'Unknown binned likelihood {0}. Use one of {1}.'.format(likelihood, BINNED_LIKELIHOODS)
+        self.fit_bins = n_bins
+        self.binned_likelihood = likelihood
+        self.compare_unbinned = compare_unbinned
+
+
+    def _report_binned_shifts(self, shifts):
+        """
+        Print the shifts of the binned fit result from the unbinned one.
+        shifts = [(parameter name, binned value, unbinned value, unbinned error)]
+        """
+        self.log.info('Shifts of the binned fit ({0} bins, {1}) from the unbinned fit:'.format(self.fit_bins, self.binned_likelihood))
+        max_pull = 0.
+        for par_name, binned_value, unbinned_value, unbinned_error in shifts:
+            pull = 0.
+            if unbinned_error > 0: pull = (binned_value-unbinned_value)/unbinned_error
+            max_pull = max(max_pull, abs(pull))
+            print '    {0:12s} binned = {1: .6g}, unbinned = {2: .6g} +/- {3:.3g}, shift = {4: .3g} ({5: .2f} sigma)'.format(par_name,
+                                    binned_value, unbinned_value, unbinned_error, binned_value-unbinned_value, pull)
+        self.log.info('Largest shift = {0:.2f} sigma of the unbinned fit.'.format(max_pull))
+
+
+    def set_warm_start(self, source, store_dir='warm_start'):
+        """
+        Set the initial values of the p0, p1 parameters of the simultaneous fit: 'last' for the last
+        stored fit result of the channel and bins, a parametrization YAML file,
+        or empty string for the built-in values (_dcb_param_init). The results of the simultaneous
+        fits are stored to store_dir.
+        """
+        self.warm_start = source
+        self.warm_start_store = WarmStartStore(store_dir)
+
+
+    def _get_warm_start_name(self, channel):
+        """
+        Name of the stored fit result: the channel and bins. There is no fallback to other bins,
+        they are fitted at the same time with --jobs and the start would depend on their order.
+        """
+        return '{0}_{1}_genbin{2}_recobin{3}'.format(channel, opt.OBSNAME, self.genbin, self.recobin)
+
+
+    def _get_dcb_param_init(self, channel):
+        """
+        Returns (OrderedDict {p0/p1 parameter name : (initial value, min, max)}, {name : step size})
+        for the simultaneous fit, see set_warm_start. The ranges are always those of _dcb_param_init.
+        """
+        source = getattr(self, 'warm_start', '')
+        if not source:
+            return (self._dcb_param_init, {})
+        if source == 'last':
+            name = self._get_warm_start_name(channel)
+            stored = self.warm_start_store.get(name)
+            if stored:
+                self.log.info('Warm start from the stored fit result {0}.'.format(self.warm_start_store.get_file_name(name)))
+                return apply_warm_start(self._dcb_param_init,
+                                        dict([(par_name, value) for par_name, (value, error) in stored.iteritems()]),
+                                        dict([(par_name, error) for par_name, (value, error) in stored.iteritems()]))
+            self.log.warning('There is no stored fit result for {0}, using the built-in initial values.'.format(name))
+            return (self._dcb_param_init, {})
+        self.log.info('Warm start from the parametrization {0}.'.format(source))
+        formulas = UniversalConfigParser(cfg_type="YAML", file_list=source).get_dict()[channel]
+        return apply_warm_start(self._dcb_param_init, get_values_from_parametrization(formulas))
+
+
+    def _store_warm_start(self, channel, values, errors):
+        """
+        Stores the result {p0/p1 parameter name : value} (and errors) of the simultaneous fit for --warmStart last.
+        """
+        if getattr(self, 'warm_start_store', None):
+            self.warm_start_store.put(self._get_warm_start_name(channel), values, errors)
+
+
+    def set_multi_start(self, n_starts, method='lhs', seed=1):
+        """
+        Repeat each fit from n_starts starting points (the initial values and n_starts-1 points given
+        by the method 'lhs' or 'jitter', see get_start_points) in get_fit_cpus() worker processes
+        and keep the converged result with the lowest NLL. The starting points are given by the seed.
+        """
+        if not method in MULTI_START_METHODS:
+            raise ValueError, 'Unknown multi-start method {0}. Use one of {1}.'.format(method, MULTI_START_METHODS)
+        self.multi_start = n_starts
+        self.multi_start_method = method
+        self.multi_start_seed = seed
+
+
+    def set_resampling(self, method, n_replicas=100, seed=1):
+        """
+        Estimate the uncertainties of the simultaneous fit parameters from n_replicas refits of
+        resampled mass points (method 'bootstrap' or 'toys', see resampling_fit) in get_fit_cpus()
+        worker processes, empty method for no resampling. The replicas are given by the seed.
+        """
+        if method and not method in RESAMPLING_METHODS:
+            raise ValueError, 'Unknown resampling method {0}. Use one of {1}.'.format(method, RESAMPLING_METHODS)
+        self.resampling = method
+        self.n_replicas = n_replicas
+        self.resampling_seed = seed
+
+
+    def _estimate_resampling_uncertainties(self, channel, parameters, mass_points):
+        """
+        Refits the parameters (OrderedDict {name : FitParameter} of the simultaneous fit result) to the
+        replicas of the mass points (see set_resampling) and saves the summary of the spread and correlations.
+        The replicas are fitted in the ranges of _dcb_param_init: the ranges set by the fit stages (e.g. the
+        result +/- 1 sigma of an earlier stage) would clip the spread of the replicas.
+        """
+        if not getattr(self, 'resampling', ''):
+            return
+        parameters = copy.deepcopy(parameters)
+        for par_name, (init_value, min_value, max_value) in self._dcb_param_init.iteritems():
+            parameters[par_name].setRange(min_value, max_value)
+        self.log.info('Estimating uncertainties from {0} {1} replicas for channel={2}'.format(self.n_replicas, self.resampling, channel))
+        self.resampling_summary = resampling_fit(parameters, mass_points, self.m4l_low, self.m4l_high, self.resampling, self.n_replicas,
+                                                 self.resampling_seed, [channel, self.recobin, self.genbin], self.get_fit_cpus(),
+                                                 getattr(self, 'fit_bins', 0), getattr(self, 'binned_likelihood', 'poisson'))
+        if not os.path.exists('plots'):
+            os.makedirs('plots')
+        self.resampling_summary.save("plots/TEST11_RESAMPLING_"+self.resampling+"_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".json")
+
+
+    def set_fit_stages(self, file_name):
+        """
+        Set the config file of the fit stages of the simultaneous fit (see FitStagePipeline.from_file),
+        empty string for the built-in stages (DEFAULT_FIT_STAGES).
+        """
+        self.fit_stages_file = file_name
+
+
+    def get_fit_stages(self):
+        if getattr(self, 'fit_stages_file', ''):
+            return FitStagePipeline.from_file(self.fit_stages_file)
+        return FitStagePipeline(DEFAULT_FIT_STAGES)
+
+
+    def set_fit_cache(self, file_name, fallback_file_name=''):
+        """
+        Set the file of the fit result cache (see FitResultCache), empty string for no cache.
+        The results missing in it are looked up in fallback_file_name (read-only), if given.
+        """
+        self.fit_cache = None
+        if file_name:
+            self.fit_cache = get_shared_fit_cache(file_name, fallback_file_name)
+
+
+    def _get_fit_cache_key(self, engine, data_fingerprint, parameters, model='', steps=None):
+        """
+        Returns the key of the fit result cache: the dataset content, the initial values and
+        ranges of the parameters [(name, value, min, max, constant)], the frozen parameters,
+        the initial step sizes [(name, step)] of the minimizer (if it uses them), the m4l range
+        and the fit options.
+        """
+        cache_key = {'engine'      : engine,
+                    'model'       : model,
+                    'data'        : data_fingerprint,
+                    'parameters'  : sorted(parameters),
+                    'frozen'      : sorted([par[0] for par in parameters if par[4]]),
+                    'steps'       : sorted(steps or []),
+                    'm4l_range'   : [self.m4l_low, self.m4l_high],
+                    'fit_bins'    : getattr(self, 'fit_bins', 0),
+                    'likelihood'  : getattr(self, 'binned_likelihood', None),
+                    }
+        if getattr(self, 'multi_start', 1) > 1:
+            cache_key['multi_start'] = [self.multi_start, self.multi_start_method, self.multi_start_seed]
+        return cache_key
+
+
+    def _get_data_key(self, Sample, channel, massHiggs):
+        """
+        Returns what the events of the sample are made from, for the fit result cache: the dataset
+        cache key or, for the toys of generate_dataset, the hash of the generated values.
+        """
+        if (channel, massHiggs) in getattr(self, 'generated_values', {}):
+            return get_data_fingerprint([self.generated_values[(channel, massHiggs)]])
+        return self._get_dataset_cache_key(Sample, channel, massHiggs)
+
+
+    def _fit_numpy(self, parameters, mass_points, model=''):
+        """
+        Fit the parameters (numpy engine) to the mass points, unbinned or binned (see set_binned_fit).
+        The result is taken from the fit result cache if the same fit (of the model, e.g. the fit stage) was done before,
+        the binned fit is then still compared with the unbinned one if set.
+        """
+        fit_cache = getattr(self, 'fit_cache', None)
+        if fit_cache:
+            initial_parameters = copy.deepcopy(parameters)
+            data_fingerprint = get_data_fingerprint(sum([[[mass_point.MH], mass_point.x, mass_point.weights] for mass_point in mass_points], []))
+            cache_key = self._get_fit_cache_key('numpy', data_fingerprint,
+                                                [(par.name, par.value, par.min, par.max, par.constant) for par in parameters.values()], model)
+            result = fit_cache.get(cache_key, parameters)
+            if result:
+                self.log.info('Fit result (NLL={0}) taken from the fit result cache {1}.'.format(result.nll, fit_cache.file_name))
+                if getattr(self, 'fit_bins', 0) and self.compare_unbinned:
+                    self._compare_unbinned_numpy(initial_parameters, parameters, mass_points, result)
+                return result
+        result = self._fit_numpy_uncached(parameters, mass_points)
+        if fit_cache:
+            fit_cache.put(cache_key, result)
+        return result
+
+
+    def _minimize_numpy(self, parameters, nll, mass_points, sumw2_error=True):
+        """
+        Minimizes the NLL with respect to the parameters (numpy engine), from multiple starting points if set (see set_multi_start).
+        """
+        if getattr(self, 'multi_start', 1) <= 1:
+            return ParametrizationFitter(parameters).fit(nll, sumw2_error)
+        random_state = get_random_state(self.multi_start_seed, 'multi_start', self.channel, self.recobin, [mass_point.MH for mass_point in mass_points])
+        return multi_start_fit(parameters, nll, self.multi_start, self.multi_start_method, random_state, self.get_fit_cpus(), sumw2_error)[0]
+
+
+    def _fit_numpy_uncached(self, parameters, mass_points):
+        fit_bins = getattr(self, 'fit_bins', 0)
+        if not fit_bins:
+            return self._minimize_numpy(parameters, SimultaneousDCBNLL(mass_points, self.m4l_low, self.m4l_high), mass_points)
+
+        unbinned_parameters = copy.deepcopy(parameters)
+        nll = BinnedSimultaneousDCBNLL(mass_points, self.m4l_low, self.m4l_high, fit_bins, self.binned_likelihood)
+        #the weighted chi2 already has the errors of the weighted events
+        result = self._minimize_numpy(parameters, nll, mass_points, sumw2_error=(self.binned_likelihood != 'chi2'))
+        if self.compare_unbinned:
+            self._compare_unbinned_numpy(unbinned_parameters, parameters, mass_points, result)
+        return result
+
+
+    def _compare_unbinned_numpy(self, unbinned_parameters, parameters, mass_points, result):
+        """
+        Fits the unbinned_parameters (the initial values of the binned fit) unbinned and reports the shifts
+        of the binned result (parameters) from it, see set_binned_fit.
+        """
+        ParametrizationFitter(unbinned_parameters).fit(SimultaneousDCBNLL(mass_points, self.m4l_low, self.m4l_high))
+        self._report_binned_shifts([(par_name, parameters[par_name].value, unbinned_parameters[par_name].value, unbinned_parameters[par_name].error)
+                                    for par_name in result.floating])
+
+
+    def _fit_roofit(self, pdf, dataset, variables, data_keys):
+        """
+        Fit the pdf to the dataset, unbinned or binned (see set_binned_fit). For the binned
+        fit the dataset is filled into RooDataHist of the variables (the mass and the category).
+        The result is taken from the fit result cache if the same fit was done before,
+        the parameters of the pdf are then set to the stored values and errors. The dataset
+        enters the cache key by the data_keys (see _get_data_key) of its samples.
+        """
+        fit_cache = getattr(self, 'fit_cache', None)
+        if fit_cache:
+            params = RooArgList(pdf.getParameters(dataset))
+            params_state = []
+            params_steps = []
+            for idx in range(params.getSize()):
+                par = params[idx]
+                if isinstance(par, RooRealVar):
+                    params_state.append((par.GetName(), par.getVal(), par.getMin(), par.getMax(), bool(par.isConstant())))
+                    #Minuit starts with the errors as step sizes
+                    params_steps.append((par.GetName(), par.getError()))
+                else:
+                    params_state.append((par.GetName(), par.getVal(), par.getVal(), par.getVal(), True))
+            cache_key = self._get_fit_cache_key('roofit', data_keys, params_state, pdf.GetName(), params_steps)
+            result = fit_cache.get(cache_key)
+            if result:
+                self.log.info('Fit result of {0} (NLL={1}) taken from the fit result cache {2}.'.format(pdf.GetName(), result.minNll(), fit_cache.file_name))
+                float_params = result.floatParsFinal()
+                for idx in range(float_params.getSize()):
+                    par = params.find(float_params[idx].GetName())
+                    par.setVal(float_params[idx].getVal())
+                    par.setError(float_params[idx].getError())
+                if getattr(self, 'fit_bins', 0) and self.compare_unbinned:
+                    self._compare_unbinned_roofit(pdf, dataset, result)
+                return result
+        result = self._fit_roofit_multi_start(pdf, dataset, variables)
+        if fit_cache:
+            fit_cache.put(cache_key, result)
+        return result
+
+
+    def _fit_roofit_multi_start(self, pdf, dataset, variables):
+        """
+        Fit from multiple starting points (see set_multi_start) in worker processes (forked, they
+        share the pdf and the dataset), see run_roofit_start. The fit is then repeated from the
+        best converged minimum to get the RooFitResult.
+        """
+        if getattr(self, 'multi_start', 1) <= 1:
+            return self._fit_roofit_uncached(pdf, dataset, variables)
+        global _roofit_multi_start_setup
+
+        params = RooArgList(pdf.getParameters(dataset))
+        floating = [params[idx] for idx in range(params.getSize()) if isinstance(params[idx], RooRealVar) and not params[idx].isConstant()]
+        ranges = collections.OrderedDict([(par.GetName(), (par.getMin(), par.getMax())) for par in floating])
+        nominal = dict([(par.GetName(), par.getVal()) for par in floating])
+        random_state = get_random_state(self.multi_start_seed, 'multi_start', self.channel, self.recobin, pdf.GetName())
+        start_points = get_start_points(ranges, self.multi_start, self.multi_start_method, random_state, nominal)
+
+        n_workers = self.get_fit_cpus()
+        #the CPUs are shared by the starts running at the same time, all of them go to NumCPU
+        #if the starts run serially (e.g. in a task of --jobs)
+        _roofit_multi_start_setup = (self, pdf, dataset, variables, max(1, n_workers//get_n_processes(n_workers, len(start_points))))
+        try:
+            results = parallel_map(run_roofit_start, [(start_values,) for start_values in start_points], n_workers)
+        finally:
+            _roofit_multi_start_setup = None
+
+        summary = MultiStartSummary(*zip(*results))
+        summary.print_summary()
+        best = summary.best_index()
+        if best is None:
+            raise RuntimeError, 'All {0} fits of the multi-start of {1} failed.'.format(self.multi_start, pdf.GetName())
+        self.log.info('Repeating the fit of {0} from the best minimum (start {1}).'.format(pdf.GetName(), best))
+        params = pdf.getParameters(dataset)
+        for par_name, value in summary.values[best].iteritems():
+            params.find(par_name).setVal(value)
+        return self._fit_roofit_uncached(pdf, dataset, variables)
+
+
+    def _fit_roofit_uncached(self, pdf, dataset, variables):
+        fit_bins = getattr(self, 'fit_bins', 0)
+        if not fit_bins:
+            return pdf.fitTo(dataset,
+                             RooFit.Save(kTRUE),
+                             RooFit.SumW2Error(kTRUE),
+                             RooFit.Verbose(kFALSE),
+                             RooFit.PrintLevel(-1),
+                             RooFit.Warnings(kFALSE),
+                             RooFit.NumCPU(self.get_fit_cpus()),RooFit.Timer(kTRUE)
+                             )
+
+        default_bins = self.mass4l.getBins()
+        self.mass4l.setBins(fit_bins)
+        data_hist_name = 'binned_{0}'.format(dataset.GetName())
+        arg_set = RooArgSet()
+        for var in variables:
+            arg_set.add(var)
+        data_hist = RooDataHist(data_hist_name, data_hist_name, arg_set, dataset)
+        self.mass4l.setBins(default_bins)
+        self.log.info('Fitting binned dataset {0} ({1} bins, {2} likelihood).'.format(data_hist_name, fit_bins, self.binned_likelihood))
+
+        if self.binned_likelihood == 'chi2':
+            result = pdf.chi2FitTo(data_hist,
+                                   RooFit.Save(kTRUE),
+                                   RooFit.DataError(RooAbsData.SumW2),
+                                   RooFit.Verbose(kFALSE),
+                                   RooFit.PrintLevel(-1),
+                                   RooFit.Warnings(kFALSE),
+                                   RooFit.NumCPU(self.get_fit_cpus()),RooFit.Timer(kTRUE)
+                                   )
+        else:
+            result = pdf.fitTo(data_hist,
+                               RooFit.Save(kTRUE),
+                               RooFit.SumW2Error(kTRUE),
+                               RooFit.Verbose(kFALSE),
+                               RooFit.PrintLevel(-1),
+                               RooFit.Warnings(kFALSE),
+                               RooFit.NumCPU(self.get_fit_cpus()),RooFit.Timer(kTRUE)
+                               )
+
+        if self.compare_unbinned:
+            self._compare_unbinned_roofit(pdf, dataset, result)
+        return result
+
+
+    def _compare_unbinned_roofit(self, pdf, dataset, result):
+        """
+        Repeats the binned fit (result) unbinned from the same initial values and reports the shifts,
+        see set_binned_fit. The parameters keep the binned values and errors.
+        """
+        binned_params = result.floatParsFinal()
+        params = pdf.getParameters(dataset)
+        params.assignValueOnly(result.floatParsInit())
+        unbinned_result = pdf.fitTo(dataset,
+                                    RooFit.Save(kTRUE),
+                                    RooFit.SumW2Error(kTRUE),
+                                    RooFit.Verbose(kFALSE),
+                                    RooFit.PrintLevel(-1),
+                                    RooFit.Warnings(kFALSE),
+                                    RooFit.NumCPU(self.get_fit_cpus()),RooFit.Timer(kTRUE)
+                                    )
+        unbinned_params = unbinned_result.floatParsFinal()
+        self._report_binned_shifts([(binned_params[idx].GetName(), binned_params[idx].getVal(),
+                                     unbinned_params.find(binned_params[idx].GetName()).getVal(),
+                                     unbinned_params.find(binned_params[idx].GetName()).getError())
+                                    for idx in range(binned_params.getSize())])
+        #keep the binned result
+        params.assignValueOnly(binned_params)
+        for idx in range(binned_params.getSize()):
+            params.find(binned_params[idx].GetName()).setError(binned_params[idx].getError())
+
+
+    def _print_formulas(self, channel, param_values):
+        """
+        Print the DCB parameters as formulas of MH (@0) from {p0/p1 parameter name : value}.
+        """
+        self.log.info('Printing formulas for {0}'.format(channel))
+        for cb_par in ['mean', 'sigma', 'alpha', 'n', 'alpha2', 'n2']:
+            output_formula = ''
+            if abs(param_values[cb_par+'_p0']) > 0.0:
+                p0_part = '{0}'.format(param_values[cb_par+'_p0'])
+                output_formula += p0_part
+            if abs(param_values[cb_par+'_p1']) > 0.0:
+                p1_part = '({0})*(@0-125)'.format(param_values[cb_par+'_p1'])
+                if output_formula: output_formula += '+'
+                output_formula+= p1_part
+            print cb_par+' = \''+output_formula+'\''
+
+
+    def _get_dataset_arrays(self, dataset, var_name):
+        """
+        Returns numpy arrays (values of var_name, weights) of the dataset. With ROOT >= 6.26
+        the arrays are taken with RooDataSet.to_numpy, otherwise the variable and the accessors
+        are looked up once before the loop over the entries.
+        """
+        n_entries = dataset.numEntries()
+        if hasattr(dataset, 'to_numpy'):
+            arrays = dataset.to_numpy()
+            weight_names = ['weight']
+            if dataset.isWeighted() and dataset.weightVar():
+                weight_names.insert(0, dataset.weightVar().GetName())
+            weight_names = [weight_name for weight_name in weight_names if weight_name in arrays and weight_name != var_name]
+            if weight_names:
+                return (np.asarray(arrays[var_name], dtype=np.float64), np.asarray(arrays[weight_names[0]], dtype=np.float64))
+            if not dataset.isWeighted():
+                return (np.asarray(arrays[var_name], dtype=np.float64), np.ones(n_entries))
+        values = np.empty(n_entries)
+        weights = np.empty(n_entries)
+        get_row, get_weight = dataset.get, dataset.weight
+        var = get_row().find(var_name)
+        for idx in xrange(n_entries):
+            get_row(idx)
+            values[idx] = var.getVal()
+            weights[idx] = get_weight()
+        return (values, weights)
+
+
+    def _get_chi_square(self, category, dataset, params, n_fit_params, normalization=None):
+        """
+        Returns ChiSquare of the DCB with params (mean, sigma, alpha, n, alpha2, n2) and the dataset
+        (RooDataSet or MassPoint) of the category in m4l_bins bins. The histogram of each category
+        is filled once and the chi-square is computed once for each set of parameters.
+        """
+        if not hasattr(self, 'chi_square_calculator'):
+            self.chi_square_calculator = ChiSquareCalculator(self.m4l_low, self.m4l_high, self.m4l_bins)
+        if not self.chi_square_calculator.has_data(category):
+            if isinstance(dataset, MassPoint):
+                self.chi_square_calculator.set_data(category, dataset.x, dataset.weights)
+            else:
+                self.chi_square_calculator.set_data(category, *self._get_dataset_arrays(dataset, self.mass4l.GetName()))
+        return self.chi_square_calculator.get(category, params, n_fit_params, normalization)
+
+
+    def _get_dcb_values(self, signal):
+        """
+        Returns the current values of the DCB parameters rfv_<parameter>_CB of the signal dictionary.
+        """
+        return tuple([signal['rfv_'+dcb_par+'_CB'].getVal() for dcb_par in DCB_PARAMETERS])
+
+
+    def _plot_mass_point_fit(self, channel, signal, result):
+        """
+        Saves the fit result, the correlation matrix and the plot of the fit (with the chi-square
+        and the floating parameters) of the single mass point signal (dictionary of fit_simultaneously).
+        """
+        tag = 'SIM{0}'.format(int(signal['MH']))
+        bin_tag = channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight
+        fit_results_file = TFile("plots/TEST11_FITRESULT_"+tag+"_"+bin_tag+".root", "RECREATE")
+        result.Write('fit_result')
+        self.log.info('Retrieving correlation matrix.')
+        correlation_matrix = result.correlationHist()
+        correlation_matrix.Write('correlation_matrix')
+        c = TCanvas("c","c",750,750)
+        SetOwnership(c,False)
+        correlation_matrix.Draw("colz")
+        c.SaveAs("plots/TEST11_"+tag+"_correlation_matrix_"+bin_tag+".png")
+        c.SaveAs("plots/TEST11_"+tag+"_correlation_matrix_"+bin_tag+".pdf")
+        c.Clear()
+
+        #plot the fit and display parameters and also the chiSquare
+        self.log.info('Plotting the {0} GeV fit and displaying parameters.'.format(signal['MH']))
+        self.frame = RooPlot()
+        self.frame = self.mass4l.frame(RooFit.Title(self.mass4l.GetTitle().replace('mass','m')),RooFit.Bins(self.m4l_bins))
+
+        signal['dataset'].plotOn(self.frame, RooFit.LineColor(kRed), RooFit.MarkerSize(0))
+        signal['pdf'].plotOn(self.frame, RooFit.LineColor(kRed) )
+
+        self.frame.Draw()
+        self.frame.Print('v')
+        float_params = result.floatParsFinal()
+        chi_square = self._get_chi_square((channel, signal['MH']), signal['dataset'], self._get_dcb_values(signal), float_params.getSize())
+        self.log.info('ChiSquare/ndof (ndof={0}) = {1}'.format(float_params.getSize(), chi_square.per_ndof()))
+        self._draw_CMS_label(c, label = 'Simulation', x=0.2, y=0.8)
+        latex2 = TLatex()
+        latex2.SetNDC()
+        latex2.SetTextAlign(11)
+        latex2.SetTextFont(42)
+        latex2.SetTextSize(0.3*c.GetTopMargin())
+        latex2.DrawLatex(0.15, 0.64, "#chi^{{2}}/ndof = {0:3.2f} ({1})".format(chi_square.per_ndof(), float_params.getSize()))
+        dy = 0
+        for idx in range(float_params.getSize()):
+            par = float_params[idx]
+            latex2.DrawLatex(0.15, 0.6+dy, " {0} = {1:3.2f} #pm {2:3.2f}".format(par.GetTitle().rstrip('_p0'), par.getVal(), par.getError()))
+            dy -= 0.04
+
+        c.SaveAs("plots/TEST11_"+tag+"_"+bin_tag+".png")
+        c.SaveAs("plots/TEST11_"+tag+"_"+bin_tag+".pdf")
+        fit_results_file.Close()
+
+
+    def _get_mass_points(self, channel):
+        """
+        Returns list of MassPoint (events and weights of the mass4l variable) for all samples.
+        """
+        mass_points = []
+        for Sample in self.List:
+            massHiggs = self._get_sample_mass(Sample)
+            if (channel, massHiggs) in getattr(self, 'generated_values', {}):
+                x = self.generated_values[(channel, massHiggs)]
+                weights = np.ones_like(x)
+            else:
+                dataset = self._get_dataset(Sample, channel, massHiggs)
+                x, weights = self._get_dataset_arrays(dataset, self.mass4l.GetName())
+            mass_points.append(MassPoint(massHiggs, x, weights))
+            self.log.debug('Mass point MH={0}: entries={1}, sum_weights={2}'.format(massHiggs, len(x), weights.sum()))
+        return mass_points
+
+
+    def fit_simultaneously_numpy(self, channel, samples):
+        """
+        The same fit stages as fit_simultaneously (see set_fit_stages) with the numpy DCB engine (lib/fitting).
+        The result of a stage is taken from the fit result cache if the stage was fitted before with the same inputs.
+        """
+        self.mass4l = self._get_mass_var(channel)
+        mass_points = self._get_mass_points(channel)
+
+        param_init = self._get_dcb_param_init(channel)[0]  #L-BFGS-B has no initial step sizes
+        parameters = collections.OrderedDict()
+        for par_name, init in param_init.iteritems():
+            parameters[par_name] = FitParameter(par_name, *init)
+
+        fit_stages = self.get_fit_stages()
+        self.chi_square_values = []
+
+        def fit_stage(stage, setup, MH_values):
+            for par_name, (constant, value, error, par_range) in setup.iteritems():
+                if value is not None: parameters[par_name].value = value
+                if error is not None: parameters[par_name].error = error
+                if par_range is not None: parameters[par_name].setRange(*par_range)
+                parameters[par_name].constant = constant
+            stage_mass_points = [mass_point for mass_point in mass_points if mass_point.MH in MH_values]
+
+            self.log.info('Fitting mass points {0} for channel={1}, fit stage {2} (numpy engine)'.format(MH_values, channel, stage.name))
+            result = self._fit_numpy(parameters, stage_mass_points, stage.name)
+            print "FitResult of fit stage {0}:".format(stage.name)
+            result.Print()
+            for mass_point in stage_mass_points:
+                chi_square = self._get_chi_square((channel, mass_point.MH), mass_point, get_dcb_params(result.values().values(), mass_point.MH), len(result.floating))
+                self.log.info('MH = {0}: ChiSquare/ndof (ndof={1}) = {2}'.format(mass_point.MH, len(result.floating), chi_square.per_ndof()))
+                if fit_stages.is_final(stage):
+                    self.chi_square_values.append((mass_point.MH, chi_square.per_ndof()))
+            if fit_stages.is_final(stage):
+                self.r = result
+            return collections.OrderedDict([(par_name, (par.value, par.error, par_name in result.floating)) for par_name, par in parameters.iteritems()])
+
+        #the last stage is the final fit, done with doFit
+        fit_stages.run(fit_stage, parameters.keys(), [mass_point.MH for mass_point in mass_points], {True:None, False:-1}[doFit])
+        if not doFit: return
+        self._print_formulas(channel, self.r.values())
+        self._store_warm_start(channel, self.r.values(), self.r.errors())
+        self._estimate_resampling_uncertainties(channel, parameters, mass_points)
+
+
     def fit_simultaneously(self, channel, samples):
         """
         Perform simultaneous fit on multiple signal masses to get the Doube Crystal-Ball
         parameters, actually, the parameters of their mass dependence (e.g. p0 and p1)
         """
+        if getattr(self, 'fit_engine', 'roofit') == 'numpy':
+            return self.fit_simultaneously_numpy(channel, samples)
 
         ROOT.gSystem.AddIncludePath("-I$CMSSW_BASE/src/ ");
         ROOT.gSystem.Load("$CMSSW_BASE/lib/slc5_amd64_gcc472/libHiggsAnalysisCombinedLimit.so");
@@ -329,45 +1362,47 @@ class SignalSpectrumFitter(object):
 
         #define p0, p1 paremeters for each DCB parameter  (these will be fit )
 
+        param_init, param_steps = self._get_dcb_param_init(channel)
         if channel in ['2e2mu_inclusive', '2e2mu', '2mu2e','4e','4mu']: #FIXME for the moment they all have the same parameter range
 
             #idea is to make a linear expansion around mH=125p6
             #*_p0 is an intersection with y-axis of parametere(mH-125) dependance
             #*_p1 is a slope of parametere(mH-125) dependance
-            mean_p0 = RooRealVar('mean_p0','mean_p0', 125, 120, 130)
-            mean_p1 = RooRealVar('mean_p1','mean_p1', 1, 0.9, 1.1)
+            mean_p0 = RooRealVar('mean_p0','mean_p0', *param_init['mean_p0'])
+            mean_p1 = RooRealVar('mean_p1','mean_p1', *param_init['mean_p1'])
             #mean_p1.setConstant(True)
 
-            sigma_p0 = RooRealVar('sigma_p0','sigma_p0', 1.63, 1, 3)
-            sigma_p1 = RooRealVar('sigma_p1','sigma_p1', 0,-0.5, 0.5)
+            sigma_p0 = RooRealVar('sigma_p0','sigma_p0', *param_init['sigma_p0'])
+            sigma_p1 = RooRealVar('sigma_p1','sigma_p1', *param_init['sigma_p1'])
             #sigma_p1.setConstant(True)
 
-            alpha_p0 = RooRealVar('alpha_p0','alpha_p0', 0.96, 0, 10)
-            alpha_p1 = RooRealVar('alpha_p1','alpha_p1', 0, -0.5, 0.5)
+            alpha_p0 = RooRealVar('alpha_p0','alpha_p0', *param_init['alpha_p0'])
+            alpha_p1 = RooRealVar('alpha_p1','alpha_p1', *param_init['alpha_p1'])
             #alpha_p1.setConstant(True)
 
-            n_p0 = RooRealVar('n_p0','n_p0', 4.51, 0, 10)
-            n_p1 = RooRealVar('n_p1','n_p1', 0, -10, 10)
+            n_p0 = RooRealVar('n_p0','n_p0', *param_init['n_p0'])
+            n_p1 = RooRealVar('n_p1','n_p1', *param_init['n_p1'])
             #n_p1.setConstant(True)
 
-            alpha2_p0 = RooRealVar('alpha2_p0','alpha2_p0', 1.4, 0, 10)
-            alpha2_p1 = RooRealVar('alpha2_p1','alpha2_p1', 0, -0.5, 0.5)
+            alpha2_p0 = RooRealVar('alpha2_p0','alpha2_p0', *param_init['alpha2_p0'])
+            alpha2_p1 = RooRealVar('alpha2_p1','alpha2_p1', *param_init['alpha2_p1'])
             #alpha2_p1.setConstant(True)
 
-            n2_p0 = RooRealVar('n2_p0','n2_p0', 20, -50, 50)
-            n2_p1 = RooRealVar('n2_p1','n2_p1', 0, -0.5, 0.5)
+            n2_p0 = RooRealVar('n2_p0','n2_p0', *param_init['n2_p0'])
+            n2_p1 = RooRealVar('n2_p1','n2_p1', *param_init['n2_p1'])
 
             #define parameter lists (will use for 125 GeV fits and freezing)
             slope_params        = RooArgList(mean_p1, sigma_p1, alpha_p1, n_p1, alpha2_p1, n2_p1)
             intersection_params = RooArgList(mean_p0, sigma_p0, alpha_p0, n_p0, alpha2_p0, n2_p0)
 
+            #the initial step sizes of the minimizer are the errors of the warm start
+            for par_name, step in param_steps.iteritems():
+                (intersection_params.find(par_name) or slope_params.find(par_name)).setError(step)
+
 
         #find central mass point (to get diffs)
 
-        mass_suffix = channel
-        if channel in ["2e2mu_inclusive", "2e2mu","2mu2e"]:
-                mass_suffix = "2e2mu"
-        self.mass4l = RooRealVar("mass"+mass_suffix, "mass"+mass_suffix, m4l_low, m4l_high)
+        self.mass4l = self._get_mass_var(channel)
 
         ext_pdf_list = RooArgList()
         signals_dict = {}
@@ -401,23 +1436,24 @@ class SignalSpectrumFitter(object):
             self.processBin = sample_name+'_'+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)
             signals_dict[sample_name]['processBin'] = self.processBin
 
-            #define RooFormulaVar for DCB CB_parameters (including mass diff from central)
-            self.log.info('Defining the DCB parameters as formulas')
-            #general_formula = "@0+(@1)*(@2+({0}))".format(delta_MH)
-            general_formula = "@0+(@1)*(@2+({0})-125)".format(delta_MH)  #we make expansion around mH=125
+            #define the DCB CB_parameters as p0 + p1*(MH-125) (including mass diff from central)
+            #general_formula = "@0+(@1)*(@2+({0})-125)".format(delta_MH) is linear in p0, p1 for the fixed MH,
+            #so it is a compiled RooPolyVar of p1 with coefficients (p0, MH-125) instead of an interpreted RooFormulaVar
+            self.log.info('Defining the DCB parameters as linear functions of p0, p1')
+            slope_factor = RooFit.RooConst(MH.getVal()+delta_MH-125)  #we make expansion around mH=125
 
-            signals_dict[sample_name]['rfv_mean_CB']  = RooFormulaVar("mean_{0}".format(int(massHiggs)),general_formula , RooArgList(mean_p0, mean_p1,MH))
+            signals_dict[sample_name]['rfv_mean_CB']  = RooPolyVar("mean_{0}".format(int(massHiggs)), "mean_{0}".format(int(massHiggs)), mean_p1, RooArgList(mean_p0, slope_factor), 0)
             signals_dict[sample_name]['rfv_mean_CB'].SetTitle('#mu')
-            signals_dict[sample_name]['rfv_sigma_CB'] = RooFormulaVar("sigma_{0}".format(int(massHiggs)),general_formula , RooArgList(sigma_p0, sigma_p1,MH))
+            signals_dict[sample_name]['rfv_sigma_CB'] = RooPolyVar("sigma_{0}".format(int(massHiggs)), "sigma_{0}".format(int(massHiggs)), sigma_p1, RooArgList(sigma_p0, slope_factor), 0)
             signals_dict[sample_name]['rfv_sigma_CB'].SetTitle('#sigma')
-            signals_dict[sample_name]['rfv_alpha_CB'] = RooFormulaVar("alpha_{0}".format(int(massHiggs)),general_formula , RooArgList(alpha_p0, alpha_p1,MH))
+            signals_dict[sample_name]['rfv_alpha_CB'] = RooPolyVar("alpha_{0}".format(int(massHiggs)), "alpha_{0}".format(int(massHiggs)), alpha_p1, RooArgList(alpha_p0, slope_factor), 0)
             signals_dict[sample_name]['rfv_alpha_CB'].SetTitle('#alpha')
-            signals_dict[sample_name]['rfv_n_CB']     = RooFormulaVar("n_{0}".format(int(massHiggs)),general_formula , RooArgList(n_p0, n_p1,MH))
+            signals_dict[sample_name]['rfv_n_CB']     = RooPolyVar("n_{0}".format(int(massHiggs)), "n_{0}".format(int(massHiggs)), n_p1, RooArgList(n_p0, slope_factor), 0)
             signals_dict[sample_name]['rfv_n_CB'].SetTitle('n')
 
-            signals_dict[sample_name]['rfv_alpha2_CB'] = RooFormulaVar("alpha2_{0}".format(int(massHiggs)),general_formula , RooArgList(alpha2_p0, alpha2_p1,MH))
+            signals_dict[sample_name]['rfv_alpha2_CB'] = RooPolyVar("alpha2_{0}".format(int(massHiggs)), "alpha2_{0}".format(int(massHiggs)), alpha2_p1, RooArgList(alpha2_p0, slope_factor), 0)
             signals_dict[sample_name]['rfv_alpha2_CB'].SetTitle('#alpha_{2}')
-            signals_dict[sample_name]['rfv_n2_CB']     = RooFormulaVar("n2_{0}".format(int(massHiggs)),general_formula , RooArgList(n2_p0, n2_p1,MH))
+            signals_dict[sample_name]['rfv_n2_CB']     = RooPolyVar("n2_{0}".format(int(massHiggs)), "n2_{0}".format(int(massHiggs)), n2_p1, RooArgList(n2_p0, slope_factor), 0)
             signals_dict[sample_name]['rfv_n2_CB'].SetTitle('n_{2}')
 
 
@@ -439,19 +1475,9 @@ class SignalSpectrumFitter(object):
             rc_signals.defineType(signals_dict[sample_name]['cat_name'])
 
             dataset_name = 'dataset_sig_{0}_{1}'.format(channel, int(massHiggs))
-            if self.use_dataset_from_ws:
-
-
-                f_win = TFile.Open('sim_fit_ws_{0}.root'.format(channel))
-
-                win = f_win.Get('w')
-                signals_dict[sample_name]['dataset'] = win.data(dataset_name)
-                self.log.info('Using datasets {1} from workspace: {0}/w'.format(f_win.GetName(),signals_dict[sample_name]['dataset'].GetName()))
-                self._set_cuts(channel, Sample)
-
-            else:
-                signals_dict[sample_name]['dataset'] = self._prepare_datasets(Sample, channel, massHiggs)
-                #signals_dict[sample_name]['dataset'] = signals_dict[sample_name]['pdf'].generate(RooArgSet(self.mass4l),1000)
+            signals_dict[sample_name]['dataset'] = self._get_dataset(Sample, channel, massHiggs)
+            signals_dict[sample_name]['data_key'] = self._get_data_key(Sample, channel, massHiggs)
+            #signals_dict[sample_name]['dataset'] = signals_dict[sample_name]['pdf'].generate(RooArgSet(self.mass4l),1000)
 
             signals_dict[sample_name]['dataset'].SetNameTitle(dataset_name,dataset_name)
 
@@ -472,124 +1498,6 @@ class SignalSpectrumFitter(object):
             #self.pp.pprint(signals_dict)
             #ext_pdf_list.Print()
 
-        #----------------------------------------------------------------------------------------------------------
-        #before simultaneous fit, we will fix intesection parametrs to those obtained from fit to mH=125 GeV sample
-        #----------------------------------------------------------------------------------------------------------
-        #we freeze slopes for this pourpose
-        self.log.info('Freezing slope parameters for fits to 125 GeV point.')
-        for idx in range(slope_params.getSize()):
-            slope_params[idx].setConstant(True)
-
-        #prepare fitting
-        r_125 = RooFitResult()
-        for key, val in signals_dict.iteritems():
-            #find the pdf, dataset for 125 GeV
-            #print key, val
-            if val['MH'] == 125:
-                self.log.debug('Found 125 GeV signal.= in signals_dict.')
-                sig_125 = val
-        try:
-            sig_125
-        except NameError:
-            raise NameError, 'There is no 125 GeV signal pdf, dataset loaded into signals_dict.'
-
-        #now we will make a fit of 125 GeV sample
-        self.log.info('Fitting 125 GeV signal for channel={0}'.format(channel))
-        r_125 = sig_125['pdf'].fitTo(sig_125['dataset'],
-                                RooFit.Save(kTRUE),
-                                RooFit.SumW2Error(kTRUE),
-                                RooFit.Verbose(kFALSE),
-                                RooFit.PrintLevel(-1),
-                                RooFit.Warnings(kFALSE),
-                                RooFit.NumCPU(12),RooFit.Timer(kTRUE)
-                                )
-        print "RooFitResult for 125 GeV signal:"
-        r_125.Print()
-        fit_results_file = TFile("plots/TEST11_FITRESULT_SIM125_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".root", "RECREATE")
-        r_125.Write('fit_result')
-        #sum.Print()
-        self.log.info('Retrieving correlation matrix.')
-        correlation_matrix = r_125.correlationHist()
-        correlation_matrix.Write('correlation_matrix')
-        c = TCanvas("c","c",750,750)
-        SetOwnership(c,False)
-        correlation_matrix.Draw("colz")
-        c.SaveAs("plots/TEST11_SIM125_correlation_matrix_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".png")
-        c.SaveAs("plots/TEST11_SIM125_correlation_matrix_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".pdf")
-
-        #plot the fit and display parameters and also the chiSquare
-        self.log.info('Plotting the 125 GeV fit and displaying parameters.')
-        self.frame = RooPlot()
-        self.frame = self.mass4l.frame(RooFit.Title(self.mass4l.GetTitle().replace('mass','m')),RooFit.Bins(self.m4l_bins))
-
-        sig_125['dataset'].plotOn(self.frame, RooFit.LineColor(kRed), RooFit.MarkerSize(0))
-        sig_125['pdf'].plotOn(self.frame, RooFit.LineColor(kRed) )
-
-        self.frame.Draw()
-        self.frame.Print('v')
-        self.log.info('ChiSquare/ndof (ndof={0}) = {1}'.format(r_125.floatParsFinal().getSize(),
-                                                                self.frame.chiSquare(r_125.floatParsFinal().getSize())))
-        self._draw_CMS_label(c, label = 'Simulation', x=0.2, y=0.8)
-        latex2 = TLatex()
-        latex2.SetNDC()
-        latex2.SetTextSize(0.4*c.GetTopMargin())
-        latex2.SetTextAlign(11)
-        latex2.SetTextFont(42)
-        latex2.SetTextSize(0.3*c.GetTopMargin())
-        latex2.DrawLatex(0.15, 0.64, "#chi^{{2}}/ndof = {0:3.2f} ({1})".format(self.frame.chiSquare(r_125.floatParsFinal().getSize()), r_125.floatParsFinal().getSize()))
-        dy = 0
-        self.log.info('Getting intesection parameters from fit results and fixing them to 125 GeV best-fit values.')
-        for idx in range(intersection_params.getSize()):
-            #print to the plot
-            par = intersection_params[idx]
-            par_name = par.GetName()
-            r_125_float_params = r_125.floatParsFinal()
-            if not r_125_float_params.find(par_name):
-                raise RuntimeError, 'Cannot find parameter {0} in RooFitResult floated parameters.'.format(par_name)
-
-            self.log.debug('Found matching parameters in fit result: {0} = {1:3.3f} +/- {2:3.3f} ...'.format(par_name,
-                                                                                                     r_125_float_params.find(par_name).getVal(),
-                                                                                                     r_125_float_params.find(par_name).getError() ))
-
-            par.setVal(r_125_float_params.find(par_name).getVal())
-            par.setError(r_125_float_params.find(par_name).getError())
-            par.setRange(par.getVal()-par.getError(), par.getVal()+par.getError())
-
-            if self.DEBUG: par.Print()
-            latex2.DrawLatex(0.15, 0.6+dy, " {0} = {1:3.2f} #pm {2:3.2f}".format(par.GetTitle().rstrip('_p0'),
-                                                                                 r_125_float_params.find(par_name).getVal(),
-                                                                                 r_125_float_params.find(par_name).getError()))
-            dy -= 0.04
-
-        c.SaveAs("plots/TEST11_SIM125_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".png")
-        c.SaveAs("plots/TEST11_SIM125_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".pdf")
-
-
-
-        #unfreeze the slopes and freeze intesections after setting to the ones from 125 GeV fit
-        self.log.info('Unfreezing slope parameters...')
-        for idx in range(slope_params.getSize()):
-            slope_params[idx].setConstant(False)
-            if self.DEBUG: slope_params[idx].Print()
-
-        sim_fit_frozen_params = RooArgList(
-                                            mean_p0,
-                                            sigma_p0,
-                                            alpha_p0,
-                                            #n_p0,
-                                            #alpha2_p0,
-                                            n2_p0,
-                                            alpha2_p1,
-                                            alpha_p1,
-                                            n_p1  #added on Oct06 for TEST7 version
-                                            )
-
-        self.log.info('Freezing parameters {0}.'.format(sim_fit_frozen_params))
-        for idx in range(sim_fit_frozen_params.getSize()):
-            sim_fit_frozen_params[idx].setConstant(True)
-            if self.DEBUG: sim_fit_frozen_params[idx].Print()
-
-
         #return
 
         ##make RooAddPdf of all signals and prepare fitting.
@@ -644,8 +1552,10 @@ class SignalSpectrumFitter(object):
             if not import_rds_cmd: break
             rds_signals_create_cmd = 'this_rds = RooDataSet("all_signals_{1}","All signals {1}",RooArgSet(self.mass4l,self.rrv_recoweight), RooFit.Index(rc_signals),RooFit.WeightVar(self.rrv_recoweight.GetName()){0})'.format(import_rds_cmd, i_rds)
             self.log.debug('rds_all_signals_create_cmd : {0}'.format(rds_signals_create_cmd))
-            exec(rds_signals_create_cmd)
-            rds_signals.append(this_rds)
+            #exec in own namespace, fit_simultaneously has a nested function (fit_stage)
+            exec_namespace = dict(globals(), **locals())
+            exec rds_signals_create_cmd in exec_namespace
+            rds_signals.append(exec_namespace['this_rds'])
 
         rds_all_signals = rds_signals[0]
         for rds in rds_signals[1:]:
@@ -653,9 +1563,6 @@ class SignalSpectrumFitter(object):
 
         #pdb.set_trace()
 
-        getattr(wout,'import')(rds_all_signals, RooFit.RecycleConflictNodes())
-        getattr(wout,'import')(self.sim_pdf, RooFit.RecycleConflictNodes())
-        wout.writeToFile('sim_fit_ws_{0}.root'.format(channel))
         if self.DEBUG: self.sim_pdf.Print('v')
 
         if self.DEBUG:
@@ -665,20 +1572,64 @@ class SignalSpectrumFitter(object):
             print 100*'-'
 
 
-        #prepare fit results and fit
+        #----------------------------------------------------------------------------------------------------------
+        #fit stages (see set_fit_stages), by default the fit to mH=125 GeV sample with frozen slopes, then the simultaneous
+        #fit with the intersection parameters within the errors of the 125 GeV fit and some parameters frozen
+        #----------------------------------------------------------------------------------------------------------
+        fit_stages = self.get_fit_stages()
+
+        def apply_setup(setup):
+            for par_name, (constant, value, error, par_range) in setup.iteritems():
+                par = intersection_params.find(par_name) or slope_params.find(par_name)
+                if value is not None: par.setVal(value)
+                if error is not None: par.setError(error)
+                if par_range is not None: par.setRange(*par_range)
+                par.setConstant(constant)
+                if self.DEBUG: par.Print()
+
+        def write_workspace():
+            getattr(wout,'import')(rds_all_signals, RooFit.RecycleConflictNodes())
+            getattr(wout,'import')(self.sim_pdf, RooFit.RecycleConflictNodes())
+            wout.writeToFile('sim_fit_ws_{0}.root'.format(channel))
+
+        def fit_stage(stage, setup, MH_values):
+            apply_setup(setup)
+            if fit_stages.is_final(stage):
+                write_workspace()
+            stage_signals = [signals_dict[sample_shortnames[Sample]] for Sample in self.List if signals_dict[sample_shortnames[Sample]]['MH'] in MH_values]
+            if len(stage_signals) == 1:
+                signal = stage_signals[0]
+                self.log.info('Fitting {0} GeV signal for channel={1}, fit stage {2}'.format(signal['MH'], channel, stage.name))
+                result = self._fit_roofit(signal['pdf'], signal['dataset'], [self.mass4l], [signal['data_key']])
+                print "RooFitResult for {0} GeV signal:".format(signal['MH'])
+                result.Print()
+                self._plot_mass_point_fit(channel, signal, result)
+            else:
+                stage_dataset = rds_all_signals
+                if len(stage_signals) < len(signals_dict):
+                    stage_dataset = rds_all_signals.reduce(RooFit.Cut('||'.join(['signals==signals::{0}'.format(signal['cat_name']) for signal in stage_signals])))
+                self.log.info('Fitting mass points {0} simultaneously for channel={1}, fit stage {2}'.format(MH_values, channel, stage.name))
+                result = self._fit_roofit(self.sim_pdf, stage_dataset, [self.mass4l, rc_signals], [signal['data_key'] for signal in stage_signals])
+                print "RooFitResult of fit stage {0}:".format(stage.name)
+                result.Print()
+            if fit_stages.is_final(stage):
+                self.r = result
+            float_params = result.floatParsFinal()
+            stage_result = collections.OrderedDict()
+            for par_name in self._dcb_param_init.keys():
+                par = intersection_params.find(par_name) or slope_params.find(par_name)
+                stage_result[par_name] = (par.getVal(), par.getError(), bool(float_params.find(par_name)))
+            return stage_result
+
+        #the last stage is the final fit, done with doFit
+        fit_stages.run(fit_stage, self._dcb_param_init.keys(), [signals_dict[sample_shortnames[Sample]]['MH'] for Sample in self.List], {True:None, False:-1}[doFit])
+        if not doFit:
+            #the setup of the final fit without fitting
+            apply_setup(fit_stages.get_setup(fit_stages.stages[-1], self._dcb_param_init.keys()))
+            write_workspace()
+
+        #prepare fit results
         if doFit:
-            self.r = RooFitResult()
-            self.r = self.sim_pdf.fitTo(rds_all_signals,
-                                        RooFit.Save(kTRUE),
-                                        RooFit.SumW2Error(kTRUE),
-                                        RooFit.Verbose(kFALSE),
-                                        RooFit.PrintLevel(-1),
-                                        RooFit.Warnings(kFALSE),
-                                        RooFit.NumCPU(12),RooFit.Timer(kTRUE)
-                                        )
-            print "RooFitResult:"
-            self.r.Print()
-
             fit_results_file = TFile("plots/TEST11_FITRESULT_SIM_"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+".root", "RECREATE")
             self.r.Write('fit_result')
             #sum.Print()
@@ -686,17 +1637,22 @@ class SignalSpectrumFitter(object):
             correlation_matrix.Write('correlation_matrix')
 
             #print results into formula
-            self.log.info('Printing formulas for {0}'.format(channel))
-            for cb_par in ['mean', 'sigma', 'alpha', 'n', 'alpha2', 'n2']:
-                output_formula = ''
-                if abs(intersection_params.find(cb_par+'_p0').getVal()) > 0.0:
-                    p0_part = '{0}'.format(intersection_params.find(cb_par+'_p0').getVal())
-                    output_formula += p0_part
-                if abs(slope_params.find(cb_par+'_p1').getVal()) > 0.0:
-                    p1_part = '({0})*(@0-125)'.format(slope_params.find(cb_par+'_p1').getVal())
-                    if output_formula: output_formula += '+'
-                    output_formula+= p1_part
-                print cb_par+' = \''+output_formula+'\''
+            param_values = collections.OrderedDict()
+            param_errors = {}
+            for par_name in self._dcb_param_init.keys():
+                param_values[par_name] = (intersection_params.find(par_name) or slope_params.find(par_name)).getVal()
+                param_errors[par_name] = (intersection_params.find(par_name) or slope_params.find(par_name)).getError()
+            self._print_formulas(channel, param_values)
+            self._store_warm_start(channel, param_values, param_errors)
+
+            if getattr(self, 'resampling', ''):
+                #the replicas are refitted with the numpy engine from the RooFit result
+                parameters = collections.OrderedDict()
+                for par_name in self._dcb_param_init.keys():
+                    par = intersection_params.find(par_name) or slope_params.find(par_name)
+                    parameters[par_name] = FitParameter(par_name, par.getVal(), par.getMin(), par.getMax(), bool(par.isConstant()))
+                    parameters[par_name].error = par.getError()
+                self._estimate_resampling_uncertainties(channel, parameters, self._get_mass_points(channel))
 
 
         #plot all signals
@@ -716,8 +1672,8 @@ class SignalSpectrumFitter(object):
         for Sample in self.List:
             c.Clear()
             sample_name = sample_shortnames[Sample]
-            self.frame = self.mass4l.frame(RooFit.Title('mH = {0}'.format(signals_dict[sample_name]['MH']))#,
-                                           #RooFit.Bins(self.m4l_bins)
+            self.frame = self.mass4l.frame(RooFit.Title('mH = {0}'.format(signals_dict[sample_name]['MH'])),
+                                           RooFit.Bins(self.m4l_bins)  #the binning of the chi-square
                                            )
             self.frame.GetXaxis().SetTitle('m_{2e2#mu}')
             rds_all_signals.plotOn(self.frame, RooFit.LineColor(kBlack),
@@ -737,11 +1693,10 @@ class SignalSpectrumFitter(object):
 
 
             if doFit:
-                self.log.info('ChiSquare/ndof (ndof={0}) = {1}'.format(self.r.floatParsFinal().getSize(),
-                                                                    self.frame.chiSquare(self.r.floatParsFinal().getSize())
-                                                                    #self.frame.chiSquare('sum_Norm[mass2e2mu]', 'h_dataset_sig', self.r.floatParsFinal().getSize())
-                                                                    ))
-                chi_square_values.append(( signals_dict[sample_name]['MH'], self.frame.chiSquare(self.r.floatParsFinal().getSize())))
+                chi_square = self._get_chi_square((channel, signals_dict[sample_name]['MH']), signals_dict[sample_name]['dataset'],
+                                                  self._get_dcb_values(signals_dict[sample_name]), self.r.floatParsFinal().getSize())
+                self.log.info('ChiSquare/ndof (ndof={0}) = {1}'.format(self.r.floatParsFinal().getSize(), chi_square.per_ndof()))
+                chi_square_values.append(( signals_dict[sample_name]['MH'], chi_square.per_ndof()))
             self.frame.Draw()
             #self.frame.Draw()
             #self.frame.Print('v')
@@ -754,7 +1709,7 @@ class SignalSpectrumFitter(object):
             latex2.SetTextFont(42)
             latex2.SetTextSize(0.3*c.GetTopMargin())
             if doFit:
-                latex2.DrawLatex(0.6, 0.84, "\chi^{{2}}/ndof = {0:3.2f} ({1})".format(self.frame.chiSquare(self.r.floatParsFinal().getSize()), self.r.floatParsFinal().getSize()))
+                latex2.DrawLatex(0.6, 0.84, "\chi^{{2}}/ndof = {0:3.2f} ({1})".format(chi_square.per_ndof(), self.r.floatParsFinal().getSize()))
                 #latex2.DrawLatex(0.15, 0.47, "ndof = {0}".format(self.r.floatParsFinal().getSize()))
                 dy = 0
                 for key in sorted(signals_dict[sample_name].keys()):
@@ -773,6 +1728,7 @@ class SignalSpectrumFitter(object):
                                     chi_square_values, x_title = 'm_H')
 
 
+        self.chi_square_values = chi_square_values
         if doFit:
             fit_results_file.Close()
         return
@@ -784,7 +1740,11 @@ class SignalSpectrumFitter(object):
         Perform closure test of the Doube Crystal-Ball parameters
         from an already established DCB_parametrization writen as
         formula strings in 'parametization_cfg'
+        The yields and chi-squares are those of ClosureTest (see closure_test_numpy),
+        the RooFit engine only adds the plots of the datasets and the extended pdfs.
         """
+        if getattr(self, 'fit_engine', 'roofit') == 'numpy':
+            return self.closure_test_numpy(channel, params_dict, tag)
 
         ROOT.gSystem.AddIncludePath("-I$CMSSW_BASE/src/ ");
         ROOT.gSystem.Load("$CMSSW_BASE/lib/slc5_amd64_gcc472/libHiggsAnalysisCombinedLimit.so");
@@ -793,14 +1753,10 @@ class SignalSpectrumFitter(object):
 
         #find central mass point (to get diffs)
 
-        mass_suffix = channel
-        if channel in ["2e2mu_inclusive", "2e2mu","2mu2e"]:
-                mass_suffix = "2e2mu"
-        self.mass4l = RooRealVar("mass"+mass_suffix, "mass"+mass_suffix, m4l_low, m4l_high)
+        self.mass4l = self._get_mass_var(channel)
 
         ext_pdf_list = RooArgList()
         signals_dict = {}
-        MH = None
         rds_all_signals = None
         #loop on mass points
 
@@ -808,45 +1764,41 @@ class SignalSpectrumFitter(object):
         chi_square_values = {}
         for cfg_id, cfg in enumerate(sorted(params_dict.keys())):
             chi_square_values[cfg] = []
+        closure = self._get_closure_test(params_dict)
+        compiled_params = closure.parametrizations
 
+        #the dataset of each mass point is loaded once and shared by all the parametrizations,
+        #their yields and chi-squares are given by ClosureTest (only the yield floats, no fit is needed)
+        datasets = {}
         for Sample in self.List:
+            massHiggs = self._get_sample_mass(Sample)
+            dataset_name = 'dataset_sig_{0}_{1}'.format(channel, int(massHiggs))
+            datasets[Sample] = self._get_dataset(Sample, channel, massHiggs)
+            datasets[Sample].SetNameTitle(dataset_name,dataset_name)
+            closure.add_mass_point(MassPoint(massHiggs, *self._get_dataset_arrays(datasets[Sample], self.mass4l.GetName())))
+        closure_results = closure.run()
 
-            sample_name = sample_shortnames[Sample]
+        for sample_idx, Sample in enumerate(self.List):
 
-            mh = sample_name.split("_")
-            mass = ""
-            for i in range(len(mh)):
-                if mh[i].startswith("1"): mass = mh[i]
-            if (mass=="125p6"): mass="125.6"
-
-            massHiggs = ast.literal_eval(mass)
-            MH = RooRealVar("MH", "MH", massHiggs)
+            sample_name = sample_shortnames[Sample]
+            massHiggs = self._get_sample_mass(Sample)
             signals_dict[sample_name] = {}
+
             for cfg_id, cfg in enumerate(sorted(params_dict.keys())):
                 signals_dict[sample_name][cfg] = {}
                 signals_dict[sample_name][cfg]['MH'] = massHiggs
+                signals_dict[sample_name][cfg]['closure_result'] = closure_results[cfg][sample_idx]
 
                 self.processBin = sample_name+'_'+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)
                 signals_dict[sample_name][cfg]['processBin'] = self.processBin
 
 
-                #define RooFormulaVar for DCB CB_parameters (including mass diff from central)
-                self.log.info('Defining the DCB parameters as formulas')
-
-
-                signals_dict[sample_name][cfg]['rfv_mean_CB']  = RooFormulaVar("mean_{0}_{1}".format(int(massHiggs), cfg_id),params_dict[cfg]['mean'], RooArgList(MH))
-                signals_dict[sample_name][cfg]['rfv_mean_CB'].SetTitle('#mu')
-                signals_dict[sample_name][cfg]['rfv_sigma_CB'] = RooFormulaVar("sigma_{0}_{1}".format(int(massHiggs), cfg_id),params_dict[cfg]['sigma'], RooArgList(MH))
-                signals_dict[sample_name][cfg]['rfv_sigma_CB'].SetTitle('#sigma')
-                signals_dict[sample_name][cfg]['rfv_alpha_CB'] = RooFormulaVar("alpha_{0}_{1}".format(int(massHiggs), cfg_id),params_dict[cfg]['alpha'], RooArgList(MH))
-                signals_dict[sample_name][cfg]['rfv_alpha_CB'].SetTitle('#alpha')
-                signals_dict[sample_name][cfg]['rfv_n_CB']     = RooFormulaVar("n_{0}_{1}".format(int(massHiggs), cfg_id),params_dict[cfg]['n'], RooArgList(MH))
-                signals_dict[sample_name][cfg]['rfv_n_CB'].SetTitle('n')
-
-                signals_dict[sample_name][cfg]['rfv_alpha2_CB'] = RooFormulaVar("alpha2_{0}_{1}".format(int(massHiggs), cfg_id),params_dict[cfg]['alpha2'], RooArgList(MH))
-                signals_dict[sample_name][cfg]['rfv_alpha2_CB'].SetTitle('#alpha_{2}')
-                signals_dict[sample_name][cfg]['rfv_n2_CB']     = RooFormulaVar("n2_{0}_{1}".format(int(massHiggs), cfg_id),params_dict[cfg]['n2'], RooArgList(MH))
-                signals_dict[sample_name][cfg]['rfv_n2_CB'].SetTitle('n_{2}')
+                #the DCB CB_parameters at this MH from the compiled parametrization formulas (constant in the fit)
+                self.log.info('Evaluating the DCB parameters from the parametrization formulas')
+                dcb_values = compiled_params[cfg].evaluate(massHiggs)
+                for dcb_par, title in [('mean', '#mu'), ('sigma', '#sigma'), ('alpha', '#alpha'), ('n', 'n'), ('alpha2', '#alpha_{2}'), ('n2', 'n_{2}')]:
+                    var_name = "{0}_{1}_{2}".format(dcb_par, int(massHiggs), cfg_id)
+                    signals_dict[sample_name][cfg]['rfv_'+dcb_par+'_CB'] = RooRealVar(var_name, title, float(dcb_values[dcb_par]))
 
 
 
@@ -863,30 +1815,17 @@ class SignalSpectrumFitter(object):
 
 
                 #create RooDataSet for current Sample
-                signals_dict[sample_name][cfg]['cat_name'] = 'cat_signal_{0}'.format(int(massHiggs), cfg_id)
+                signals_dict[sample_name][cfg]['cat_name'] = 'cat_signal_{0}_{1}'.format(int(massHiggs), cfg_id)
                 rc_signals.defineType(signals_dict[sample_name][cfg]['cat_name'])
 
-                dataset_name = 'dataset_sig_{0}_{1}'.format(channel, int(massHiggs))
-                if self.use_dataset_from_ws:
-
-
-                    f_win = TFile.Open('sim_fit_ws_{0}.root'.format(channel))
+                signals_dict[sample_name][cfg]['dataset'] = datasets[Sample]
+                #signals_dict[sample_name][cfg]['dataset'] = signals_dict[sample_name][cfg]['pdf'].generate(RooArgSet(self.mass4l),1000)
 
-                    win = f_win.Get('w')
-                    signals_dict[sample_name][cfg]['dataset'] = win.data(dataset_name)
-                    self.log.info('Using datasets {1} from workspace: {0}/w'.format(f_win.GetName(),signals_dict[sample_name][cfg]['dataset'].GetName()))
-                    self._set_cuts(channel, Sample)
+                #extended pdf with the yield of the closure test
 
-                else:
-                    signals_dict[sample_name][cfg]['dataset'] = self._prepare_datasets(Sample, channel, massHiggs)
-                    #signals_dict[sample_name][cfg]['dataset'] = signals_dict[sample_name][cfg]['pdf'].generate(RooArgSet(self.mass4l),1000)
-
-                signals_dict[sample_name][cfg]['dataset'].SetNameTitle(dataset_name,dataset_name)
-
-                #extended pdf
-
-                n_truesig = signals_dict[sample_name][cfg]['dataset'].sumEntries()
+                n_truesig = signals_dict[sample_name][cfg]['closure_result'].n_yield
                 signals_dict[sample_name][cfg]['nsig']    = RooRealVar("N_sig_{0}_{1}".format(int(massHiggs), cfg_id),"N_sig_{0}_{1}".format(int(massHiggs), cfg_id), n_truesig, 0.5*n_truesig, 1.5*n_truesig)
+                signals_dict[sample_name][cfg]['nsig'].setError(signals_dict[sample_name][cfg]['closure_result'].yield_error)
 
                 #signals_dict[sample_name][cfg]['nsig'].setConstant(True)
 
@@ -895,25 +1834,6 @@ class SignalSpectrumFitter(object):
                 if self.DEBUG: signals_dict[sample_name][cfg]['ext_pdf'].Print('v')
                 #ext_pdf_list.add(signals_dict[sample_name][cfg]['ext_pdf'])
 
-
-                #prepare fit results and fit
-                if doFit:
-                    signals_dict[sample_name][cfg]['fit_result'] = RooFitResult()
-                    signals_dict[sample_name][cfg]['fit_result'] = signals_dict[sample_name][cfg]['ext_pdf'].fitTo(signals_dict[sample_name][cfg]['dataset'],
-                                                RooFit.Save(kTRUE),
-                                                RooFit.SumW2Error(kTRUE),
-                                                RooFit.Verbose(kFALSE),
-                                                RooFit.PrintLevel(-1),
-                                                RooFit.Warnings(kFALSE),
-                                                RooFit.NumCPU(12),RooFit.Timer(kTRUE)
-                                                )
-                    print "RooFitResult:"
-                    signals_dict[sample_name][cfg]['fit_result'].Print()
-
-                    fit_results_file = TFile("plots/TEST11_FITRESULT_CLOSURE_"+str(cfg_id)+"_"+signals_dict[sample_name][cfg]['processBin']+"_effs_"+self.recoweight+'_'+tag+".root", "RECREATE")
-                    signals_dict[sample_name][cfg]['fit_result'].Write('fit_result')
-                    #sum.Print()
-
             #plot all signals
             c = TCanvas("c","c",750,750)
             SetOwnership(c,False)
@@ -926,8 +1846,8 @@ class SignalSpectrumFitter(object):
             sample_name = sample_shortnames[Sample]
             first_cfg = sorted(params_dict.keys())[0]
 
-            self.frame = self.mass4l.frame(RooFit.Title('mH = {0}'.format(signals_dict[sample_name][first_cfg]['MH']))#,
-                                            #RooFit.Bins(self.m4l_bins)
+            self.frame = self.mass4l.frame(RooFit.Title('mH = {0}'.format(signals_dict[sample_name][first_cfg]['MH'])),
+                                            RooFit.Bins(self.m4l_bins)  #the binning of the chi-square
                                             )
             self.frame.GetXaxis().SetTitle('m_{2e2#mu}')
             signals_dict[sample_name][first_cfg ]['dataset'].plotOn(self.frame, RooFit.LineColor(kBlack),
@@ -939,12 +1859,9 @@ class SignalSpectrumFitter(object):
                                     RooFit.LineColor(params_dict[cfg]['color'])
                                     )
 
-                self.log.info('ChiSquare/ndof (ndof={0}) = {1}'.format(signals_dict[sample_name][cfg]['fit_result'].floatParsFinal().getSize(),
-                                                                    self.frame.chiSquare(signals_dict[sample_name][cfg]['fit_result'].floatParsFinal().getSize())
-                                                                    #self.frame.chiSquare('sum_Norm[mass2e2mu]', 'h_dataset_sig', self.r.floatParsFinal().getSize())
-                                                                    ))
-                chi_square_values[cfg].append(( signals_dict[sample_name][cfg]['MH'], self.frame.chiSquare(signals_dict[sample_name][cfg]['fit_result'].floatParsFinal().getSize())))
-                signals_dict[sample_name][cfg]['dataset'].plotOn(self.frame, RooFit.LineColor(kBlack),RooFit.MarkerSize(0))
+                chi_square = signals_dict[sample_name][cfg]['closure_result'].chi_square
+                self.log.info('ChiSquare/ndof (ndof={0}) = {1}'.format(chi_square.ndof, chi_square.per_ndof()))
+                chi_square_values[cfg].append(( signals_dict[sample_name][cfg]['MH'], chi_square.per_ndof()))
             self.frame.Draw()
             #self.frame.Draw()
             #self.frame.Print('v')
@@ -991,7 +1908,40 @@ class SignalSpectrumFitter(object):
                                         chi_square_values[cfg], x_title = 'm_H')
 
             #fit_results_file.Close()
-        return
+        closure.print_table(closure_results)
+        self.chi_square_values = chi_square_values
+        return closure_results
+
+
+    def _get_closure_test(self, params_dict):
+        """
+        Returns ClosureTest of the parametrizations {cfg : {DCB parameter : formula}} (sorted by cfg).
+        """
+        return ClosureTest(collections.OrderedDict([(cfg, params_dict[cfg]) for cfg in sorted(params_dict.keys())]),
+                           self.m4l_low, self.m4l_high, self.m4l_bins)
+
+
+    def closure_test_numpy(self, channel, params_dict, tag):
+        """
+        Closure test of the parametrizations (see closure_test_fit) with the numpy engine (ClosureTest):
+        the events of each mass point are read once and compared with the DCB of all the parametrizations,
+        only the yield is fitted (analytically). Prints the table of chi-square/ndof and NLL per
+        parametrization and mass point, makes the chi-square plots and returns the ClosureResults.
+        """
+        self.mass4l = self._get_mass_var(channel)
+        closure = self._get_closure_test(params_dict)
+        for mass_point in self._get_mass_points(channel):
+            closure.add_mass_point(mass_point)
+        results = closure.run()
+        closure.print_table(results)
+
+        self.chi_square_values = {}
+        for cfg, cfg_results in results.iteritems():
+            self.chi_square_values[cfg] = [(result.MH, result.chi_square.per_ndof()) for result in cfg_results]
+            tag_single =  string.split(cfg,'.')[0]
+            self.make_chisqaure_plot("plots/TEST11_SIM_chisquare_closure"+channel+'_'+opt.OBSNAME+'_genbin'+str(self.genbin)+'_recobin'+str(self.recobin)+"_effs_"+self.recoweight+'_'+tag_single,
+                                     self.chi_square_values[cfg], x_title = 'm_H')
+        return results
 
 
 
@@ -1049,35 +1999,192 @@ if (obs_reco=="mass4l"):
 else:
     chans = ['4e','4mu','2e2mu','2mu2e','2e2mu_inclusive']
 
+def copy_genbin_outputs(chan, recobin, genbin, shared_genbins, output_dir='plots'):
+    """
+    Copies the plots and fit result files of the gen bin to the names of the gen bins
+    in shared_genbins (the gen bins with the same results).
+    """
+    bin_tag = '{0}_{1}_genbin{2}_recobin{3}'.format(chan, opt.OBSNAME, genbin, recobin)
+    #the tag ends with '_' or '.', so that e.g. recobin1 does not match the files of recobin10
+    tag_pattern = re.compile(re.escape(bin_tag)+'(?=[_.])')
+    output_files = [output_file for output_file in glob.glob(os.path.join(output_dir, '*{0}*'.format(bin_tag)))
+                    if tag_pattern.search(os.path.basename(output_file))]
+    for shared_genbin in shared_genbins:
+        shared_bin_tag = '{0}_{1}_genbin{2}_recobin{3}'.format(chan, opt.OBSNAME, shared_genbin, recobin)
+        for output_file in output_files:
+            shutil.copy(output_file, os.path.join(os.path.dirname(output_file), tag_pattern.sub(shared_bin_tag, os.path.basename(output_file))))
+    print 'Copied {0} output files of genbin {1} to genbins {2}'.format(len(output_files), genbin, shared_genbins)
+
+
+def run_fitter_task(chan, recobin, genbin, dataset_cache, dummy_file_name=None, shared_genbins=[], fit_cpus=1, fit_cache=''):
+    """
+    Runs the fits (or the closure test) for one channel, reco bin and gen bin.
+    Used as a JobScheduler task, returns the fit summary of the SignalSpectrumFitter.
+    If dummy_file_name is given, the memory resident trees of the task go to its own file.
+    The outputs are copied to the gen bins in shared_genbins, which have the same results.
+    Each fit uses fit_cpus CPUs for the NLL evaluation and the fit results are cached in the file fit_cache.
+    If the cache files are not the common ones (tasks of --jobs), the common ones are read as well
+    and the datasets are expected there (see prepare_task_datasets).
+    """
+    if dummy_file_name:
+        task_dummy_file = TFile(dummy_file_name,"RECREATE")
+    m4l_tool = SignalSpectrumFitter(chan,List, m4l_bins, m4l_low, m4l_high, obs_reco, obs_gen, obs_bins, recobin, genbin)
+    print m4l_tool
+    common_dataset_cache = {True:opt.DATASET_CACHE, False:''}[dataset_cache != opt.DATASET_CACHE]
+    m4l_tool.datasets_exists(not opt.DO_DATASETS or bool(common_dataset_cache))
+    m4l_tool.set_dataset_cache(dataset_cache, common_dataset_cache)
+    if opt.SINGLE_PASS:
+        m4l_tool.set_single_pass_channels(chans)
+    m4l_tool.set_columnar_reader(opt.COLUMNAR)
+    m4l_tool.set_fit_engine(opt.FIT_ENGINE)
+    m4l_tool.set_fit_cpus(fit_cpus)
+    m4l_tool.set_fit_cache(fit_cache, {True:opt.FIT_CACHE, False:''}[fit_cache != opt.FIT_CACHE])
+    m4l_tool.set_fit_stages(opt.FIT_STAGES)
+    m4l_tool.set_warm_start(opt.WARM_START, opt.WARM_START_DIR)
+    if opt.MULTI_START>1:
+        m4l_tool.set_multi_start(opt.MULTI_START, opt.MULTI_START_METHOD, opt.SEED)
+    if opt.RESAMPLE:
+        m4l_tool.set_resampling(opt.RESAMPLE, opt.REPLICAS, opt.SEED)
+    if opt.BINNED:
+        m4l_tool.set_binned_fit(opt.FIT_BINS, opt.BINNED_LIKELIHOOD, opt.COMPARE_UNBINNED)
+    if opt.EXTRACT_WORKERS>1:
+        m4l_tool.set_extraction_workers(opt.EXTRACT_WORKERS)
+        m4l_tool.extract_datasets_parallel({True:chans, False:[chan]}[opt.SINGLE_PASS])
+    if opt.GENERATE_N:
+        m4l_tool.generate_dataset(opt.GENERATE_N, opt.GENERATE_PARAMS, opt.SEED)
+    if not opt.DOCLOSURE:
+        m4l_tool.fit_simultaneously(chan, List)
+    else:
+        if opt.CLOSURE_TEST:
+            params_cfgs = string.split(opt.CLOSURE_TEST,',')
+
+        else:
+            params_cfgs = ['DCB_parametrization.yaml']
+        print 'Parameterization cfgs: {0}'.format(params_cfgs)
+        params_dict={}
+        tag_for_closure_plots = ''
+        #read all the configurations for the closure test.
+        for params_cfg in params_cfgs:
+            cfg_reader = UniversalConfigParser(cfg_type="YAML",file_list = params_cfg)
+            params_dict[params_cfg] = cfg_reader.get_dict()[chan]
+            tag_for_closure_plots += os.path.splitext(params_cfg)[0]
+            tag_for_closure_plots+='_'
+        pp.pprint(params_dict)
+        m4l_tool.closure_test_fit(chan, List, params_dict, tag_for_closure_plots)
+    summary = m4l_tool.get_fit_summary()
+    if shared_genbins:
+        copy_genbin_outputs(chan, recobin, genbin, shared_genbins)
+    if dummy_file_name:
+        task_dummy_file.Close()
+        os.remove(dummy_file_name)
+    return summary
+
+
+def prepare_task_datasets(task_bins):
+    """
+    Extracts the datasets of the tasks of --jobs once, before the tasks are started: for each
+    (recobin, genbin) the final states of task_bins {(recobin, genbin) : [channel]} are extracted
+    in a single pass over each tree (with max(--extractWorkers, --jobs) workers) into the common
+    dataset cache. The tasks read them from there and write only the missing ones into their own files.
+    """
+    for (recobin, genbin), task_chans in task_bins.iteritems():
+        m4l_tool = SignalSpectrumFitter(task_chans[0],List, m4l_bins, m4l_low, m4l_high, obs_reco, obs_gen, obs_bins, recobin, genbin)
+        m4l_tool.datasets_exists(not opt.DO_DATASETS)
+        m4l_tool.set_dataset_cache(opt.DATASET_CACHE)
+        m4l_tool.set_extraction_workers(max(opt.EXTRACT_WORKERS, opt.JOBS))
+        m4l_tool.extract_datasets_parallel(task_chans)
+    #the forked tasks must not share the open file of the parent
+    get_shared_cache(opt.DATASET_CACHE).close()
+
+
+_roofit_multi_start_setup = None  #(fitter, pdf, dataset, variables, fit CPUs) of the running multi-start, shared with the forked workers
+
+def run_roofit_start(start_values):
+    """
+    Multi-start worker (see SignalSpectrumFitter._fit_roofit_multi_start): fits the pdf from the
+    start values {parameter name : value}. Returns (NLL, converged, {parameter name : value}),
+    NLL is None if the fit failed.
+    """
+    fitter, pdf, dataset, variables, fit_cpus = _roofit_multi_start_setup
+    params = pdf.getParameters(dataset)
+    for par_name, value in start_values.iteritems():
+        params.find(par_name).setVal(value)
+    saved_setup = (fitter.get_fit_cpus(), getattr(fitter, 'compare_unbinned', False))
+    fitter.fit_cpus, fitter.compare_unbinned = fit_cpus, False
+    try:
+        result = fitter._fit_roofit_uncached(pdf, dataset, variables)
+    except Exception, error:
+        print 'Fit from {0} failed: {1}'.format(dict(start_values), error)
+        return (None, False, None)
+    finally:
+        fitter.fit_cpus, fitter.compare_unbinned = saved_setup
+    float_params = result.floatParsFinal()
+    values = collections.OrderedDict([(float_params[idx].GetName(), float_params[idx].getVal()) for idx in range(float_params.getSize())])
+    return (result.minNll(), result.status() == 0, values)
+
+
+if opt.SLIM_DIR:
+    #the slim ntuples keep the branches of the cuts, weights and observables of all the channels and bins
+    for chan in chans:
+        for recobin in range(len(obs_bins)-1):
+            AddSlimExpressions(SignalSpectrumFitter(chan,List, m4l_bins, m4l_low, m4l_high, obs_reco, obs_gen, obs_bins, recobin, recobin).get_tree_expressions(chan))
+
+if opt.CLEAR_DATASET_CACHE:
+    for cache_file_name in [opt.DATASET_CACHE]+glob.glob('{0}_*.root'.format(os.path.splitext(opt.DATASET_CACHE)[0])):
+        get_shared_cache(cache_file_name).clear()
+
 dummy_file = TFile("dummy_file.root","RECREATE")  #Created to fix the ROOT feature of memory resident trees.
 pp = pprint.PrettyPrinter(indent=4)
+scheduler = JobScheduler(opt.JOBS, opt.JOB_LOG_DIR)
+shared_tasks = collections.OrderedDict()  #{task name : name of the task with the same results}
+task_bins = collections.OrderedDict()  #{(recobin, genbin) : [channel]} of the tasks
+task_cache_files = []  #(get cache function, common file, file of the task) of the tasks of --jobs, merged at the end
+task_specs = []  #(task name, arguments of run_fitter_task before and after the fit CPUs)
 for chan in chans:
     for recobin in range(len(obs_bins)-1):
+        #the gen bins with the same stage key (same datasets) give the same results, only the first one runs
+        genbin_groups = collections.OrderedDict()  #{stage key : [genbin]}
         for genbin in range(len(obs_bins)-1):
             #geteffs(chan,List, m4l_bins, m4l_low, m4l_high, obs_reco, obs_gen, obs_bins, recobin, genbin)
-            m4l_tool = SignalSpectrumFitter(chan,List, m4l_bins, m4l_low, m4l_high, obs_reco, obs_gen, obs_bins, recobin, genbin)
-            print m4l_tool
-            m4l_tool.datasets_exists(not opt.DO_DATASETS)
-            if opt.GENERATE_N:
-                m4l_tool.generate_dataset(opt.GENERATE_N)
-            if not opt.DOCLOSURE:
-                m4l_tool.fit_simultaneously(chan, List)
+            stage_key = SignalSpectrumFitter(chan,List, m4l_bins, m4l_low, m4l_high, obs_reco, obs_gen, obs_bins, recobin, genbin).get_stage_key(chan)
+            genbin_groups.setdefault(json.dumps(stage_key, sort_keys=True), []).append(genbin)
+        for genbins in genbin_groups.values():
+            genbin, shared_genbins = genbins[0], genbins[1:]
+            task_name = '{0}_{1}_recobin{2}_genbin{3}'.format(chan, opt.OBSNAME, recobin, genbin)
+            for shared_genbin in shared_genbins:
+                shared_tasks['{0}_{1}_recobin{2}_genbin{3}'.format(chan, opt.OBSNAME, recobin, shared_genbin)] = task_name
+            task_bins.setdefault((recobin, genbin), []).append(chan)
+            if opt.JOBS>1:
+                #the tasks running at the same time cannot write into the same root files, they read the common ones
+                dataset_cache = '{0}_{1}.root'.format(os.path.splitext(opt.DATASET_CACHE)[0], task_name)
+                task_cache_files.append((get_shared_cache, opt.DATASET_CACHE, dataset_cache))
+                fit_cache = ''
+                if opt.FIT_CACHE:
+                    fit_cache = '{0}_{1}.root'.format(os.path.splitext(opt.FIT_CACHE)[0], task_name)
+                    task_cache_files.append((get_shared_fit_cache, opt.FIT_CACHE, fit_cache))
+                task_specs.append((task_name, (chan, recobin, genbin, dataset_cache, os.path.join(opt.JOB_LOG_DIR, task_name+'_dummy_file.root'), shared_genbins), (fit_cache,)))
             else:
-                if opt.CLOSURE_TEST:
-                    params_cfgs = string.split(opt.CLOSURE_TEST,',')
-
-                else:
-                    params_cfgs = ['DCB_parametrization.yaml']
-                print 'Parameterization cfgs: {0}'.format(params_cfgs)
-                params_dict={}
-                tag_for_closure_plots = ''
-                #read all the configurations for the closure test.
-                for params_cfg in params_cfgs:
-                    cfg_reader = UniversalConfigParser(cfg_type="YAML",file_list = params_cfg)
-                    params_dict[params_cfg] = cfg_reader.get_dict()[chan]
-                    tag_for_closure_plots += os.path.splitext(params_cfg)[0]
-                    tag_for_closure_plots+='_'
-                pp.pprint(params_dict)
-                m4l_tool.closure_test_fit(chan, List, params_dict, tag_for_closure_plots)
+                task_specs.append((task_name, (chan, recobin, genbin, opt.DATASET_CACHE, None, shared_genbins), (opt.FIT_CACHE,)))
+#the CPUs are divided only between the tasks which can run at the same time
+parallelism = ParallelismPolicy(opt.CPUS, opt.JOBS, opt.FIT_CPUS, len(task_specs))
+for task_name, args_before, args_after in task_specs:
+    scheduler.add_task(task_name, run_fitter_task, *(args_before+(parallelism.get_fit_cpus(),)+args_after))
+print 'Running {0} tasks, the results of {1} genbin tasks are reused: {2}'.format(len(scheduler.tasks), len(shared_tasks), shared_tasks)
+
+if opt.JOBS>1 and not opt.GENERATE_N:
+    prepare_task_datasets(task_bins)
+task_results = scheduler.run()
+for get_cache, common_file_name, task_file_name in task_cache_files:
+    get_cache(common_file_name).merge(task_file_name)
+failed_tasks = scheduler.print_summary(task_results)
+for task_name, task_result in task_results.iteritems():
+    if task_result.ok() and task_result.result['parameters']:
+        print 'Fit result of {0}:'.format(task_name)
+        pp.pprint(task_result.result['parameters'])
+for task_name, reused_task_name in shared_tasks.iteritems():
+    print 'Fit result of {0}: the same as {1}'.format(task_name, reused_task_name)
 
 dummy_file.Close()
+if failed_tasks:
+    print 'Failed tasks: {0}'.format(failed_tasks)
+    sys.exit(1)